@@ -5,6 +5,8 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 import joblib
 
+from Modules.Loaders.DerivativeEstimator import estimate_derivatives
+
 def load_covasim_data(file_path, population, test_prob, trace_prob, keep_d, case_name, plot=True):
 
     # file_name = '_'.join(['covasim', str(population), str(test_prob), str(trace_prob)])
@@ -137,3 +139,51 @@ def load_covasim_data_drums(file_path, population, case_name, keep_d=True, plot=
 
         '''
     return params
+
+def load_covasim_data_denoised(file_path, 
+                               population, 
+                               test_prob, 
+                               trace_prob, 
+                               keep_d, 
+                               case_name, 
+                               method='savgol', 
+                               trim=1, 
+                               cache_dir=None, 
+                               plot=False, 
+                               **options):
+    '''
+    Loads Covasim simulation data (see load_covasim_data) and preprocesses it
+    for the denoised models (NNComponentsCV_DRUMS, NNComponentsCV) with
+    DerivativeEstimator.estimate_derivatives.
+
+    Args:
+        file_path (str): name of the file path
+        population (int): number of agents in population
+        test_prob (float): testing probability of the simulation
+        trace_prob (float): tracing probability of the simulation
+        keep_d (bool): boolean value indicating whether or not to include D (diagnosed) in model
+        case_name (str): case name of the simulation
+        method (str): 'fd', 'savgol' or 'spline', see estimate_derivatives
+        trim (int or tuple): points dropped at the ends, see estimate_derivatives
+        cache_dir (str): directory of the derivative cache, None disables caching
+        plot (bool): whether or not to plot simulation data
+        options (dict): passed on to estimate_derivatives, e.g. window_length
+            and polyorder for 'savgol' or n_bootstrap
+
+    Returns:
+        params (dict): dictionary with values for each parameter of dataset,
+            plus 'derivatives' (the result of estimate_derivatives) and
+            'u_tensor' (the (N, C, 2) tensor of u and ut)
+    '''
+
+    params = load_covasim_data(file_path, population, test_prob, trace_prob, keep_d, case_name, plot=plot)
+
+    # replicates are counts, an averaged trajectory is already normalized
+    data = params['data']
+    scale = params['population'] if isinstance(data, (list, tuple)) else None
+    derivatives = estimate_derivatives(data, method, population=scale, trim=trim,
+                                       cache_dir=cache_dir, dataset=case_name, **options)
+    params['derivatives'] = derivatives
+    params['u_tensor'] = derivatives['u_tensor']
+
+    return params
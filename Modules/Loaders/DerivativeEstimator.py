@@ -0,0 +1,202 @@
+import os
+import hashlib
+import joblib
+import torch
+import numpy as np
+from scipy.signal import savgol_filter
+from scipy.interpolate import make_smoothing_spline
+
+def as_replicates(data, population=None):
+    '''
+    Stacks Covasim replicates into one array.
+
+    Args:
+        data (list, DataFrame or array): list of (T, C) DataFrames or arrays,
+            a single (T, C) trajectory or an array with shape (R, T, C).
+        population (int): if given, the data is divided by the population.
+
+    Returns:
+        u (array): replicates with shape (R, T, C).
+    '''
+    if isinstance(data, (list, tuple)):
+        u = np.stack([np.asarray(d, dtype=float) for d in data])
+    else:
+        u = np.asarray(data, dtype=float)
+        if u.ndim == 2:
+            u = u[None]
+    if population is not None:
+        u = u / population
+    return u
+
+def finite_difference(u, t):
+    '''
+    Second order central differences (one-sided at the ends) along time,
+    the trajectories are not smoothed.
+    '''
+    return u, np.gradient(u, t, axis=1)
+
+def savitzky_golay(u, t, window_length=15, polyorder=3):
+    '''
+    Savitzky-Golay smoothing and differentiation along time (uniform t).
+    '''
+    delta = t[1] - t[0]
+    smooth = savgol_filter(u, window_length, polyorder, axis=1)
+    deriv = savgol_filter(u, window_length, polyorder, deriv=1, delta=delta, axis=1)
+    return smooth, deriv
+
+def smoothing_operators(t, lam):
+    '''
+    Matrices mapping a trajectory on t to the values and first derivatives
+    of its cubic smoothing spline with regularization lam on t.
+    '''
+    basis = np.eye(len(t))
+    try:
+        spline = make_smoothing_spline(t, basis, lam=lam)
+        return spline(t), spline.derivative()(t)
+    except (ValueError, TypeError):
+        # older scipy, one-dimensional ordinates only
+        splines = [make_smoothing_spline(t, e, lam=lam) for e in basis]
+        return (np.stack([s(t) for s in splines], axis=1),
+                np.stack([s.derivative()(t) for s in splines], axis=1))
+
+def smoothing_spline(u, t, lam=None, lams=np.logspace(-3, 9, 49)):
+    '''
+    Cubic smoothing spline per compartment. If lam is None, the
+    regularization of every compartment is chosen from lams by GCV on the
+    replicate mean and then shared by all replicates, which keeps the
+    smoother linear (so the smoothed mean is the mean of the smoothed
+    replicates).
+    '''
+    lams = [lam] if lam is not None else list(lams)
+    operators = [smoothing_operators(t, l) for l in lams]
+    smooth, deriv = np.empty_like(u), np.empty_like(u)
+    for c in range(u.shape[-1]):
+        mean = u[:, :, c].mean(axis=0)
+        gcv = [len(t) * np.sum((mean - S @ mean) ** 2) / (len(t) - np.trace(S)) ** 2 for S, _ in operators]
+        S, D = operators[int(np.argmin(gcv))]
+        smooth[:, :, c] = u[:, :, c] @ S.T
+        deriv[:, :, c] = u[:, :, c] @ D.T
+    return smooth, deriv
+
+METHODS = {'fd': finite_difference,
+           'savgol': savitzky_golay,
+           'spline': smoothing_spline}
+
+def cache_key(u, t, dataset, method, options):
+    '''
+    Hash of the data, the method and its options.
+    '''
+    h = hashlib.sha1()
+    h.update(str((dataset, method, sorted(options.items()))).encode())
+    h.update(str(u.shape).encode())
+    h.update(np.ascontiguousarray(u).tobytes())
+    h.update(np.ascontiguousarray(t, dtype=float).tobytes())
+    return h.hexdigest()
+
+def estimate_derivatives(data,
+                         method='savgol',
+                         population=None,
+                         t=None,
+                         trim=1,
+                         smooth_values=False,
+                         n_bootstrap=0,
+                         seed=None,
+                         cache_dir=None,
+                         dataset=None,
+                         **options):
+    '''
+    Preprocessing of Covasim replicates for the denoised (DRUMS) models.
+    Smooths and differentiates all replicates and compartments at once and
+    averages them; every method is linear in the data, so this equals
+    smoothing and differentiating the replicate mean (which is all that is
+    done without bootstrap). Bootstrap variances come from resampling
+    replicates with replacement, which only reweights the per-replicate
+    results. Results are cached in cache_dir, keyed by the
+    dataset name, the method, its options and a hash of the data.
+
+    Args:
+        data (list, DataFrame or array): replicates, see as_replicates.
+        method (str): 'fd' (finite differences), 'savgol' (Savitzky-Golay)
+            or 'spline' (smoothing spline).
+        population (int): if given, the data is divided by the population.
+        t (array): time points, defaults to 0, 1, ..., T - 1.
+        trim (int or tuple): number of points dropped at both ends, where
+            derivatives are least accurate (1 gives the days 1 to T - 2, as
+            the notebooks), or a (front, back) pair, e.g. (16, 1) for the
+            trimmed notebook runs.
+        smooth_values (bool): if True, u is the smoothed replicate mean,
+            otherwise the raw replicate mean as in the notebooks (only the
+            derivatives are smoothed).
+        n_bootstrap (int): number of bootstrap resamples of the replicates.
+        seed (int): seed of the bootstrap.
+        cache_dir (str): directory of the cache, None disables caching.
+        dataset (str): name of the dataset in the cache, e.g. the case name.
+        options (dict): passed on to the method, e.g. window_length and
+            polyorder for 'savgol' or lam for 'spline'.
+
+    Returns:
+        result (dict): dictionary with key value pairs
+            't' -> time points after trimming with shape (N,)
+            'u' -> mean trajectories with shape (N, C)
+            'ut' -> mean time derivatives with shape (N, C)
+            'u_var' -> bootstrap variance of u (None without bootstrap)
+            'ut_var' -> bootstrap variance of ut (None without bootstrap)
+            'u_tensor' -> float tensor of u and ut with shape (N, C, 2),
+                the input of NNComponentsCV_DRUMS
+            'method' -> name of the method
+            'options' -> options of the method
+    '''
+    if method not in METHODS:
+        raise ValueError('unknown method ' + str(method) + ', expected one of ' + str(list(METHODS)))
+    u = as_replicates(data, population)
+    t = np.arange(u.shape[1], dtype=float) if t is None else np.asarray(t, dtype=float)
+
+    file_name = None
+    if cache_dir is not None:
+        settings = dict(options, trim=tuple(np.atleast_1d(trim)), smooth_values=smooth_values, n_bootstrap=n_bootstrap, seed=seed)
+        key = cache_key(u, t, dataset, method, settings)
+        file_name = os.path.join(cache_dir, '{0}_{1}_{2}.joblib'.format(dataset, method, key[:16]))
+        if os.path.exists(file_name):
+            result = joblib.load(file_name)
+            result['u_tensor'] = derivative_tensor(result['u'], result['ut'])
+            return result
+
+    # all methods are linear, so without bootstrap only the mean is processed
+    if n_bootstrap == 0:
+        u = u.mean(axis=0, keepdims=True)
+    smooth, deriv = METHODS[method](u, t, **options)
+    values = smooth if smooth_values else u
+    front, back = trim if isinstance(trim, (tuple, list)) else (trim, trim)
+    keep = slice(front, u.shape[1] - back)
+    result = {'t': t[keep],
+              'u': values.mean(axis=0)[keep],
+              'ut': deriv.mean(axis=0)[keep],
+              'u_var': None,
+              'ut_var': None,
+              'method': method,
+              'options': options}
+
+    if n_bootstrap > 0:
+        rng = np.random.default_rng(seed)
+        R = len(u)
+        weights = rng.multinomial(R, np.ones(R) / R, size=n_bootstrap) / R
+        for name, x in [('u_var', values), ('ut_var', deriv)]:
+            x = x[:, keep]
+            boot = (weights @ x.reshape(R, -1)).reshape((n_bootstrap,) + x.shape[1:])
+            result[name] = boot.var(axis=0, ddof=1) if n_bootstrap > 1 else np.zeros(x.shape[1:])
+
+    if file_name is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_name = file_name + '.{0}.tmp'.format(os.getpid())
+        joblib.dump(result, tmp_name)
+        os.replace(tmp_name, file_name)
+    result['u_tensor'] = derivative_tensor(result['u'], result['ut'])
+
+    return result
+
+def derivative_tensor(u, ut):
+    '''
+    Stacks trajectories and derivatives with shape (N, C) into the (N, C, 2)
+    float tensor of NNComponentsCV_DRUMS.
+    '''
+    return torch.as_tensor(np.stack([u, ut], axis=2), dtype=torch.float)
@@ -7,11 +7,8 @@ sys.path.append(sys.path[0] + '\\../')
 
 from Modules.Models.BuildMLP import BuildMLP
 from Modules.Activations.SoftplusReLU import SoftplusReLU
-from Modules.Utils.Gradient import Gradient
-
-from sklearn.preprocessing import PolynomialFeatures
-
-from scipy.stats import beta
+from Modules.Utils.Gradient import Gradient, BatchGradient
+from Modules.Models.PolynomialLayer import PolynomialLayer
 
 class main_MLP(nn.Module):
     '''
@@ -138,6 +135,24 @@ class tau_NN(nn.Module):
 
         return outputs
 
+def to_buffer(array):
+    '''
+    Converts an optional array (e.g. average masking or tracing probabilities) to 
+    a float tensor so it can be registered as a module buffer and live on the 
+    same device as the model.
+    '''
+    if array is None:
+        return None
+    return torch.as_tensor(np.asarray(array, dtype=np.float32))
+
+def beta_bump(x):
+    '''
+    Beta(3, 3) probability density scaled to a maximum of one at x = 0.5, i.e. 
+    16 x^2 (1 - x)^2 on [0, 1] and zero elsewhere. Torch-native equivalent of 
+    scipy.stats.beta.pdf(x, 3, 3) / beta.pdf(0.5, 3, 3).
+    '''
+    return torch.where((x >= 0) & (x <= 1), 16 * x ** 2 * (1 - x) ** 2, torch.zeros_like(x))
+
 def chi(t, eff_ub, chi_type):
     if chi_type is None or chi_type == 'linear':
         rate = eff_ub / 75
@@ -153,18 +168,14 @@ def chi(t, eff_ub, chi_type):
         factor = 0.3 * (1 + torch.sin(rad_times)) / 2
     elif chi_type == 'piecewise':
         factor = torch.zeros_like(t)
-        # use pdf of beta distribution
-        a, b = 3, 3
+        # use pdf of beta distribution, in closed form so it stays on device
         t_max = 159
-        max_val = beta.pdf(0.5, a, b, loc=0, scale=1)
 
         # t < 80
-        factor = factor + (t < 80) * torch.Tensor(beta.pdf(t.cpu().detach().numpy() / t_max, a, b, loc=0, scale=1)).to(
-            t.device) * eff_ub / max_val
+        factor = factor + (t < 80) * beta_bump(t / t_max) * eff_ub
 
         # t > 120
-        factor = factor + (t >= 120) * torch.Tensor(beta.pdf((t.cpu().detach().numpy() - 40) / t_max, a, b, loc=0,
-                                                             scale=1)).to(t.device) * eff_ub / max_val
+        factor = factor + (t >= 120) * beta_bump((t - 40) / t_max) * eff_ub
 
         # otherwise
         factor = factor + (t >= 80) * (t < 120) * eff_ub
@@ -201,6 +212,14 @@ class AdaMaskBINNCovasim(nn.Module):
         tau_deep (bool): If True make q. diagnosis rate network 3 layers deep. Otherwise, 1 layer deep.
         masking (bool): If True, include average masking in the model.
         masking_learned (bool): If True, masking averages are learned.
+
+    Attributes:
+        collocation (CollocationSampler): Optional sampler of extra time points at
+            which the PDE loss is enforced during training (see ModelWrapper.fit).
+        n_members (int): Number of ensemble members stacked along the batch 
+            dimension (see BuildEnsemble). If set, losses are returned per member.
+        compile_modules (list): Names of the networks free of double backward,
+            compiled by ModelWrapper(use_compile=True).
     '''
 
     def __init__(self, 
@@ -239,6 +258,9 @@ class AdaMaskBINNCovasim(nn.Module):
         self.eta_func = eta_NN(3, eta_deep) if not maskb else eta_NN(4, eta_deep)
         self.beta_func = beta_NN(beta_deep)
         self.tau_func = tau_NN(tau_deep)
+        # networks the loss differentiates only once, which ModelWrapper(use_compile=True)
+        # may compile (eta_func and tau_func are differentiated twice by their constraints)
+        self.compile_modules = ['beta_func']
 
         # input extrema
         self.t_min = 0.0
@@ -251,9 +273,10 @@ class AdaMaskBINNCovasim(nn.Module):
         self.pde_weight = 1e4
         
         if masking_learned:
-            self.weights_c = torch.tensor(np.array([1, 1000, 1, 1000, 1000, 1, 1000, 1, 1000, 1])[None, :], dtype=torch.float)
+            weights_c = torch.tensor(np.array([1, 1000, 1, 1000, 1000, 1, 1000, 1, 1000, 1])[None, :], dtype=torch.float)
         else:
-            self.weights_c = torch.tensor(np.array([1, 1000, 1, 1000, 1000, 1, 1000, 1, 1000])[None, :], dtype=torch.float)
+            weights_c = torch.tensor(np.array([1, 1000, 1, 1000, 1000, 1, 1000, 1, 1000])[None, :], dtype=torch.float)
+        self.register_buffer('weights_c', weights_c, persistent=False)
         
         self.pde_loss_weight = 1e0
         self.eta_loss_weight = 1e5
@@ -275,12 +298,14 @@ class AdaMaskBINNCovasim(nn.Module):
         self.p_asymp = params['p_asymp']
         self.n_contacts = params['n_contacts']
         self.delta = params['delta']
-        self.tracing_array = tracing_array
+
+        # lookup tables as (non-persistent) buffers so they move with the model
+        self.register_buffer('tracing_array', to_buffer(tracing_array), persistent=False)
+        self.register_buffer('avg_masking', to_buffer(params['avg_masking']) if maskb else None, persistent=False)
         
-        if maskb:
-            self.avg_masking = params['avg_masking']
-            if masking_learned:
-                self.mt_coef = torch.tensor(params['mt_coef'])
+        if masking_learned:
+            self.register_buffer('mt_coef', torch.tensor(params['mt_coef'], dtype=torch.float), persistent=False)
+            self.mt_poly = PolynomialLayer(9, degree=2)
         self.maskb = maskb
         self.masking_learned = masking_learned
 
@@ -291,13 +316,33 @@ class AdaMaskBINNCovasim(nn.Module):
 
         self.chi_type = chi_type if chi_type is not None else None
 
+        # optional collocation points for the pde loss
+        self.collocation = None
+
+        # optional number of stacked ensemble members
+        self.n_members = None
+
+    def mean(self, x):
+        '''Mean over points, or per ensemble member if members are stacked'''
+        if self.n_members is None:
+            return torch.mean(x)
+        return x.reshape(self.n_members, -1).mean(dim=1)
 
     def forward(self, inputs):
         '''Forward Pass of Neural Network'''
         # cache input batch for pde loss
         self.inputs = inputs
 
-        return self.surface_fitter(self.inputs)
+        # during training, evaluate collocation points in the same forward pass
+        if self.training and self.collocation is not None:
+            colloc = self.collocation.sample().to(inputs.device)
+            self.pde_inputs = torch.cat([inputs, colloc], dim=0)
+            self.pde_outputs = self.surface_fitter(self.pde_inputs)
+            return self.pde_outputs[:len(inputs)]
+
+        self.pde_inputs = inputs
+        self.pde_outputs = self.surface_fitter(self.pde_inputs)
+        return self.pde_outputs
 
     def gls_loss(self, pred, true):
         '''GLS Loss Function'''
@@ -312,13 +357,12 @@ class AdaMaskBINNCovasim(nn.Module):
         residual *= pred.abs().clamp(min=1.0) ** (-self.gamma)
 
         # apply weights on compartments
-        residual *= self.weights_c.to(self.inputs.device)
+        residual *= self.weights_c
 
-        return torch.mean(residual)
+        return self.mean(residual)
 
     def pde_loss(self, inputs, outputs, return_mean=True):
         '''PDE Loss Function'''
-        pde_loss = 0
         # unpack inputs
         t = inputs[:, 0][:, None]
 
@@ -331,8 +375,7 @@ class AdaMaskBINNCovasim(nn.Module):
             if self.masking_learned:
                 eta_input = torch.cat([u[:,[0,3,4,9]]], dim=1).float()
             else:
-                avg_masking = torch.tensor(self.avg_masking, dtype=torch.float).to(inputs.device)
-                avg_masking = avg_masking[(t * self.t_max_real).long()]
+                avg_masking = self.avg_masking[(t * self.t_max_real).long()]
                 eta_input = torch.cat([u[:,[0,3,4]], avg_masking], dim=1).float()
         else:
             eta_input = torch.cat([u[:,[0,3,4]]], dim=1).float()
@@ -349,11 +392,10 @@ class AdaMaskBINNCovasim(nn.Module):
         tau = self.tau_lb + (self.tau_ub - self.tau_lb) * tau0
 
         if self.masking_learned:
-            poly = PolynomialFeatures(2)
-            X_mt = torch.tensor(poly.fit_transform(u[:,0:9].detach().cpu())).float().to(inputs.device)
-            mt_coef = self.mt_coef.float().to(inputs.device)[:,None]
+            X_mt = self.mt_poly(u[:,0:9])
+            mt_coef = self.mt_coef[:,None]
 
-        # STEAYDQRF model, loop through each compartment
+        # unpack STEAYDQRF compartments
         if self.masking_learned:
             s, tq, e, a, y, d, q, r, f, m = u[:, 0][:, None], u[:, 1][:, None], u[:, 2][:, None], u[:, 3][:, None],\
                                         u[:, 4][:, None], u[:, 5][:, None], u[:, 6][:, None], u[:, 7][:, None],\
@@ -364,43 +406,28 @@ class AdaMaskBINNCovasim(nn.Module):
                                         u[:, 8][:, None]
         # (mu * Y + tau * Q)
         new_d = self.mu * y + tau * q
-        for i in range(self.n_com):
-            d1 = Gradient(u[:, i], inputs, order=1)
-            ut = d1[:, 0][:, None]
-            LHS = ut / self.t_max_real
-            if i == 0:
-                # dS
-                RHS = - yita * s  * (a + y) - beta * new_d * self.n_contacts * s + self.alpha * tq
-            elif i == 1:
-                # dT
-                RHS = beta * new_d * self.n_contacts * s - self.alpha * tq
-            elif i == 2:
-                # dE
-                RHS = yita * s * (a + y) - self.gamma * e
-            elif i == 3:
-                # dA
-                RHS = self.p_asymp * self.gamma * e - self.lamda * a - beta * new_d * self.n_contacts * a
-            elif i == 4:
-                # dY
-                RHS = (1 - self.p_asymp) * self.gamma * e - (self.mu + self.lamda + self.delta) * y - beta * new_d * self.n_contacts * y
-            elif i == 5:
-                # dD
-                RHS = self.mu * y + tau * q - self.lamda * d - self.delta * d
-            elif i == 6:
-                # dQ
-                RHS = beta * new_d * self.n_contacts * (a + y) - (tau + self.lamda + self.delta) * q
-            elif i == 7:
-                # dR
-                RHS = self.lamda * (a + y + d + q)
-            elif i == 8:
-                # dF
-                RHS = self.delta * (y + d + q)
-            elif i == 9:
-                # dM
-                RHS = torch.matmul(X_mt, mt_coef)
-
-            if i in [0, 1, 2, 3, 4, 5, 6, 9]:
-                pde_loss += (LHS - RHS) ** 2
+        
+        # time derivatives of all compartments in a single backward pass
+        LHS = BatchGradient(u, inputs)[:, :, 0] / self.t_max_real
+        
+        # STEAYDQRF right hand sides, one column per compartment
+        RHS = [
+            - yita * s  * (a + y) - beta * new_d * self.n_contacts * s + self.alpha * tq, # dS
+            beta * new_d * self.n_contacts * s - self.alpha * tq, # dT
+            yita * s * (a + y) - self.gamma * e, # dE
+            self.p_asymp * self.gamma * e - self.lamda * a - beta * new_d * self.n_contacts * a, # dA
+            (1 - self.p_asymp) * self.gamma * e - (self.mu + self.lamda + self.delta) * y - beta * new_d * self.n_contacts * y, # dY
+            self.mu * y + tau * q - self.lamda * d - self.delta * d, # dD
+            beta * new_d * self.n_contacts * (a + y) - (tau + self.lamda + self.delta) * q, # dQ
+            self.lamda * (a + y + d + q), # dR
+            self.delta * (y + d + q)] # dF
+        if self.masking_learned:
+            RHS.append(torch.matmul(X_mt, mt_coef)) # dM
+        RHS = torch.cat(RHS, dim=1)
+        
+        # residuals of every compartment except R and F
+        residual_inds = [i for i in [0, 1, 2, 3, 4, 5, 6, 9] if i < self.n_com]
+        pde_loss = ((LHS - RHS)[:, residual_inds] ** 2).sum(dim=1, keepdim=True)
 
         pde_loss *= self.pde_loss_weight
 
@@ -422,7 +449,7 @@ class AdaMaskBINNCovasim(nn.Module):
         self.tau_y_loss += self.tau_loss_weight * torch.where(dtau[:,1] < 0, dtau[:,1] ** 2, torch.zeros_like(dtau[:,1]))
 
         if return_mean:
-            return torch.mean(pde_loss  + self.eta_a_loss + self.eta_y_loss + self.tau_a_loss + self.tau_y_loss)
+            return self.mean(pde_loss[:, 0] + self.eta_a_loss + self.eta_y_loss + self.tau_a_loss + self.tau_y_loss)
         else:
             return pde_loss
 
@@ -431,19 +458,14 @@ class AdaMaskBINNCovasim(nn.Module):
         self.gls_loss_val = 0
         self.pde_loss_val = 0
 
-        # load inputs from forward pass
-        p = np.random.permutation(self.inputs.shape[0])
-        inputs_rand = self.inputs[p]
-
-        # predict surface fitter at sampled points
-        outputs_rand = self.surface_fitter(inputs_rand)
-
         # compute surface loss
         self.gls_loss_val = self.surface_weight * self.gls_loss(pred, true)
         
-        # compute PDE loss at sampled locations
+        # compute PDE loss at the inputs (and any collocation points) cached in 
+        # the forward pass, reusing its outputs and graph (the loss is a mean 
+        # over points, so shuffling them first would not change it)
         if self.pde_weight != 0:
-            self.pde_loss_val += self.pde_weight * self.pde_loss(inputs_rand, outputs_rand)
+            self.pde_loss_val += self.pde_weight * self.pde_loss(self.pde_inputs, self.pde_outputs)
 
         return self.gls_loss_val + self.pde_loss_val
     
@@ -504,15 +526,20 @@ class NNComponentsCV_DRUMS(nn.Module):
         self.tau_lb = tau_lb if tau_lb is not None else 0.0
         self.tau_ub =  tau_ub if tau_ub is not None else 0.5
         
-        # store denoised data and numerically approximated derivatives
-        self.u_tensor = u_tensor
-        self.u = u_tensor[:,:,0]
-        self.ut = u_tensor[:,:,1]
+        # store denoised data and numerically approximated derivatives as 
+        # (non-persistent) buffers so they move with the model
+        u_tensor = torch.as_tensor(u_tensor)
+        self.register_buffer('u_tensor', u_tensor, persistent=False)
+        self.register_buffer('u', u_tensor[:,:,0], persistent=False)
+        self.register_buffer('ut', u_tensor[:,:,1], persistent=False)
 
         # pde functions/components
         self.eta_func = eta_NN(3, eta_deep) if not mask_input else eta_NN(4, eta_deep)
         self.beta_func = beta_NN(beta_deep)
         self.tau_func = tau_NN(tau_deep)
+        # networks the loss differentiates only once, which ModelWrapper(use_compile=True)
+        # may compile (eta_func and tau_func are differentiated twice by their constraints)
+        self.compile_modules = ['beta_func']
 
         # input extrema
         self.t_min = 0.0
@@ -542,12 +569,12 @@ class NNComponentsCV_DRUMS(nn.Module):
         self.p_asymp = params['p_asymp']
         self.n_contacts = params['n_contacts']
         self.delta = params['delta']
-        self.tracing_array = tracing_array
-        if maskb:
-            self.avg_masking = params['avg_masking'][1:t_max_real]
+        self.register_buffer('tracing_array', to_buffer(tracing_array), persistent=False)
+        self.register_buffer('avg_masking', to_buffer(params['avg_masking'][1:t_max_real]) if maskb else None, persistent=False)
 
         self.keep_d = keep_d
         self.mask_input = mask_input
+        self.maskb = maskb
 
         # if dynamic
         if 'dynamic_tracing' in params:
@@ -578,8 +605,7 @@ class NNComponentsCV_DRUMS(nn.Module):
         chi_t = chi(1 + t * self.t_max_real, self.eff_ub, self.chi_type)
 
         if self.maskb:
-            avg_masking = torch.tensor(self.avg_masking, dtype=torch.float).to(inputs.device)
-            avg_masking = avg_masking[(t * self.t_max_real).long()]
+            avg_masking = self.avg_masking[(t * self.t_max_real).long()]
             cat_tensor = torch.cat([u[:,[0,3,4]], avg_masking], dim=1).float()
         else:
             cat_tensor = torch.cat([u[:,[0,3,4]]], dim=1).float()
@@ -594,7 +620,7 @@ class NNComponentsCV_DRUMS(nn.Module):
         tau0 = self.tau_func(ay_tensor)
         tau = self.tau_lb + (self.tau_ub - self.tau_lb) * tau0
         
-        # STEAYDQRF model, loop through each compartment
+        # unpack STEAYDQRF compartments
         s, tq, e, a, y, d, q, r, f = u[:, 0][:, None], u[:, 1][:, None], u[:, 2][:, None], u[:, 3][:, None],\
                                     u[:, 4][:, None], u[:, 5][:, None], u[:, 6][:, None], u[:, 7][:, None],\
                                     u[:, 8][:, None]
@@ -734,15 +760,20 @@ class NNComponentsCV(nn.Module):
         self.tau_lb = tau_lb if tau_lb is not None else 0.0
         self.tau_ub =  tau_ub if tau_ub is not None else 0.5
         
-        # store denoised data and numerically approximated derivatives
-        self.u_tensor = u_tensor
-        self.u = u_tensor[:,:,0]
-        self.ut = u_tensor[:,:,1]
+        # store denoised data and numerically approximated derivatives as 
+        # (non-persistent) buffers so they move with the model
+        u_tensor = torch.as_tensor(u_tensor)
+        self.register_buffer('u_tensor', u_tensor, persistent=False)
+        self.register_buffer('u', u_tensor[:,:,0], persistent=False)
+        self.register_buffer('ut', u_tensor[:,:,1], persistent=False)
 
         # pde functions/components
         self.eta_func = eta_NN(3, eta_deep) if not mask_input else eta_NN(4, eta_deep)
         self.beta_func = beta_NN(beta_deep)
         self.tau_func = tau_NN(tau_deep)
+        # networks the loss differentiates only once, which ModelWrapper(use_compile=True)
+        # may compile (eta_func and tau_func are differentiated twice by their constraints)
+        self.compile_modules = ['beta_func']
 
         # input extrema
         self.t_min = 0.0
@@ -772,12 +803,12 @@ class NNComponentsCV(nn.Module):
         self.p_asymp = params['p_asymp']
         self.n_contacts = params['n_contacts']
         self.delta = params['delta']
-        self.tracing_array = tracing_array
-        if maskb:
-            self.avg_masking = params['avg_masking'][1:t_max_real]
+        self.register_buffer('tracing_array', to_buffer(tracing_array), persistent=False)
+        self.register_buffer('avg_masking', to_buffer(params['avg_masking'][1:t_max_real]) if maskb else None, persistent=False)
 
         self.keep_d = keep_d
         self.mask_input = mask_input
+        self.maskb = maskb
 
         # if dynamic
         if 'dynamic_tracing' in params:
@@ -808,8 +839,7 @@ class NNComponentsCV(nn.Module):
         chi_t = chi(1 + t * self.t_max_real, self.eff_ub, self.chi_type)
 
         if self.mask_input:
-            avg_masking = torch.tensor(self.avg_masking, dtype=torch.float).to(inputs.device)
-            avg_masking = avg_masking[(t * self.t_max_real - 1).long()]
+            avg_masking = self.avg_masking[(t * self.t_max_real - 1).long()]
             cat_tensor = torch.cat([u[:,[0,3,4]], avg_masking], dim=1).float()
         else:
             cat_tensor = torch.cat([u[:,[0,3,4]]], dim=1).float()
@@ -824,7 +854,7 @@ class NNComponentsCV(nn.Module):
         tau0 = self.tau_func(ay_tensor)
         tau = self.tau_lb + (self.tau_ub - self.tau_lb) * tau0
         
-        # STEAYDQRF model, loop through each compartment
+        # unpack STEAYDQRF compartments
         s, tq, e, a, y, d, q, r, f = u[:, 0][:, None], u[:, 1][:, None], u[:, 2][:, None], u[:, 3][:, None],\
                                     u[:, 4][:, None], u[:, 5][:, None], u[:, 6][:, None], u[:, 7][:, None],\
                                     u[:, 8][:, None]
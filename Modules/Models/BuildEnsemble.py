@@ -0,0 +1,153 @@
+import copy
+import torch, pdb
+import torch.nn as nn
+
+from torch.func import stack_module_state, functional_call, vmap
+
+class StackedModule(nn.Module):
+
+    '''
+    K independent copies of a module whose parameters are stacked along a
+    leading member dimension and evaluated in a single vmapped call. Inputs
+    and outputs are flattened over members, i.e. rows [k*N, (k+1)*N) belong
+    to member k, so the stacked module is a drop-in replacement for one copy
+    inside a model that treats rows independently.
+
+    Args:
+        modules (list): Modules with identical architecture.
+
+    Inputs:
+        x (tensor): Float tensor of inputs with shape (K*N, ...).
+
+    Returns:
+        y (tensor): Float tensor of outputs with shape (K*N, ...).
+    '''
+
+    def __init__(self, modules):
+
+        super().__init__()
+        self.n_members = len(modules)
+
+        # stacked parameters and buffers, dots are not allowed in names
+        params, buffers = stack_module_state(modules)
+        self.param_names = list(params.keys())
+        self.buffer_names = list(buffers.keys())
+        self.weights = nn.ParameterList(
+            [nn.Parameter(params[n].detach()) for n in self.param_names])
+        for n in self.buffer_names:
+            self.register_buffer('_' + n.replace('.', '_'), buffers[n])
+
+        # stateless copy of the architecture (kept out of the module tree)
+        self.__dict__['base'] = copy.deepcopy(modules[0]).to('meta')
+
+    def stacked_state(self):
+
+        params = dict(zip(self.param_names, self.weights))
+        buffers = {n: getattr(self, '_' + n.replace('.', '_')) for n in self.buffer_names}
+
+        return params, buffers
+
+    def member_state_dict(self, k):
+
+        '''
+        Returns the state dict of member k, loadable into a single copy.
+        '''
+
+        params, buffers = self.stacked_state()
+        state = {n: p[k].detach().clone() for n, p in params.items()}
+        state.update({n: b[k].detach().clone() for n, b in buffers.items()})
+
+        return state
+
+    def load_member_state_dict(self, k, state):
+
+        '''
+        Copies the state dict of a single copy into member k.
+        '''
+
+        params, buffers = self.stacked_state()
+        with torch.no_grad():
+            for n, p in list(params.items()) + list(buffers.items()):
+                p[k].copy_(state[n])
+
+    def train(self, mode=True):
+
+        super().train(mode)
+        self.base.train(mode)
+
+        return self
+
+    def forward(self, x):
+
+        def call(params, buffers, x):
+            return functional_call(self.base, (params, buffers), (x,))
+
+        # (K*N, ...) -> (K, N, ...) -> vmap over members -> (K*N, ...)
+        params, buffers = self.stacked_state()
+        x = x.reshape(self.n_members, -1, *x.shape[1:])
+        y = vmap(call, randomness='different')(params, buffers, x)
+
+        return y.reshape(-1, *y.shape[2:])
+
+def BuildEnsemble(models):
+
+    '''
+    Stacks K models with identical architecture (e.g. one BINN per Covasim
+    replicate) into one ensemble model. The ensemble is a copy of the first
+    model whose child networks are replaced by StackedModules, so it runs its
+    own forward/loss code on inputs flattened over members (see StackedModule)
+    and trains all members in lockstep. The model must set n_members to
+    return one loss per member (see AdaMaskBINNCovasim.mean).
+
+    Args:
+        models (list): Models with identical architecture and settings.
+
+    Returns:
+        ensemble (nn.Module): Ensemble model with n_members = len(models).
+    '''
+
+    ensemble = copy.deepcopy(models[0])
+    ensemble.n_members = len(models)
+    ensemble.children_stacked = []
+    for name, child in models[0].named_children():
+        if len(list(child.parameters())) == 0:
+            continue
+        stacked = StackedModule([getattr(m, name) for m in models])
+        setattr(ensemble, name, stacked)
+        ensemble.children_stacked.append(name)
+
+    # collocation points are appended after all members, which breaks the
+    # member layout of the rows
+    if getattr(ensemble, 'collocation', None) is not None:
+        raise Exception('Collocation points are not supported for ensembles.')
+
+    return ensemble
+
+def member_state_dict(ensemble, k):
+
+    '''
+    Returns the state dict of member k of an ensemble from BuildEnsemble,
+    loadable into one of the original models.
+    '''
+
+    state = {}
+    for name, value in ensemble.state_dict().items():
+        child = name.split('.')[0]
+        if child not in ensemble.children_stacked:
+            state[name] = value
+    for child in ensemble.children_stacked:
+        for name, value in getattr(ensemble, child).member_state_dict(k).items():
+            state[child + '.' + name] = value
+
+    return state
+
+def load_member_state_dict(ensemble, k, state):
+
+    '''
+    Loads the state dict of one of the original models into member k.
+    '''
+
+    for child in ensemble.children_stacked:
+        prefix = child + '.'
+        getattr(ensemble, child).load_member_state_dict(
+            k, {n[len(prefix):]: v for n, v in state.items() if n.startswith(prefix)})
@@ -0,0 +1,104 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from functools import lru_cache
+from itertools import chain, combinations, combinations_with_replacement
+
+class PolynomialLayer(nn.Module):
+
+    '''
+    Torch-native polynomial feature expansion. Produces the same features, in
+    the same order and with the same term names, as
+    sklearn.preprocessing.PolynomialFeatures, but runs on the device of the
+    inputs and keeps the autograd graph. The index tuples of every term are
+    precomputed once; each term is the product of the input columns it
+    indexes, where index n_features points to a column of ones so that lower
+    degree terms (and the bias) can share one (n_out, degree) index table.
+
+    Args:
+        n_features        (int): Number of input features.
+        degree            (int): Maximal degree of the polynomial features.
+        include_bias     (bool): If True, includes the constant (bias) term.
+        interaction_only (bool): If True, only products of distinct features.
+
+    Inputs:
+        x (tensor): Float tensor of inputs with shape (N, n_features).
+
+    Returns:
+        X (tensor): Float tensor of features with shape (N, n_out).
+    '''
+
+    def __init__(self, n_features, degree=2, include_bias=True, interaction_only=False):
+
+        super().__init__()
+        self.n_features = n_features
+        self.degree = degree
+        self.include_bias = include_bias
+        self.interaction_only = interaction_only
+
+        # index tuples in sklearn order: by degree, then lexicographically
+        combine = combinations if interaction_only else combinations_with_replacement
+        start = 0 if include_bias else 1
+        self.powers = [c for c in chain.from_iterable(
+            combine(range(n_features), d) for d in range(start, degree+1))]
+        self.n_out = len(self.powers)
+
+        # pad lower degree terms with the index of the ones column
+        index = np.full([self.n_out, max(degree, 1)], n_features)
+        for i, c in enumerate(self.powers):
+            index[i, :len(c)] = c
+        self.register_buffer('index', torch.tensor(index, dtype=torch.long), persistent=False)
+
+    def forward(self, x):
+
+        ones = torch.ones_like(x[:, :1])
+        x = torch.cat([x, ones], dim=1)
+
+        return x[:, self.index].prod(dim=-1)
+
+    def transform(self, x):
+
+        '''
+        Applies the expansion to numpy arrays or tensors, returning the same
+        type. Numpy inputs are computed in numpy so that their dtype is kept.
+        '''
+
+        if torch.is_tensor(x):
+            return self.forward(x)
+        x = np.asarray(x)
+        x = np.concatenate([x, np.ones_like(x[:, :1])], axis=1)
+
+        return x[:, self.index.cpu().numpy()].prod(axis=-1)
+
+    def get_feature_names_out(self, input_features=None):
+
+        '''
+        Returns the term names, e.g. ['1', 'x0', 'x0^2', 'x0 x1'], using
+        input_features (default x0, x1, ...) as the names of the inputs.
+        '''
+
+        if input_features is None:
+            input_features = ['x%d' % i for i in range(self.n_features)]
+        names = []
+        for c in self.powers:
+            if len(c) == 0:
+                names.append('1')
+                continue
+            terms = []
+            for i in sorted(set(c)):
+                power = c.count(i)
+                terms.append(input_features[i] if power == 1 else '%s^%d' % (input_features[i], power))
+            names.append(' '.join(terms))
+
+        return np.asarray(names, dtype=object)
+
+@lru_cache(maxsize=None)
+def polynomial_layer(n_features, degree=2, include_bias=True, interaction_only=False):
+
+    '''
+    Returns a cached PolynomialLayer, so callers that expand inputs at every
+    step (e.g. ODE right-hand sides) do not rebuild the index tuples.
+    '''
+
+    return PolynomialLayer(n_features, degree, include_bias, interaction_only)
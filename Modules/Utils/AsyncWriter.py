@@ -0,0 +1,131 @@
+import os
+import threading
+import collections
+import torch
+
+def snapshot(state_dict):
+
+    '''
+    Copies a (possibly nested) state dict to the CPU, so it can be written
+    while training keeps updating the original tensors.
+    '''
+
+    if torch.is_tensor(state_dict):
+        return state_dict.detach().to('cpu', copy=True)
+    if isinstance(state_dict, dict):
+        return type(state_dict)((k, snapshot(v)) for k, v in state_dict.items())
+    if isinstance(state_dict, (list, tuple)):
+        return type(state_dict)(snapshot(v) for v in state_dict)
+    return state_dict
+
+class AsyncWriter():
+
+    '''
+    Background writer thread for checkpoints and plots. Jobs are keyed by the
+    file they write: submitting a job for a file that still has a pending job
+    replaces it, so superseded saves are coalesced and only the latest
+    snapshot is written. Checkpoints can also be kept as epoch-tagged copies,
+    of which only the last keep_last are retained (besides the best one).
+
+    The writer is also a ModelWrapper callback that flushes all pending jobs
+    at the end of training.
+
+    Args:
+        keep_last (int): Number of epoch-tagged checkpoints to keep per name
+                          (0 keeps only the untagged best checkpoint).
+
+    Inputs:
+        wrapper (ModelWrapper): Model wrapper, unused.
+    '''
+
+    def __init__(self, keep_last=0):
+
+        self.keep_last = keep_last
+        self.pending = collections.OrderedDict()
+        self.history = collections.defaultdict(collections.deque)
+        self.condition = threading.Condition()
+        self.busy = False
+        self.error = None
+        self.n_submitted = 0
+        self.n_written = 0
+
+        # callback flags, see ModelWrapper.fit
+        self.on_train_begin = False
+        self.on_epoch_begin = False
+        self.on_batch_begin = False
+        self.on_batch_end = False
+        self.on_epoch_end = False
+        self.on_train_end = True
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, key, job, *args):
+
+        '''
+        Queues job(*args) under key, replacing a pending job with the same key.
+        '''
+
+        with self.condition:
+            self.pending.pop(key, None)
+            self.pending[key] = (job, args)
+            self.n_submitted += 1
+            self.condition.notify()
+
+    def save(self, state_dict, file_name, epoch=None):
+
+        '''
+        Snapshots a state dict and queues torch.save to file_name. If epoch is
+        given and keep_last > 0, an epoch-tagged copy is also written and the
+        oldest copies beyond keep_last are removed.
+        '''
+
+        state = snapshot(state_dict)
+        self.submit(file_name, torch.save, state, file_name)
+        if epoch is not None and self.keep_last > 0:
+            tagged = '{0}_epoch_{1}'.format(file_name, epoch)
+            self.submit(tagged, self.save_tagged, state, file_name, tagged)
+
+    def save_tagged(self, state, file_name, tagged):
+
+        torch.save(state, tagged)
+        history = self.history[file_name]
+        history.append(tagged)
+        while len(history) > self.keep_last:
+            old = history.popleft()
+            if os.path.exists(old):
+                os.remove(old)
+
+    def run(self):
+
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.busy = False
+                    self.condition.notify_all()
+                    self.condition.wait()
+                key, (job, args) = self.pending.popitem(last=False)
+                self.busy = True
+            try:
+                job(*args)
+                self.n_written += 1
+            except Exception as e:
+                self.error = e
+
+    def flush(self):
+
+        '''
+        Blocks until all pending jobs are written and re-raises any error
+        raised by a job.
+        '''
+
+        with self.condition:
+            while self.pending or self.busy:
+                self.condition.wait()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __call__(self, wrapper):
+
+        self.flush()
@@ -0,0 +1,279 @@
+import numpy as np
+import torch
+
+from Modules.Models.BuildBINNs import chi
+from Modules.Models.PolynomialLayer import polynomial_layer
+
+# chi_func in PDESolver uses a fixed upper bound on the tracing efficiency
+EFF_UB = 0.3
+
+def batch_param(value, u):
+    '''
+    Converts a model parameter to a tensor on the device of u. Scalars stay
+    scalars, per-trajectory values (one per row of u) become a (B, 1) column.
+    '''
+    value = torch.as_tensor(value, dtype=u.dtype, device=u.device)
+    return value if value.dim() == 0 else value.reshape(-1, 1)
+
+def expand(x, degree):
+    '''
+    Optional polynomial features of x (with bias) as in STEAYDQRF_RHS_dynamic_DRUMS.
+    '''
+    if degree == -1:
+        return x
+    return polynomial_layer(x.shape[1], degree)(x)
+
+def STEAYDQRF_RHS_batch(t,
+                        u,
+                        eta_func,
+                        beta_func,
+                        tau_func,
+                        params,
+                        t_max,
+                        chi_type,
+                        masking=False,
+                        eta_all_comps=False,
+                        beta_all_comps=False,
+                        tau_all_comps=False,
+                        eta_degree=-1,
+                        beta_degree=-1,
+                        tau_degree=-1):
+    '''
+    Batched torch version of PDESolver.STEAYDQRF_RHS_dynamic_DRUMS. Evaluates the
+    learned components once on all B states instead of on a single 1 x k row.
+
+    Args:
+        t (float): current time.
+        u (tensor): STEAYDQRF values with shape (B, 9).
+        eta_func (func): torch callable mapping (B, k) features to (B, 1) contact rates.
+        beta_func (func): torch callable mapping (B, k) features to (B, 1) tracing rates.
+        tau_func (func): torch callable mapping (B, k) features to (B, 1) diagnosis rates.
+        params (dict): parameters of the Covasim model, each a scalar or one value
+            per trajectory.
+        t_max (float): the maximum value of time in the t array.
+        chi_type (str): string indicating the type of function chi is.
+
+    Returns:
+        (tensor): derivatives of STEAYDQRF with shape (B, 9).
+    '''
+
+    p = {k: batch_param(params[k], u) for k in
+         ['alpha', 'gamma', 'mu', 'lamda', 'p_asymp', 'n_contacts', 'delta',
+          'yita_lb', 'yita_ub', 'tau_lb', 'tau_ub']}
+    B = u.shape[0]
+    t_col = torch.full((B, 1), float(t), dtype=u.dtype, device=u.device)
+    chi_t = chi(t_col, EFF_UB, chi_type)
+
+    # eta
+    eta_input = u[:, [0, 3, 4]] if not eta_all_comps else u
+    if masking:
+        avg_masking = params['avg_masking']
+        m = avg_masking[int(t * t_max)] if int(t * t_max) < 183 else avg_masking[-1]
+        eta_input = torch.cat([eta_input, batch_param(m, u).expand(B, 1)], dim=1)
+    cr = eta_func(expand(eta_input, eta_degree)).reshape(B, -1)[:, :1]
+    yita = p['yita_lb'] + (p['yita_ub'] - p['yita_lb']) * cr
+
+    # beta
+    if not beta_all_comps:
+        beta_input = torch.cat([u[:, [0, 3, 4]].sum(dim=1, keepdim=True), chi_t], dim=1)
+    else:
+        beta_input = u
+    beta0 = beta_func(expand(beta_input, beta_degree)).reshape(B, -1)[:, :1]
+    beta = chi_t * beta0
+
+    # tau
+    tau_input = u[:, [3, 4]] if not tau_all_comps else u
+    tau0 = tau_func(expand(tau_input, tau_degree)).reshape(B, -1)[:, :1]
+    tau = p['tau_lb'] + (p['tau_ub'] - p['tau_lb']) * tau0
+
+    # current compartment values
+    s, tq, e, a, y, d, q, r, f = [u[:, i:i+1] for i in range(9)]
+    new_d = p['mu'] * y + tau * q
+    contacts = beta * new_d * p['n_contacts']
+
+    ds = - yita * s * (a + y) - contacts * s + p['alpha'] * tq
+    dt = contacts * s - p['alpha'] * tq
+    de = yita * s * (a + y) - p['gamma'] * e
+    da = p['p_asymp'] * p['gamma'] * e - p['lamda'] * a - contacts * a
+    dy = (1 - p['p_asymp']) * p['gamma'] * e - (p['mu'] + p['lamda'] + p['delta']) * y - contacts * y
+    dd = p['mu'] * y + tau * q - p['lamda'] * d - p['delta'] * d
+    dq = contacts * (a + y) - (tau + p['delta']) * q
+    dr = p['lamda'] * (a + y + d)
+    df = p['delta'] * (y + d + q)
+
+    return torch.cat([ds, dt, de, da, dy, dd, dq, dr, df], dim=1)
+
+def rk4(f, u0, t, n_steps=1000):
+    '''
+    Classic fourth-order Runge-Kutta integration of du/dt = f(t, u) for a batch
+    of initial conditions. About n_steps equal steps cover [t[0], t[-1]],
+    adjusted so that every output time is hit exactly.
+
+    Args:
+        f (func): right hand side mapping (t, (B, n)) to (B, n).
+        u0 (tensor): initial conditions with shape (B, n).
+        t (array): increasing output times.
+        n_steps (int): approximate total number of steps.
+
+    Returns:
+        u (tensor): solution at the output times with shape (B, len(t), n).
+    '''
+    t = np.asarray(t, dtype=float)
+    h_max = (t[-1] - t[0]) / n_steps
+    u = u0
+    out = [u0]
+    for t0, t1 in zip(t[:-1], t[1:]):
+        n = max(int(np.ceil((t1 - t0) / h_max - 1e-9)), 1)
+        h = (t1 - t0) / n
+        for i in range(n):
+            ti = t0 + i * h
+            k1 = f(ti, u)
+            k2 = f(ti + h / 2, u + h / 2 * k1)
+            k3 = f(ti + h / 2, u + h / 2 * k2)
+            k4 = f(ti + h, u + h * k3)
+            u = u + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        out.append(u)
+    return torch.stack(out, dim=1)
+
+# Dormand-Prince 5(4) Butcher tableau
+DP_C = [0, 1/5, 3/10, 4/5, 8/9, 1, 1]
+DP_A = [[],
+        [1/5],
+        [3/40, 9/40],
+        [44/45, -56/15, 32/9],
+        [19372/6561, -25360/2187, 64448/6561, -212/729],
+        [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+        [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+DP_B = [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0]
+DP_E = [71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40]
+
+def dopri5(f, u0, t, rtol=1e-6, atol=1e-9, h0=None, max_steps=100000):
+    '''
+    Adaptive Dormand-Prince 5(4) integration of du/dt = f(t, u) for a batch of
+    initial conditions (the method of scipy's 'dopri5'). All trajectories share
+    the step size, which is controlled by the largest error norm in the batch,
+    and steps are shortened to hit every output time exactly.
+
+    Args:
+        f (func): right hand side mapping (t, (B, n)) to (B, n).
+        u0 (tensor): initial conditions with shape (B, n).
+        t (array): increasing output times.
+        rtol (float): relative tolerance.
+        atol (float): absolute tolerance.
+        h0 (float): initial step size, defaults to 1/100 of the time span.
+        max_steps (int): maximal number of accepted and rejected steps.
+
+    Returns:
+        u (tensor): solution at the output times with shape (B, len(t), n).
+    '''
+    t = np.asarray(t, dtype=float)
+    h = (t[-1] - t[0]) / 100 if h0 is None else h0
+    tc, u = t[0], u0
+    out = [u0]
+    k1 = f(tc, u)
+    steps = 0
+    for t1 in t[1:]:
+        while tc < t1 - 1e-12 * max(1.0, abs(t1)):
+            steps += 1
+            if steps > max_steps:
+                raise RuntimeError('dopri5: maximal number of steps exceeded')
+            h_step = min(h, t1 - tc)
+            k = [k1]
+            for i in range(1, 7):
+                du = sum(a * ki for a, ki in zip(DP_A[i], k) if a != 0)
+                k.append(f(tc + DP_C[i] * h_step, u + h_step * du))
+            u_new = u + h_step * sum(b * ki for b, ki in zip(DP_B, k) if b != 0)
+            err = h_step * sum(e * ki for e, ki in zip(DP_E, k) if e != 0)
+
+            # RMS error norm, worst trajectory decides
+            scale = atol + rtol * torch.maximum(u.abs(), u_new.abs())
+            norm = float((err / scale).pow(2).mean(dim=1).sqrt().max())
+            if not np.isfinite(norm):
+                raise RuntimeError('dopri5: non-finite solution')
+            if norm <= 1.0:
+                tc, u, k1 = tc + h_step, u_new, k[6] # first same as last
+            factor = 0.9 * norm ** (-0.2) if norm > 0 else 10.0
+            h = h_step * min(10.0, max(0.2, factor))
+            if h < 1e-14 * max(1.0, abs(tc)):
+                raise RuntimeError('dopri5: step size too small')
+        out.append(u)
+    return torch.stack(out, dim=1)
+
+def STEAYDQRF_sim_batch(IC,
+                        t,
+                        eta_func,
+                        beta_func,
+                        tau_func,
+                        params,
+                        chi_type,
+                        masking=False,
+                        eta_all_comps=False,
+                        beta_all_comps=False,
+                        tau_all_comps=False,
+                        eta_degree=-1,
+                        beta_degree=-1,
+                        tau_degree=-1,
+                        method='dopri5',
+                        dtype=torch.float,
+                        device=None,
+                        **kwargs):
+    '''
+    Batched torch counterpart of PDESolver.STEAYDQRF_sim: integrates B initial
+    conditions and/or parameter sets at once with the learned components
+    evaluated on (B, k) batches. Per-trajectory parameter sets are passed as
+    one value per trajectory in params, or are closed over by the component
+    functions (e.g. a (B, n_coef) coefficient matrix of a regression model).
+
+    Args:
+        IC (array/tensor): initial conditions with shape (9,) or (B, 9).
+        t (array): output times.
+        eta_func (func): torch callable for the contact rate.
+        beta_func (func): torch callable for the tracing rate.
+        tau_func (func): torch callable for the q. diagnosis rate.
+        params (dict): parameters of the Covasim model.
+        chi_type (str): string indicating the type of function chi is.
+        method (str): 'dopri5' (adaptive) or 'rk4' (fixed steps).
+        dtype (torch.dtype): dtype of the states, must match the components.
+        device (torch.device): device of the states, must match the components.
+        kwargs (dict): passed on to dopri5 or rk4.
+
+    Returns:
+        u (tensor): simulated STEAYDQRF values with shape (B, len(t), 9).
+            Trajectories that failed to integrate are set to 1e6 as in
+            STEAYDQRF_sim.
+    '''
+    u0 = torch.as_tensor(IC, dtype=dtype, device=device)
+    u0 = u0[None, :] if u0.dim() == 1 else u0
+    t = np.asarray(t, dtype=float)
+    t_max = np.max(t)
+
+    def RHS_tu(t, u):
+        return STEAYDQRF_RHS_batch(t,
+                                   u,
+                                   eta_func,
+                                   beta_func,
+                                   tau_func,
+                                   params,
+                                   t_max,
+                                   chi_type,
+                                   masking,
+                                   eta_all_comps,
+                                   beta_all_comps,
+                                   tau_all_comps,
+                                   eta_degree,
+                                   beta_degree,
+                                   tau_degree)
+
+    integrator = {'dopri5': dopri5, 'rk4': rk4}[method]
+    with torch.no_grad():
+        try:
+            u = integrator(RHS_tu, u0, t, **kwargs)
+        except RuntimeError as e:
+            print("integration failed:", e)
+            return 1e6 * torch.ones(u0.shape[0], len(t), u0.shape[1], device=u0.device)
+
+    # flag individual trajectories that blew up
+    failed = ~torch.isfinite(u).all(dim=2).all(dim=1)
+    u[failed] = 1e6
+
+    return u
@@ -0,0 +1,224 @@
+import os
+import sqlite3
+import joblib
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['case_name', 'replicate', 'parameter', 'term', 'coef']
+
+# term names of the regression models of the Covasim BINNs, the first
+# coefficient of every per-replicate CSV is the intercept
+TERMS = {'eta': ['intercept', 'S', 'S^2', 'A', 'Y'],
+         'beta': ['intercept', 'S + A + Y', r'$\chi$'],
+         'tau': ['intercept', 'A', 'Y']}
+
+class CoefficientStore():
+
+    '''
+    Single-file store of the regression coefficients of a training campaign,
+    one row per (case_name, replicate, parameter, term). Backed by SQLite for
+    safe concurrent appends (a Parquet file, as used for simulation results,
+    would have to be rewritten by every writer), so any number of processes
+    (e.g. parallel lasso fits) can append to the same file: every write is
+    one transaction, concurrent writers wait for the lock (up to timeout
+    seconds), and writing a key again replaces its coefficient. Slices are
+    read with indexed queries of only the requested columns.
+
+    Args:
+        path      (str): database file, created if it does not exist.
+        timeout (float): seconds a writer waits for the lock of another one.
+    '''
+
+    def __init__(self, path, timeout=60.0):
+
+        self.path = path
+        self.timeout = timeout
+        with self.connect() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('''CREATE TABLE IF NOT EXISTS coefficients (
+                               case_name TEXT NOT NULL,
+                               replicate INTEGER NOT NULL,
+                               parameter TEXT NOT NULL,
+                               term TEXT NOT NULL,
+                               coef REAL,
+                               position INTEGER,
+                               PRIMARY KEY (case_name, parameter, replicate, term))''')
+            con.execute('''CREATE INDEX IF NOT EXISTS coefficients_term
+                           ON coefficients (case_name, parameter, term)''')
+        con.close()
+
+    def connect(self):
+
+        # a new connection per call, connections cannot be shared across processes
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def __getstate__(self):
+
+        return {'path': self.path, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+
+    def write(self, table):
+
+        '''
+        Appends (or replaces) the rows of a DataFrame with the columns
+        case_name, replicate, parameter, term and coef in one transaction.
+        The order of the terms within each (case_name, replicate, parameter)
+        is kept.
+        '''
+
+        table = pd.DataFrame(table)[COLUMNS]
+        position = table.groupby(['case_name', 'replicate', 'parameter']).cumcount()
+        rows = zip(table['case_name'].astype(str), table['replicate'].astype(int),
+                   table['parameter'].astype(str), table['term'].astype(str),
+                   table['coef'].astype(float), position.astype(int))
+        con = self.connect()
+        with con:
+            con.executemany('INSERT OR REPLACE INTO coefficients VALUES (?, ?, ?, ?, ?, ?)',
+                            [tuple(row) for row in rows])
+        con.close()
+
+    def append(self, case_name, replicate, parameter, terms, coefs):
+
+        '''
+        Appends the coefficients of one fitted model.
+        '''
+
+        coefs = np.asarray(coefs, dtype=float).reshape(-1)
+        if len(coefs) != len(terms):
+            raise ValueError('got {0} coefficients for {1} terms'.format(len(coefs), len(terms)))
+        self.write(pd.DataFrame({'case_name': case_name, 'replicate': replicate,
+                                 'parameter': parameter, 'term': list(terms), 'coef': coefs}))
+
+    def read(self, case_name=None, replicate=None, parameter=None, term=None, columns=COLUMNS):
+
+        '''
+        Reads the requested columns of the rows matching every given key
+        (a value or a list of values, None matches all) as a DataFrame,
+        sorted by case_name, parameter, replicate and term order.
+        '''
+
+        conditions, values = [], []
+        for name, value in [('case_name', case_name), ('replicate', replicate),
+                            ('parameter', parameter), ('term', term)]:
+            if value is None:
+                continue
+            value = list(value) if isinstance(value, (list, tuple, np.ndarray, pd.Index)) else [value]
+            if name == 'replicate':
+                value = [int(v) for v in value]
+            conditions.append('{0} IN ({1})'.format(name, ', '.join('?' * len(value))))
+            values += value
+        for column in columns:
+            if column not in COLUMNS:
+                raise ValueError('unknown column ' + str(column))
+        query = 'SELECT {0} FROM coefficients'.format(', '.join(columns))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY case_name, parameter, replicate, position'
+        con = self.connect()
+        table = pd.read_sql_query(query, con, params=values)
+        con.close()
+        return table
+
+    def wide(self, case_name, parameter, replicate=None):
+
+        '''
+        Coefficients of one parameter as a DataFrame with the terms as rows
+        and the replicates as columns (the layout of estimated_coefs).
+        '''
+
+        table = self.read(case_name=case_name, parameter=parameter, replicate=replicate,
+                          columns=['replicate', 'term', 'coef'])
+        terms = list(dict.fromkeys(table['term']))
+        table = table.pivot(index='term', columns='replicate', values='coef').loc[terms]
+        table.index.name, table.columns.name = None, None
+        return table
+
+    def coefficient_dict(self, case_name, parameters=('eta', 'beta', 'tau'), replicate=None):
+
+        '''
+        Dictionary of the wide coefficient tables of the given parameters.
+        '''
+
+        return {parameter: self.wide(case_name, parameter, replicate) for parameter in parameters}
+
+    def keys(self, column):
+
+        '''
+        Distinct values of a key column (case_name, replicate, parameter or term).
+        '''
+
+        if column not in COLUMNS[:4]:
+            raise ValueError('unknown key ' + str(column))
+        con = self.connect()
+        values = [row[0] for row in con.execute(
+            'SELECT DISTINCT {0} FROM coefficients ORDER BY {0}'.format(column))]
+        con.close()
+        return values
+
+def from_directory(store, mydir, case_name, replicates, terms=TERMS):
+
+    '''
+    Converts the per-replicate CSV layout of lasso_parameter_fitting,
+    mydir/case_name/<replicate>/<case_name>_regression_coef_<parameter>.csv,
+    into the store. Missing files are skipped.
+
+    Args:
+        store (CoefficientStore): store to write to.
+        mydir (str): model directory of the training campaign.
+        case_name (str): name of the case.
+        replicates (iterable): replicate indices, e.g. range(n_samples).
+        terms (dict): term names of the coefficients of each parameter.
+
+    Returns:
+        table (DataFrame): converted rows.
+    '''
+
+    tables = []
+    for replicate in replicates:
+        save_path = os.path.join(mydir, case_name, str(replicate))
+        for parameter, names in terms.items():
+            file_name = os.path.join(save_path, case_name + '_regression_coef_' + parameter + '.csv')
+            if not os.path.exists(file_name):
+                continue
+            coefs = pd.read_csv(file_name, index_col=[0]).to_numpy().reshape(-1)
+            tables.append(pd.DataFrame({'case_name': case_name, 'replicate': int(replicate),
+                                        'parameter': parameter, 'term': names[:len(coefs)],
+                                        'coef': coefs}))
+    table = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=COLUMNS)
+    store.write(table)
+    return table
+
+def from_table(store, file_name):
+
+    '''
+    Converts a long coefficient table (CSV with the columns case_name,
+    replicate, parameter, term and coef, as written by fit_replicates).
+    '''
+
+    table = pd.read_csv(file_name)
+    store.write(table)
+    return table
+
+def from_joblib(store, file_name, case_name, terms=TERMS):
+
+    '''
+    Converts a dictionary of wide coefficient tables (terms as rows,
+    replicates as columns) dumped with joblib, e.g. estimated_coefs.joblib.
+    '''
+
+    tables = []
+    for parameter, wide in joblib.load(file_name).items():
+        wide = pd.DataFrame(wide)
+        names = terms[parameter] if parameter in terms else list(wide.index)
+        for column, replicate in enumerate(wide.columns):
+            coefs = wide.iloc[:, column].to_numpy()
+            replicate = replicate if isinstance(replicate, (int, np.integer)) else column
+            tables.append(pd.DataFrame({'case_name': case_name, 'replicate': int(replicate),
+                                        'parameter': parameter, 'term': names[:len(coefs)],
+                                        'coef': coefs}))
+    table = pd.concat(tables, ignore_index=True)
+    store.write(table)
+    return table
@@ -0,0 +1,125 @@
+import torch
+import numpy as np
+
+class CollocationSampler():
+
+    '''
+    Residual-adaptive (RAR) sampler of collocation points for the PDE loss of a
+    BINN. Collocation points are continuous time points in [t_min, t_max], so
+    the PDE residual is also enforced between the observed (integer) days.
+    Every resample_every epochs a large pool of uniform candidates is scored
+    with the model's pointwise PDE residual and the collocation points are
+    redrawn with probability proportional to residual**power, keeping a
+    fraction of uniformly drawn points so no region is starved.
+
+    The sampler is also a ModelWrapper callback: pass it to ModelWrapper.fit
+    via collocation=sampler (or in callbacks after setting model.collocation).
+
+    Args:
+        n_points         (int): Budget of collocation points per batch.
+        t_min          (float): Lower bound of the scaled time domain.
+        t_max          (float): Upper bound of the scaled time domain.
+        n_candidates     (int): Number of candidates scored when resampling.
+        resample_every   (int): Epochs between resampling.
+        uniform_frac   (float): Fraction of points drawn uniformly each time.
+        power          (float): Exponent on the residual for the sampling
+                                 probabilities (0 is uniform sampling).
+        device  (torch.device): Device of the collocation points.
+
+    Inputs:
+        wrapper (ModelWrapper): Model wrapper whose model is used to score
+                                 candidates when called as a callback.
+    '''
+
+    def __init__(self,
+                 n_points=256,
+                 t_min=0.0,
+                 t_max=1.0,
+                 n_candidates=4096,
+                 resample_every=100,
+                 uniform_frac=0.2,
+                 power=1.0,
+                 device=None):
+
+        self.n_points = n_points
+        self.t_min = t_min
+        self.t_max = t_max
+        self.n_candidates = n_candidates
+        self.resample_every = resample_every
+        self.uniform_frac = uniform_frac
+        self.power = power
+        self.device = device
+        self.epoch = 0
+
+        # callback flags, see ModelWrapper.fit
+        self.on_train_begin = False
+        self.on_epoch_begin = True
+        self.on_batch_begin = False
+        self.on_batch_end = False
+        self.on_epoch_end = False
+        self.on_train_end = False
+
+        # start from uniformly distributed points
+        self.points = self.uniform(n_points)
+
+    def uniform(self, n):
+
+        '''
+        Draws n time points uniformly from [t_min, t_max] with shape (n, 1).
+        '''
+
+        points = torch.rand(n, 1, device=self.device)
+
+        return self.t_min + (self.t_max - self.t_min) * points
+
+    def sample(self):
+
+        '''
+        Returns the current collocation points as a fresh leaf tensor that
+        requires gradients, so time derivatives can be taken with respect to it.
+        '''
+
+        return self.points.clone().requires_grad_(True)
+
+    def resample(self, model):
+
+        '''
+        Redraws the collocation points in proportion to the pointwise PDE
+        residual of the model at a pool of uniform candidates.
+        '''
+
+        # draw new points on the same device as the model
+        self.device = next(model.parameters()).device
+
+        # pointwise residuals at uniform candidates (gradients w.r.t. time are
+        # needed for the residual, but the graph is discarded right away)
+        candidates = self.uniform(self.n_candidates).requires_grad_(True)
+        with torch.enable_grad():
+            outputs = model.surface_fitter(candidates)
+            residuals = model.pde_loss(candidates, outputs, return_mean=False)
+        residuals = residuals.detach().flatten().abs()
+
+        # sampling probabilities proportional to residual**power
+        weights = residuals ** self.power
+        if not torch.isfinite(weights).all() or weights.sum() <= 0:
+            weights = torch.ones_like(weights)
+        n_uniform = int(np.round(self.uniform_frac * self.n_points))
+        inds = torch.multinomial(weights, self.n_points - n_uniform, replacement=True)
+
+        # adaptive points plus uniform points
+        self.points = torch.cat([candidates.detach()[inds],
+                                 self.uniform(n_uniform)], dim=0)
+        self.residuals = residuals
+
+        return self.points
+
+    def __call__(self, wrapper):
+
+        '''
+        Resamples every resample_every epochs (skipping the first epoch, where
+        the untrained residuals carry no information).
+        '''
+
+        if self.epoch > 0 and self.epoch % self.resample_every == 0:
+            self.resample(wrapper.model)
+        self.epoch += 1
@@ -1,9 +1,69 @@
+import copy
 import numpy as np
-from sklearn.linear_model import LassoCV
-from sklearn.preprocessing import PolynomialFeatures
+from joblib import Parallel, delayed
+from sklearn.linear_model import LassoCV, Lasso, lasso_path
+from sklearn.model_selection import check_cv
+from Modules.Models.PolynomialLayer import polynomial_layer
 from sklearn.metrics import mean_squared_error
 
 
+def design_matrix(
+    input_dict      : dict[str, np.ndarray],
+    degree          : int = 2,
+) -> tuple[np.ndarray, np.ndarray]:
+
+    '''
+        Purpose --> Build the polynomial design matrix of the RHS terms once, so that it can be shared
+        by all fits on the same inputs.
+
+        Return --> The design matrix X_poly (all combinations up to degree, without bias) and the
+        feature names, e.g. 'S^2 A'.
+
+        Parameters:
+            input_dict {Dictionary} : The keys are the string, variable symbol or terms used in the
+            RHS, and the values are the ndarray of the possible values in the domain.
+
+            degree {int} : The max power of the RHS.
+    '''
+
+    # Set up the input terms, data_x for input into Lasso
+    input_terms = []
+    data_x = None
+    for var_name, np_vals in input_dict.items():
+        input_terms.append(var_name)
+        if data_x is None:
+            data_x = np_vals[:, None]
+        else:
+            data_x = np.hstack([data_x, np_vals[:, None]])
+
+    # Do all the combinations up to degree of the input variables
+    poly = polynomial_layer(data_x.shape[1], degree=degree, include_bias=False)
+    X_poly = poly.transform(data_x)
+    feature_names = poly.get_feature_names_out(input_features=input_terms)
+
+    return X_poly, feature_names
+
+
+def format_equation(
+    coefs           : np.ndarray,
+    intercept       : float,
+    feature_names   : np.ndarray,
+) -> str:
+
+    '''
+        Purpose --> Format a fitted curve as a string equation, keeping the terms whose coefficient is
+        larger than 1e-6 in absolute value.
+    '''
+
+    equation = "f = "
+    for coef, name in zip(coefs, feature_names):
+        if abs(coef) > 1e-6:
+            equation += f"{coef:.5f}*{name} + "
+    equation = equation[:-3] + f' + {intercept:.5f}'
+
+    return equation
+
+
 def DRUMS_Lasso(
     input_dict      : dict[str, np.ndarray],
     lhs_values      : np.ndarray,
@@ -42,35 +102,17 @@ def DRUMS_Lasso(
             cv {int} : The cross validation splitting strategy. Default, cv = 5.
     '''
 
-    # Set up the input terms, data_x for input into Lasso
-    input_terms = []
-    data_x = None
-    for var_name, np_vals in input_dict.items():
-        input_terms.append(var_name)
-        if data_x is None:
-            data_x = np_vals[:, None]
-        else:
-            data_x = np.hstack([data_x, np_vals[:, None]])
-    
     # Do all the combinations up to degree of the input variables
-    poly = PolynomialFeatures(degree=degree, include_bias=False)
-    X_poly = poly.fit_transform(data_x)
+    X_poly, feature_names = design_matrix(input_dict, degree)
     
     # Create a Lasso object and fit the data
     lasso = LassoCV(fit_intercept=intercept, cv=cv, alphas=alphas)
     lasso.fit(X_poly, lhs_values)
 
-    # Get the coefficients and feature names
+    # Get the coefficients and print the equation
     coefs = lasso.coef_
     intercept = lasso.intercept_
-    feature_names = poly.get_feature_names_out(input_features=input_terms)
-
-    # Print the equation
-    equation = "f = "
-    for coef, name in zip(coefs, feature_names):
-        if abs(coef) > 1e-6:
-            equation += f"{coef:.5f}*{name} + "
-    equation = equation[:-3] + f' + {intercept:.5f}'
+    equation = format_equation(coefs, intercept, feature_names)
     
     # Make predictions on the training data
     y_pred = lasso.predict(X_poly)
@@ -88,6 +130,203 @@ def DRUMS_Lasso(
     return output_dict
 
 
+def fold_mse(X, Y, train, test, alphas, intercept, max_iter, tol):
+
+    '''
+        Purpose --> Held-out MSE of the lasso paths of all targets on one CV fold. The fold is centered
+        and its Gram matrix is computed once for all targets, then each target is solved along the
+        warm-started path exactly as in LassoCV.
+
+        Return --> Array of MSEs with shape (n_targets, n_alphas).
+    '''
+
+    X_train, Y_train = X[train], Y[train]
+    X_test, Y_test = X[test], Y[test]
+    if intercept:
+        X_offset = np.average(X_train, axis=0)
+        Y_offset = np.average(Y_train, axis=0)
+        X_train = X_train - X_offset
+        Y_train = Y_train - Y_offset
+    else:
+        X_offset = np.zeros(X.shape[1])
+        Y_offset = np.zeros(Y.shape[1])
+    X_train = np.asfortranarray(X_train)
+
+    # precompute='auto' of LassoCV
+    gram = None
+    if X_train.shape[0] > X_train.shape[1]:
+        gram = np.empty((X_train.shape[1], X_train.shape[1]), order='C')
+        np.dot(X_train.T, X_train, out=gram)
+
+    mse = np.empty((Y.shape[1], len(alphas)))
+    for k in range(Y.shape[1]):
+        y_k = np.ascontiguousarray(Y_train[:, k])
+        Xy = np.dot(X_train.T, y_k) if gram is not None else None
+        _, coefs, _ = lasso_path(X_train, y_k, alphas=alphas, precompute=gram if gram is not None else False,
+                                 Xy=Xy, copy_X=False, max_iter=max_iter, tol=tol, check_input=False)
+        residues = np.dot(X_test, coefs) - Y_test[:, k][:, None]
+        residues += Y_offset[k] - np.dot(X_offset, coefs)
+        mse[k] = (residues ** 2).mean(axis=0)
+
+    return mse
+
+
+def DRUMS_Lasso_batch(
+    input_dict      : dict[str, np.ndarray],
+    lhs_values      : np.ndarray,
+    degree          : int = 2,
+    alphas          : np.ndarray = np.array([0.0]),
+    intercept       : bool = True,
+    cv              : int = 5,
+    n_jobs          : int = 1,
+    max_iter        : int = 1000,
+    tol             : float = 1e-4,
+) -> list:
+
+    '''
+        Purpose --> DRUMS_Lasso for many LHS vectors on the same RHS values (e.g. the eta surfaces of
+        all replicate models). The design matrix is built once, every CV fold is centered and its Gram
+        matrix computed once for all targets, and the fold paths (warm-started coordinate descent
+        along the sorted alphas, as in LassoCV) run in joblib processes. The selected alpha is refit
+        on all data as in LassoCV, so coefficients and equations are identical to DRUMS_Lasso.
+
+        Return --> A list with one dictionary per target with the keys of DRUMS_Lasso, except that
+        "Lasso" is the refit Lasso object, plus "alpha" : the CV estimate of alpha, "alphas" : the
+        sorted alphas and "mse_path" : the held-out MSE per alpha and fold.
+
+        Parameters:
+            input_dict {Dictionary} : The keys are the string, variable symbol or terms used in the
+            RHS, and the values are the ndarray of the possible values in the domain.
+
+            lhs_values {numpy.ndarray} : LHS values with shape (n_samples,) or
+            (n_samples, n_targets).
+
+            degree, alphas, intercept, cv : As in DRUMS_Lasso.
+
+            n_jobs {int} : The number of processes for the CV folds. Default, n_jobs = 1.
+
+            max_iter, tol {int, float} : Coordinate descent settings (LassoCV defaults).
+    '''
+
+    X_poly, feature_names = design_matrix(input_dict, degree)
+    Y = np.asarray(lhs_values, dtype=float)
+    Y = Y[:, None] if Y.ndim == 1 else Y
+    alphas = np.sort(np.asarray(alphas, dtype=float))[::-1]
+
+    # held-out MSE of every target, alpha and fold
+    folds = list(check_cv(cv).split(X_poly, Y[:, 0]))
+    mse_paths = Parallel(n_jobs=n_jobs)(
+        delayed(fold_mse)(X_poly, Y, train, test, alphas, intercept, max_iter, tol)
+        for train, test in folds)
+    mse_paths = np.stack(mse_paths, axis=-1)
+
+    output = []
+    for k in range(Y.shape[1]):
+        best_alpha = alphas[np.argmin(mse_paths[k].mean(axis=-1))]
+
+        # refit with the selected alpha as in LassoCV
+        lasso = Lasso(alpha=best_alpha, fit_intercept=intercept, max_iter=max_iter, tol=tol, precompute=False)
+        lasso.fit(X_poly, Y[:, k])
+
+        output.append({
+            'Lasso' : lasso,
+            'Equation' : format_equation(lasso.coef_, lasso.intercept_, feature_names),
+            'MSE' : mean_squared_error(Y[:, k], lasso.predict(X_poly)),
+            'degree' : degree,
+            'alpha' : best_alpha,
+            'alphas' : alphas,
+            'mse_path' : mse_paths[k]
+        })
+
+    return output
+
+
+def fit_alphas(X, y, alphas, intercept, warm_start, max_iter, tol):
+
+    '''
+        Purpose --> Fit one Lasso per alpha on all data, optionally warm-started from the previous
+        (larger) alpha.
+
+        Return --> A list of fitted Lasso objects in the order of alphas.
+    '''
+
+    order = np.argsort(alphas)[::-1]
+    lasso = Lasso(fit_intercept=intercept, max_iter=max_iter, tol=tol, precompute=False,
+                  warm_start=warm_start)
+    fits = [None] * len(alphas)
+    for i in order:
+        lasso.set_params(alpha=alphas[i])
+        lasso.fit(X, y)
+        fits[i] = copy.deepcopy(lasso)
+
+    return fits
+
+
+def DRUMS_Lasso_path(
+    input_dict      : dict[str, np.ndarray],
+    lhs_values      : np.ndarray,
+    degree          : int = 2,
+    alphas          : np.ndarray = np.array([0.0]),
+    intercept       : bool = True,
+    warm_start      : bool = False,
+    n_jobs          : int = 1,
+    max_iter        : int = 1000,
+    tol             : float = 1e-4,
+) -> list:
+
+    '''
+        Purpose --> The result of DRUMS_Lasso(..., alphas=np.array([alpha])) for every alpha in alphas,
+        i.e. the alpha sweeps in AdaMaskParameterRegression. With a single alpha the CV of LassoCV
+        cannot select anything, so it is skipped: the design matrix is built once and one Lasso is fit
+        on all data per alpha (processes over targets). With warm_start = False the coefficients and
+        equations are identical to DRUMS_Lasso; warm_start = True starts each fit from the solution at
+        the next larger alpha, which is faster but only agrees with DRUMS_Lasso where the fits
+        converge within max_iter.
+
+        Return --> A list with one dictionary per alpha with the keys of DRUMS_Lasso ("Lasso" is the
+        Lasso object) plus "alpha", or a list of such lists (one per target) if lhs_values is 2D.
+
+        Parameters:
+            input_dict {Dictionary} : The keys are the string, variable symbol or terms used in the
+            RHS, and the values are the ndarray of the possible values in the domain.
+
+            lhs_values {numpy.ndarray} : LHS values with shape (n_samples,) or
+            (n_samples, n_targets).
+
+            degree, intercept : As in DRUMS_Lasso.
+
+            alphas {numpy.ndarray} : The alphas to fit, one equation each.
+
+            warm_start {bool} : Whether to warm start along the alphas. Default, warm_start = False.
+
+            n_jobs {int} : The number of processes for the targets. Default, n_jobs = 1.
+
+            max_iter, tol {int, float} : Coordinate descent settings (LassoCV defaults).
+    '''
+
+    X_poly, feature_names = design_matrix(input_dict, degree)
+    Y = np.asarray(lhs_values, dtype=float)
+    single = Y.ndim == 1
+    Y = Y[:, None] if single else Y
+    alphas = np.asarray(alphas, dtype=float)
+
+    fits = Parallel(n_jobs=n_jobs)(
+        delayed(fit_alphas)(X_poly, Y[:, k], alphas, intercept, warm_start, max_iter, tol)
+        for k in range(Y.shape[1]))
+
+    output = []
+    for k, target_fits in enumerate(fits):
+        output.append([{
+            'Lasso' : lasso,
+            'Equation' : format_equation(lasso.coef_, lasso.intercept_, feature_names),
+            'MSE' : mean_squared_error(Y[:, k], lasso.predict(X_poly)),
+            'degree' : degree,
+            'alpha' : alpha
+        } for alpha, lasso in zip(alphas, target_fits)])
+
+    return output[0] if single else output
+
+
 '''
 
 # This is an example of DRUMS_LASSO
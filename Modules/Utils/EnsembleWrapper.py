@@ -0,0 +1,348 @@
+import os.path
+
+import torch, time, sys, pdb
+import numpy as np
+
+from Modules.Utils.TimeRemaining import *
+from Modules.Models.BuildEnsemble import member_state_dict, load_member_state_dict
+
+def to_numpy(x):
+    return x.detach().cpu().numpy()
+
+class MemberReduceLROnPlateau():
+
+    '''
+    ReduceLROnPlateau (mode 'min', relative threshold) kept separately for
+    every member of an ensemble, so each member follows the learning rate
+    schedule it would get when trained alone with
+    torch.optim.lr_scheduler.ReduceLROnPlateau. The optimizer learning rate
+    is left unchanged; EnsembleWrapper scales each member's update by its
+    learning rate relative to the optimizer's (exact for SGD and Adam, whose
+    steps are proportional to the learning rate).
+
+    Args:
+        optimizer (callable): Optimizer over the ensemble parameters.
+        n_members      (int): Number of members.
+        factor       (float): Factor of a learning rate reduction.
+        patience       (int): Number of steps without improvement before
+                              the learning rate is reduced.
+        threshold    (float): Relative improvement that counts.
+        cooldown       (int): Number of steps after a reduction before
+                              counting steps without improvement again.
+        min_lr       (float): Lower bound of the learning rates.
+        eps          (float): Minimal change of a learning rate.
+    '''
+
+    def __init__(self, optimizer, n_members, factor=0.1, patience=10,
+                 threshold=1e-4, cooldown=0, min_lr=0, eps=1e-8):
+
+        self.base_lr = optimizer.param_groups[0]['lr']
+        self.lr = np.full(n_members, float(self.base_lr))
+        self.factor = factor
+        self.patience = patience
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.min_lr = min_lr
+        self.eps = eps
+        self.best = np.full(n_members, np.inf)
+        self.num_bad_steps = np.zeros(n_members, dtype=int)
+        self.cooldown_counter = np.zeros(n_members, dtype=int)
+
+    @property
+    def scales(self):
+
+        return self.lr / self.base_lr
+
+    def step(self, losses):
+
+        losses = np.asarray(losses, dtype=float)
+        better = losses < self.best * (1 - self.threshold)
+        self.best[better] = losses[better]
+        self.num_bad_steps = np.where(better, 0, self.num_bad_steps + 1)
+        in_cooldown = self.cooldown_counter > 0
+        self.cooldown_counter[in_cooldown] -= 1
+        self.num_bad_steps[in_cooldown] = 0
+
+        reduce = self.num_bad_steps > self.patience
+        new_lr = np.maximum(self.lr * self.factor, self.min_lr)
+        self.lr = np.where(reduce & (self.lr - new_lr > self.eps), new_lr, self.lr)
+        self.cooldown_counter[reduce] = self.cooldown
+        self.num_bad_steps[reduce] = 0
+
+
+class EnsembleWrapper():
+
+    '''
+    Trains an ensemble from BuildEnsemble, i.e. K independent models (e.g.
+    one BINN per Covasim replicate) stacked into one model, in lockstep. Each
+    step evaluates all members in one vmapped pass and backpropagates the sum
+    of the per-member losses, which gives every member its own gradients.
+    Best-model tracking, early stopping and checkpoints are kept per member,
+    and checkpoints are saved with the same names as ModelWrapper, so each
+    member can be loaded into a single model with ModelWrapper.load. Stopped
+    members are frozen: their updates are undone after every optimizer step,
+    so optimizer momentum does not move their weights.
+
+    Args:
+        model        (callable): Ensemble model (see BuildEnsemble).
+        optimizer    (callable): Optimizer over the ensemble parameters.
+        loss         (callable): Loss function that inputs (pred, true) and
+                                  returns one loss per member.
+        scheduler    (callable): Learning rate scheduler. A
+                                  MemberReduceLROnPlateau is stepped on the
+                                  member losses, any other scheduler on
+                                  their sum.
+        save_names       (list): Model name per member for saving weights.
+        save_best_train  (bool): Indicator for saving on best train loss.
+        save_best_val    (bool): Indicator for saving on best val loss.
+
+    Inputs:
+        x                 (tensor): Inputs with shape (K, N, ...).
+        y                 (tensor): Targets with shape (K, N, ...).
+        batch_size           (int): Batch size per member.
+        epochs               (int): Total number of epochs.
+        verbose              (int): How much info to print to the screen:
+                                        0: No updates
+                                        1: Update after every epoch
+        validation_data     (list): Input and target validation data with
+                                     shapes (K, N_val, ...).
+        shuffle             (bool): Whether to shuffle data each epoch.
+        early_stopping       (int): Number of epochs since validation improved
+                                     before a member is stopped.
+        rel_save_thresh    (float): Rel. diff. btwn losses before saving.
+
+    Returns:
+        train_loss_list (list): Training errors per epoch, shape (K,) each.
+        val_loss_list   (list): Validation errors per epoch, shape (K,) each.
+    '''
+
+    def __init__(self,
+                 model,
+                 optimizer,
+                 loss,
+                 scheduler=None,
+                 save_names=None,
+                 save_best_train=False,
+                 save_best_val=True):
+
+        self.model = model
+        self.optimizer = optimizer
+        self.loss = loss
+        self.scheduler = scheduler
+        self.save_names = save_names
+        self.save_best_train = save_best_train
+        self.save_best_val = save_best_val
+        self.n_members = model.n_members
+        self.train_loss_list = []
+        self.val_loss_list = []
+
+        # if no names specified, don't save weights
+        if self.save_names is None:
+            self.save_best_train = False
+            self.save_best_val = False
+
+    def fit(self,
+            x,
+            y,
+            batch_size=None,
+            epochs=1,
+            verbose=1,
+            validation_data=None,
+            shuffle=True,
+            early_stopping=None,
+            rel_save_thresh=0.0):
+
+        K, N = x.shape[0], x.shape[1]
+
+        # compute batch sizes
+        if batch_size is None or batch_size > N:
+            batch_size = N
+        train_batches_per_epoch = max(int(N / batch_size), 1)
+
+        # initialize book keeping per member
+        start_time = time.time()
+        best_train_loss = np.full(K, 1e12)
+        best_val_loss = np.full(K, 1e12)
+        last_improved = np.zeros(K, dtype=int)
+        active = np.ones(K, dtype=bool)
+        self.active = active
+
+        # loop over epochs
+        for epoch in range(epochs):
+
+            #
+            # training step
+            #
+
+            self.model.train()
+            train_losses = []
+            epoch_start_time = time.time()
+
+            # shuffle each member's training data independently
+            if shuffle:
+                p = torch.argsort(torch.rand(K, N, device=x.device), dim=1)
+                x = torch.take_along_dim(x, p.view(K, N, *[1]*(x.dim()-2)), dim=1).data
+                y = torch.take_along_dim(y, p.view(K, N, *[1]*(y.dim()-2)), dim=1).data
+
+            # stopped members no longer receive gradients
+            mask = torch.tensor(active, dtype=torch.float, device=x.device)
+
+            # loop over training batches
+            for idx in range(train_batches_per_epoch):
+
+                # extract batches, flattened over members
+                start = idx * batch_size
+                stop = (idx+1) * batch_size if idx+1 < train_batches_per_epoch else N
+                x_true = x[:, start:stop].reshape(-1, *x.shape[2:]).data.clone()
+                y_true = y[:, start:stop].reshape(-1, *y.shape[2:]).data.clone()
+                x_true.requires_grad = True
+
+                # per-member losses, their sum gives per-member gradients
+                self.optimizer.zero_grad()
+                y_pred = self.model(x_true)
+                losses = self.loss(y_pred, y_true)
+                total = (losses * mask).sum()
+                total.backward()
+                self.step(active)
+                if isinstance(self.scheduler, MemberReduceLROnPlateau):
+                    self.scheduler.step(to_numpy(losses))
+                elif self.scheduler is not None:
+                    self.scheduler.step(total.detach())
+
+                train_losses.append(to_numpy(losses))
+
+            # update book keeping for this epoch
+            self.train_loss_list.append(np.mean(train_losses, axis=0))
+
+            # if train error improved
+            rel_diff = (best_train_loss - self.train_loss_list[-1]) / best_train_loss
+            improved = active & (rel_diff > rel_save_thresh)
+            best_train_loss[improved] = self.train_loss_list[-1][improved]
+            if self.save_best_train:
+                for k in np.where(improved)[0]:
+                    self.save(k, self.save_names[k]+'_best_train')
+
+            #
+            # validation step
+            #
+
+            if validation_data is not None:
+
+                self.model.eval()
+                x_val, y_val = validation_data[0], validation_data[1]
+                x_true = x_val.reshape(-1, *x_val.shape[2:]).data.clone()
+                y_true = y_val.reshape(-1, *y_val.shape[2:]).data.clone()
+                x_true.requires_grad = True
+
+                # gradients w.r.t. time are needed for the pde loss
+                y_pred = self.model(x_true)
+                self.val_loss_list.append(to_numpy(self.loss(y_pred, y_true)))
+
+                # if validation error improved
+                rel_diff = (best_val_loss - self.val_loss_list[-1]) / best_val_loss
+                improved = active & (rel_diff > rel_save_thresh)
+                best_val_loss[improved] = self.val_loss_list[-1][improved]
+                last_improved[improved] = epoch
+                if self.save_best_val:
+                    for k in np.where(improved)[0]:
+                        self.save(k, self.save_names[k]+'_best_val')
+
+            # update user
+            if verbose == 1:
+                elapsed, remaining, ms = TimeRemaining(
+                    current_iter=epoch+1,
+                    total_iter=epochs,
+                    start_time=start_time,
+                    previous_time=epoch_start_time,
+                    ops_per_iter=batch_size*K)
+                p = '\rEpoch {0}'.format(epoch)
+                p += ' | Active = {0}/{1}'.format(active.sum(), K)
+                p += ' | Train loss = {0:1.4e}'.format(np.mean(self.train_loss_list[-1][active]))
+                if validation_data is not None:
+                    p += ' | Val loss = {0:1.4e}'.format(np.mean(self.val_loss_list[-1][active]))
+                p += ' | Remaining = ' + remaining + '           '
+                sys.stdout.write(p)
+
+            # optional early stopping per member
+            if early_stopping is not None:
+                active &= (epoch - last_improved < early_stopping)
+                if not active.any():
+                    break
+
+        # final print readout
+        if verbose == 1:
+            elapsed, remaining, ms = TimeRemaining(
+                current_iter=epoch+1,
+                total_iter=epochs,
+                start_time=start_time,
+                previous_time=epoch_start_time,
+                ops_per_iter=batch_size*K)
+            p = '\rEpoch {0}'.format(epoch)
+            p += ' | Best train loss = {0:1.4e}'.format(np.mean(best_train_loss))
+            if validation_data is not None:
+                p += ' | Best val loss = {0:1.4e}'.format(np.mean(best_val_loss))
+            p += ' | Elapsed = ' + elapsed + '           '
+            sys.stdout.write(p)
+            print()
+
+    def step(self, active):
+
+        '''
+        Optimizer step with the update of every member scaled by its
+        learning rate factor (see MemberReduceLROnPlateau), or by zero for
+        stopped members.
+        '''
+
+        scales = active.astype(float)
+        if isinstance(self.scheduler, MemberReduceLROnPlateau):
+            scales = scales * self.scheduler.scales
+        if np.all(scales == 1):
+            self.optimizer.step()
+            return
+
+        weights = [w for name in self.model.children_stacked
+                   for w in getattr(self.model, name).weights]
+        previous = [w.detach().clone() for w in weights]
+        self.optimizer.step()
+        with torch.no_grad():
+            for w, w0 in zip(weights, previous):
+                scale = torch.as_tensor(scales, dtype=w.dtype, device=w.device)
+                w.copy_(w0 + scale.view(-1, *[1]*(w.dim()-1)) * (w - w0))
+
+    def member_losses(self, k):
+
+        '''
+        Returns the training and validation loss curves of member k.
+        '''
+
+        train = [l[k] for l in self.train_loss_list]
+        val = [l[k] for l in self.val_loss_list]
+
+        return train, val
+
+    def save(self, k, save_name):
+
+        '''
+        Saves the weights of member k with the naming of ModelWrapper.save.
+        '''
+
+        torch.save(member_state_dict(self.model, k), save_name+'_model')
+
+    def load(self, k, model_weights, device=None):
+
+        '''
+        Loads single model weights into member k.
+        '''
+
+        weights = torch.load(model_weights, map_location=device)
+        load_member_state_dict(self.model, k, weights)
+        self.model.eval()
+
+    def load_best_val(self, device=None):
+
+        '''
+        Loads the weights that yielded the best validation error per member.
+        '''
+
+        for k in range(self.n_members):
+            self.load(k, self.save_names[k]+'_best_val_model', device=device)
@@ -0,0 +1,406 @@
+import warnings
+import numpy as np
+
+from Modules.Models.PolynomialLayer import polynomial_layer
+
+try:
+    import numba
+    njit = numba.njit
+    prange = numba.prange
+except ImportError: # fall back to (slow) pure Python kernels
+    numba = None
+    prange = range
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# chi_func in PDESolver uses a fixed upper bound on the tracing efficiency
+EFF_UB = 0.3
+
+# order of the Covasim parameters in the packed parameter vector
+PARAM_NAMES = ['alpha', 'gamma', 'mu', 'lamda', 'p_asymp', 'n_contacts', 'delta',
+               'yita_lb', 'yita_ub', 'tau_lb', 'tau_ub']
+
+# input names of DRUMS_Lasso and the state expressions they refer to
+STATE_NAMES = list('STEAYDQRF')
+INPUT_EXPRESSIONS = dict({n: n for n in STATE_NAMES}, s='(S + A + Y)', x='chi', M='M')
+
+@njit(cache=True)
+def chi_linear(t):
+    rate = EFF_UB / 75
+    if t < 75:
+        return rate * (t + 1)
+    elif t < 150:
+        return EFF_UB - rate * (t - 75 + 1)
+    return 0.0
+
+@njit(cache=True)
+def chi_sin(t):
+    return 0.3 * (1 + np.sin(t * np.pi / 40.)) / 2
+
+@njit(cache=True)
+def bump(x):
+    # Beta(3, 3) pdf scaled to a maximum of one
+    if 0 <= x <= 1:
+        return 16 * x ** 2 * (1 - x) ** 2
+    return 0.0
+
+@njit(cache=True)
+def chi_piecewise(t):
+    t_max = 159
+    if t < 80:
+        return bump(t / t_max) * EFF_UB
+    elif t >= 120:
+        return bump((t - 40) / t_max) * EFF_UB
+    return EFF_UB
+
+@njit(cache=True)
+def chi_constant(t):
+    return EFF_UB
+
+CHI_FUNCS = {'linear': chi_linear,
+             'sin': chi_sin,
+             'piecewise': chi_piecewise,
+             'constant': chi_constant}
+
+def parse_term(name, input_terms):
+    '''
+    Parses a feature name of PolynomialFeatures/PolynomialLayer (e.g. 'S^2 A',
+    '1' for the bias) into a list of (input name, power) pairs.
+
+    Args:
+        name (str): feature name.
+        input_terms (list): input names used to build the feature names.
+
+    Returns:
+        term (list): (input name, power) pairs, empty for the bias.
+    '''
+    term = []
+    if name.strip() == '1':
+        return term
+    for factor in name.split(' '):
+        base, _, power = factor.partition('^')
+        if base not in input_terms:
+            raise ValueError('unknown input {0} in term {1}'.format(base, name))
+        term.append((base, int(power) if power else 1))
+    return term
+
+def lasso_terms(lasso_dict, input_terms, tol=1e-6):
+    '''
+    Extracts the nonzero terms and coefficients of a DRUMS_Lasso fit, with the
+    intercept as the bias term '1' (as in the printed equation).
+
+    Args:
+        lasso_dict (dict): output of DRUMS_Lasso.
+        input_terms (list): keys of the input_dict passed to DRUMS_Lasso.
+        tol (float): coefficients with absolute value below tol are dropped.
+
+    Returns:
+        terms (list): feature names of the nonzero terms.
+        coefs (array): coefficients of the terms.
+    '''
+    lasso = lasso_dict['Lasso']
+    poly = polynomial_layer(len(input_terms), degree=lasso_dict['degree'], include_bias=False)
+    names = poly.get_feature_names_out(input_features=input_terms)
+    terms, coefs = ['1'], [lasso.intercept_]
+    for coef, name in zip(lasso.coef_, names):
+        if abs(coef) > tol:
+            terms.append(name)
+            coefs.append(coef)
+    return terms, np.array(coefs, dtype=float)
+
+def polynomial_source(terms, input_terms, offset):
+    '''
+    Python source of a polynomial whose coefficients are read from the
+    coefficient vector c, starting at index offset.
+    '''
+    products = []
+    for i, name in enumerate(terms):
+        factors = ['c[{0}]'.format(offset + i)]
+        for base, power in parse_term(name, input_terms):
+            expr = INPUT_EXPRESSIONS[base]
+            factors.append(expr if power == 1 else '{0} ** {1}'.format(expr, power))
+        products.append(' * '.join(factors))
+    return ' + '.join(products) if products else '0.0'
+
+def pack_params(params):
+    '''
+    Packs the Covasim parameters used by the compiled RHS into a float vector.
+    '''
+    return np.array([params[k] for k in PARAM_NAMES], dtype=float)
+
+RHS_TEMPLATE = '''
+def rhs(t, u, c, p, mask, t_max):
+    S, T, E, A, Y, D, Q, R, F = u[0], u[1], u[2], u[3], u[4], u[5], u[6], u[7], u[8]
+    alpha, gamma, mu, lamda, p_asymp, n_contacts, delta = p[0], p[1], p[2], p[3], p[4], p[5], p[6]
+    chi = chi_func(t)
+    i_mask = int(t * t_max)
+    M = mask[i_mask] if i_mask < len(mask) else mask[len(mask) - 1]
+    yita = p[7] + (p[8] - p[7]) * ({eta})
+    beta = chi * ({beta})
+    tau = p[9] + (p[10] - p[9]) * ({tau})
+    new_d = mu * Y + tau * Q
+    contacts = beta * new_d * n_contacts
+    du = np.empty(9)
+    du[0] = - yita * S * (A + Y) - contacts * S + alpha * T
+    du[1] = contacts * S - alpha * T
+    du[2] = yita * S * (A + Y) - gamma * E
+    du[3] = p_asymp * gamma * E - lamda * A - contacts * A
+    du[4] = (1 - p_asymp) * gamma * E - (mu + lamda + delta) * Y - contacts * Y
+    du[5] = mu * Y + tau * Q - lamda * D - delta * D
+    du[6] = contacts * (A + Y) - (tau + delta) * Q
+    du[7] = lamda * (A + Y + D)
+    du[8] = delta * (Y + D + Q)
+    return du
+'''
+
+class CompiledEquations():
+
+    '''
+    Compiles sparse polynomial forms of eta, beta and tau (e.g. discovered with
+    DRUMS_Lasso) into a jitted STEAYDQRF right hand side with the semantics of
+    PDESolver.STEAYDQRF_RHS_dynamic_DRUMS. Only the structure (the terms) is
+    compiled; the coefficients are passed as one flat vector [eta, beta, tau],
+    so new coefficient samples do not trigger recompilation. Falls back to
+    pure Python kernels if numba is not installed.
+
+    Args:
+        eta_terms   (list): feature names of the eta terms, '1' for the bias.
+        beta_terms  (list): feature names of the beta terms.
+        tau_terms   (list): feature names of the tau terms.
+        eta_inputs  (list): input names of eta, e.g. list('SAY') or list('SAYM').
+        beta_inputs (list): input names of beta, e.g. list('sx') (s = S + A + Y, x = chi).
+        tau_inputs  (list): input names of tau, e.g. list('AY').
+        chi_type     (str): string indicating the type of function chi is.
+
+    Inputs:
+        t      (float): current time.
+        u      (array): STEAYDQRF values with shape (9,).
+        coefs  (array): coefficients of the eta, beta and tau terms.
+        params  (dict): parameters of the Covasim model.
+        t_max  (float): the maximum value of time in the t array.
+
+    Returns:
+        du (array): derivatives of STEAYDQRF with shape (9,).
+    '''
+
+    def __init__(self,
+                 eta_terms,
+                 beta_terms,
+                 tau_terms,
+                 eta_inputs=list('SAY'),
+                 beta_inputs=list('sx'),
+                 tau_inputs=list('AY'),
+                 chi_type='piecewise'):
+
+        for inputs in [eta_inputs, beta_inputs, tau_inputs]:
+            for name in inputs:
+                if name not in INPUT_EXPRESSIONS:
+                    raise ValueError('unknown input name {0}'.format(name))
+        if numba is None:
+            warnings.warn('numba is not installed, compiled equations run as pure Python')
+
+        self.terms = [list(eta_terms), list(beta_terms), list(tau_terms)]
+        self.sizes = [len(terms) for terms in self.terms]
+        self.n_coefs = sum(self.sizes)
+        self.chi_type = chi_type
+        offsets = np.cumsum([0] + self.sizes)
+        self.source = RHS_TEMPLATE.format(
+            eta=polynomial_source(eta_terms, eta_inputs, offsets[0]),
+            beta=polynomial_source(beta_terms, beta_inputs, offsets[1]),
+            tau=polynomial_source(tau_terms, tau_inputs, offsets[2]))
+        self.build()
+
+    def build(self):
+
+        namespace = {'np': np, 'chi_func': CHI_FUNCS[self.chi_type]}
+        exec(compile(self.source, '<CompiledEquations>', 'exec'), namespace)
+        self.rhs = njit(namespace['rhs'])
+
+    def __getstate__(self):
+
+        # the generated kernel is not picklable, worker processes rebuild it
+        state = self.__dict__.copy()
+        state.pop('rhs')
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.build()
+
+    def split(self, coefs):
+
+        '''
+        Splits a coefficient vector into its eta, beta and tau parts.
+        '''
+
+        offsets = np.cumsum([0] + self.sizes)
+        return [coefs[..., i:j] for i, j in zip(offsets[:-1], offsets[1:])]
+
+    def __call__(self, t, u, coefs, params, t_max=1.0):
+
+        mask = np.asarray(params['avg_masking'] if params.get('avg_masking') is not None
+                          else [0.0], dtype=float)
+        return self.rhs(float(t), np.asarray(u, dtype=float), np.asarray(coefs, dtype=float),
+                        pack_params(params), mask, float(t_max))
+
+    def simulate(self, IC, t, coefs, params, method='dopri5', parallel=True, **kwargs):
+
+        '''
+        Integrates the compiled system for one coefficient vector (returns
+        (len(t), 9)) or a (B, n_coefs) matrix of coefficient vectors (returns
+        (B, len(t), 9)), see simulate.
+        '''
+
+        return simulate(self, IC, t, coefs, params, method, parallel, **kwargs)
+
+@njit(cache=True)
+def rk4(rhs, u0, t, c, p, mask, t_max, n_steps):
+    '''
+    Classic fourth-order Runge-Kutta integration with about n_steps equal
+    steps over [t[0], t[-1]], adjusted so that every output time is hit.
+    '''
+    u = u0.copy()
+    out = np.empty((len(t), len(u0)))
+    out[0] = u
+    h_max = (t[-1] - t[0]) / n_steps
+    for j in range(1, len(t)):
+        n = max(int(np.ceil((t[j] - t[j - 1]) / h_max - 1e-9)), 1)
+        h = (t[j] - t[j - 1]) / n
+        for i in range(n):
+            ti = t[j - 1] + i * h
+            k1 = rhs(ti, u, c, p, mask, t_max)
+            k2 = rhs(ti + h / 2, u + h / 2 * k1, c, p, mask, t_max)
+            k3 = rhs(ti + h / 2, u + h / 2 * k2, c, p, mask, t_max)
+            k4 = rhs(ti + h, u + h * k3, c, p, mask, t_max)
+            u = u + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        out[j] = u
+    return out
+
+@njit(cache=True)
+def dopri5(rhs, u0, t, c, p, mask, t_max, rtol, atol, max_steps):
+    '''
+    Adaptive Dormand-Prince 5(4) integration (the method of scipy's 'dopri5')
+    with steps shortened to hit every output time. Returns NaNs if the
+    integration fails.
+    '''
+    u = u0.copy()
+    out = np.full((len(t), len(u0)), np.nan)
+    out[0] = u
+    tc = t[0]
+    h = (t[-1] - t[0]) / 100
+    k1 = rhs(tc, u, c, p, mask, t_max)
+    steps = 0
+    for j in range(1, len(t)):
+        while tc < t[j] - 1e-12 * max(1.0, abs(t[j])):
+            steps += 1
+            if steps > max_steps:
+                return out
+            hs = min(h, t[j] - tc)
+            k2 = rhs(tc + hs / 5, u + hs * (k1 / 5), c, p, mask, t_max)
+            k3 = rhs(tc + hs * 3 / 10, u + hs * (3 / 40 * k1 + 9 / 40 * k2), c, p, mask, t_max)
+            k4 = rhs(tc + hs * 4 / 5, u + hs * (44 / 45 * k1 - 56 / 15 * k2 + 32 / 9 * k3),
+                     c, p, mask, t_max)
+            k5 = rhs(tc + hs * 8 / 9, u + hs * (19372 / 6561 * k1 - 25360 / 2187 * k2
+                     + 64448 / 6561 * k3 - 212 / 729 * k4), c, p, mask, t_max)
+            k6 = rhs(tc + hs, u + hs * (9017 / 3168 * k1 - 355 / 33 * k2 + 46732 / 5247 * k3
+                     + 49 / 176 * k4 - 5103 / 18656 * k5), c, p, mask, t_max)
+            u_new = u + hs * (35 / 384 * k1 + 500 / 1113 * k3 + 125 / 192 * k4
+                              - 2187 / 6784 * k5 + 11 / 84 * k6)
+            k7 = rhs(tc + hs, u_new, c, p, mask, t_max)
+            err = hs * (71 / 57600 * k1 - 71 / 16695 * k3 + 71 / 1920 * k4
+                        - 17253 / 339200 * k5 + 22 / 525 * k6 - 1 / 40 * k7)
+
+            # RMS error norm
+            scale = atol + rtol * np.maximum(np.abs(u), np.abs(u_new))
+            norm = np.sqrt(np.mean((err / scale) ** 2))
+            if not np.isfinite(norm):
+                return out
+            if norm <= 1.0:
+                tc, u, k1 = tc + hs, u_new, k7 # first same as last
+            factor = 0.9 * norm ** (-0.2) if norm > 0 else 10.0
+            h = hs * min(10.0, max(0.2, factor))
+            if h < 1e-14 * max(1.0, abs(tc)):
+                return out
+        out[j] = u
+    return out
+
+@njit(cache=True)
+def integrate(rhs, u0, t, c, p, mask, t_max, method, n_steps, rtol, atol, max_steps):
+    if method == 0:
+        return rk4(rhs, u0, t, c, p, mask, t_max, n_steps)
+    return dopri5(rhs, u0, t, c, p, mask, t_max, rtol, atol, max_steps)
+
+@njit(parallel=True)
+def integrate_batch(rhs, u0, t, c, p, mask, t_max, method, n_steps, rtol, atol, max_steps):
+    out = np.empty((c.shape[0], len(t), u0.shape[1]))
+    for b in prange(c.shape[0]):
+        out[b] = integrate(rhs, u0[b], t, c[b], p[b], mask, t_max,
+                           method, n_steps, rtol, atol, max_steps)
+    return out
+
+def simulate(equations,
+             IC,
+             t,
+             coefs,
+             params,
+             method='dopri5',
+             parallel=True,
+             n_steps=1000,
+             rtol=1e-6,
+             atol=1e-12,
+             max_steps=100000):
+    '''
+    Simulator for compiled STEAYDQRF equations. Integrates one coefficient
+    vector, or a batch of coefficient vectors (e.g. posterior samples) with
+    one trajectory per numba thread. Unlike PDESolver.STEAYDQRF_sim the
+    solution is returned exactly at t (not at the nearest point of a 1000
+    point grid).
+
+    Args:
+        equations (CompiledEquations): compiled eta, beta and tau terms.
+        IC (array): initial conditions with shape (9,) or (B, 9).
+        t (array): increasing output times.
+        coefs (array): coefficients with shape (n_coefs,) or (B, n_coefs).
+        params (dict): parameters of the Covasim model, each a scalar or one
+            value per trajectory.
+        method (str): 'dopri5' (adaptive) or 'rk4' (fixed steps).
+        parallel (bool): whether to integrate a batch on all numba threads.
+        n_steps (int): approximate number of rk4 steps.
+        rtol (float): relative tolerance of dopri5.
+        atol (float): absolute tolerance of dopri5.
+        max_steps (int): maximal number of dopri5 steps.
+
+    Returns:
+        u (array): simulated STEAYDQRF values with shape (len(t), 9) or
+            (B, len(t), 9). Trajectories that failed to integrate are set
+            to 1e6 as in STEAYDQRF_sim.
+    '''
+    coefs = np.asarray(coefs, dtype=float)
+    single = coefs.ndim == 1
+    coefs = np.atleast_2d(coefs)
+    B = coefs.shape[0]
+    if coefs.shape[1] != equations.n_coefs:
+        raise ValueError('expected {0} coefficients, got {1}'.format(
+            equations.n_coefs, coefs.shape[1]))
+    t = np.asarray(t, dtype=float)
+    t_max = float(np.max(t))
+    u0 = np.broadcast_to(np.asarray(IC, dtype=float), (B, 9)).copy()
+    p = np.stack([np.broadcast_to(np.asarray(params[k], dtype=float), (B,)) for k in PARAM_NAMES], axis=1)
+    mask = np.asarray(params['avg_masking'] if params.get('avg_masking') is not None
+                      else [0.0], dtype=float)
+    args = (equations.rhs, u0, t, coefs, p, mask, t_max,
+            {'rk4': 0, 'dopri5': 1}[method], n_steps, rtol, atol, max_steps)
+
+    if parallel and B > 1:
+        u = integrate_batch(*args)
+    else:
+        u = np.stack([integrate(args[0], u0[b], t, coefs[b], p[b], *args[5:]) for b in range(B)])
+
+    # flag individual trajectories that blew up
+    failed = ~np.isfinite(u).all(axis=(1, 2))
+    u[failed] = 1e6
+
+    return u[0] if single else u
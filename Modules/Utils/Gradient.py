@@ -1,5 +1,10 @@
+import inspect
+import torch
 from torch.autograd import grad
 
+# batched grad_outputs were added in torch 1.11
+BATCHED_GRAD = 'is_grads_batched' in inspect.signature(grad).parameters
+
 def Gradient(outputs, inputs, order=1):
 
     '''
@@ -25,4 +30,37 @@ def Gradient(outputs, inputs, order=1):
         grads = grad(outputs, inputs, create_graph=True)[0]
         outputs = grads.sum()
 
-    return grads
\ No newline at end of file
+    return grads
+
+def BatchGradient(outputs, inputs):
+
+    '''
+    Takes the gradient of every output column with respect to inputs in a 
+    single vectorized backward pass. Assumes each row of outputs depends only on 
+    the same row of inputs (e.g. an MLP evaluated pointwise), so the result is 
+    the row-wise Jacobian.
+    
+    Inputs:
+        outputs (tensor): function to be differentiated with shape (N, n_out)
+        inputs  (tensor): differentiation argument with shape (N, n_in)
+        
+    Returns:
+        grads   (tensor): gradients with shape (N, n_out, n_in)
+    '''
+    
+    # one-hot output directions, one per output column
+    n_out = outputs.shape[1]
+    eye = torch.eye(n_out, dtype=outputs.dtype, device=outputs.device)
+    grad_outputs = eye[:, None, :].expand(n_out, *outputs.shape)
+
+    # vectorized backward pass over all directions at once
+    if BATCHED_GRAD:
+        grads = grad(outputs, inputs, grad_outputs=grad_outputs, 
+                     create_graph=True, is_grads_batched=True)[0]
+    
+    # fall back to one backward pass per output for older versions of torch
+    else:
+        grads = torch.stack([grad(outputs[:, i].sum(), inputs, create_graph=True)[0] 
+                             for i in range(n_out)])
+
+    return grads.permute(1, 0, 2)
@@ -1,10 +1,21 @@
 import os.path
 
-import torch, time, sys, pdb
+import torch, time, sys, pdb, warnings
 import numpy as np
+from collections import defaultdict
+from contextlib import contextmanager
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
 from Modules.Utils.TimeRemaining import *
+from Modules.Utils.AsyncWriter import AsyncWriter
+
+# errors raised by dynamo and inductor (a subclass) while compiling
+try:
+    from torch._dynamo.exc import TorchDynamoException
+    COMPILE_ERRORS = (TorchDynamoException,)
+except ImportError:
+    COMPILE_ERRORS = ()
 
 def to_numpy(x):
     return x.detach().cpu().numpy()
@@ -28,6 +39,25 @@ class ModelWrapper():
         save_best_train  (bool): Indicator for saving on best train loss.
         save_best_val    (bool): Indicator for saving on best val loss.
         save_opt         (bool): Indicator for saving optimizer weights.
+        use_compile (bool/dict): Opt-in compilation with torch.compile (a 
+                                  dict is passed as its keyword arguments) of
+                                  the submodules named in the model's 
+                                  compile_modules attribute. Compiled graphs 
+                                  do not support double backward, so only
+                                  networks the loss differentiates once can 
+                                  be compiled: for the Covasim BINNs this is
+                                  beta_func, while the surface fitter (time 
+                                  derivatives), eta_func and tau_func 
+                                  (monotonicity constraints) and the loss run
+                                  eagerly. Compilation is checked on the 
+                                  first batch before training, if dynamo or 
+                                  inductor fail there the wrapper warns and 
+                                  trains eagerly.
+        async_save       (bool): Write checkpoints and plots on a background
+                                  thread (see AsyncWriter), flushed at the end
+                                  of training.
+        keep_last         (int): Number of epoch-tagged checkpoints to keep 
+                                  besides the best one when async_save is set.
    
     Inputs:
         x       (tensor/generator): Input data.
@@ -54,10 +84,23 @@ class ModelWrapper():
         lr_dec_epoch         (int): Decrease lr after this many epochs.
         lr_dec_prop        (float): Value <= 1 to multiply learning rate.
         rel_save_thresh    (float): Rel. diff. btwn losses before saving.
+        collocation     (callable): Collocation sampler for the model's PDE 
+                                     loss (see CollocationSampler), resampled
+                                     as a callback at the start of each epoch.
+        lbfgs_epochs         (int): Number of full-batch L-BFGS epochs run 
+                                     after the first-order epochs (see 
+                                     fit_lbfgs).
+        lbfgs_kwargs        (dict): Keyword arguments of fit_lbfgs (e.g. lr,
+                                     max_iter, history_size).
         
     Returns:
         train_loss_list (list): Training errors per epoch.
         val_loss_list   (list): Validation errors per epoch.
+        timings         (dict): Self time per training phase in the current
+                                 epoch, nested phases are excluded (see 
+                                 Telemetry).
+        phase            (str): Hook of the callback being invoked, e.g. 
+                                 'on_epoch_end'.
     '''
    
     def __init__(self, 
@@ -71,7 +114,10 @@ class ModelWrapper():
                  save_best_train=False,
                  save_best_val=True,
                  save_opt=False,
-                 save_reg=False):
+                 save_reg=False,
+                 use_compile=False,
+                 async_save=False,
+                 keep_last=0):
         
         self.model = model
         self.optimizer = optimizer
@@ -89,6 +135,12 @@ class ModelWrapper():
         self.train = False
         self.val = False
         self.str_name = None
+        self.use_compile = use_compile
+        self.compiled = []
+        self.writer = AsyncWriter(keep_last) if async_save else None
+        self.timings = defaultdict(float)
+        self.timers = []
+        self.phase = None
         
         # if no name specified, don't save weights
         if self.save_name is None:
@@ -124,7 +176,10 @@ class ModelWrapper():
             include_val_reg=False,
             lr_dec_epoch=None,
             lr_dec_prop=1.0,
-            rel_save_thresh=0.0):
+            rel_save_thresh=0.0,
+            collocation=None,
+            lbfgs_epochs=0,
+            lbfgs_kwargs=None):
         
         # compute train batch size
         if batch_size is None:
@@ -143,6 +198,19 @@ class ModelWrapper():
                 val_batches_per_epoch = 1
                 val_batch_size = len(x_val)
         
+        # optional collocation points for the PDE loss
+        if collocation is not None:
+            self.model.collocation = collocation
+            callbacks = [collocation] + (list(callbacks) if callbacks is not None else [])
+        
+        # flush pending checkpoints and plots at the end of training
+        if self.writer is not None:
+            callbacks = (list(callbacks) if callbacks is not None else []) + [self.writer]
+        
+        # optionally compile the submodules free of double backward
+        if self.use_compile and not self.compiled:
+            self.compile_modules(x[:batch_size], y[:batch_size])
+        
         # initialize book keeping
         train_length = len(x)
         if validation_data is not None:
@@ -156,10 +224,14 @@ class ModelWrapper():
         if callbacks is not None:
             for c in callbacks:
                 if c.on_train_begin:
+                    self.phase = 'on_train_begin'
                     c(self)
         
-        # loop over epochs
+        # loop over epochs (last_epoch stays defined if no epoch runs)
+        last_epoch = initial_epoch - 1
         for epoch in range(initial_epoch, initial_epoch + epochs):
+            
+            last_epoch = epoch
 
             #
             # training step
@@ -172,6 +244,7 @@ class ModelWrapper():
             if callbacks is not None:
                 for c in callbacks:
                     if c.on_epoch_begin:
+                        self.phase = 'on_epoch_begin'
                         c(self)
             
             self.model.train()
@@ -191,6 +264,7 @@ class ModelWrapper():
                 if callbacks is not None:
                     for c in callbacks:
                         if c.on_batch_begin:
+                            self.phase = 'on_batch_begin'
                             c(self)
                 
                 # stop loop if steps_per_epoch exceeded
@@ -213,25 +287,26 @@ class ModelWrapper():
                     # extract input and output batches, NOTE: we use .data to
                     # detach the current batches from their history in order
                     # to prevent the computational graph from growing in memory
-                    start = idx * batch_size
-                    stop = (idx+1) * batch_size
-                    if idx+1 == train_batches_per_epoch:
-                        stop = -1
-                    x_true = x[start:stop].data.clone()
-                    y_true = y[start:stop].data.clone()
-                    
-                    # optional augmentations
-                    if self.augmentation is not None:
-                        x_true, y_true = self.augmentation(x_true, y_true)
+                    with self.timed('data'):
+                        start = idx * batch_size
+                        stop = (idx+1) * batch_size
+                        if idx+1 == train_batches_per_epoch:
+                            stop = len(x)
+                        x_true = x[start:stop].data.clone()
+                        y_true = y[start:stop].data.clone()
+                        
+                        # optional augmentations
+                        if self.augmentation is not None:
+                            x_true, y_true = self.augmentation(x_true, y_true)
 
                     # require gradients
                     x_true.requires_grad = True
 
-                    # run the model
-                    y_pred = self.model(x_true)
+                    # run the model and compute loss
+                    y_pred, loss = self.forward_loss(x_true, y_true)
 
-                    # compute loss and optional regularization
-                    self.train_loss += self.loss(y_pred, y_true)
+                    # add optional regularization
+                    self.train_loss += loss
                     if self.regularizer is not None:
                         self.train_reg_loss += self.regularizer(self.model, 
                                                                 x_true,
@@ -240,15 +315,19 @@ class ModelWrapper():
                     self.train_loss += self.train_reg_loss
 
                     # compute backward pass
-                    self.train_loss.backward() 
+                    with self.timed('backward'):
+                        self.train_loss.backward() 
                     
                     return self.train_loss
                 
-                # update model parameters
-                if self.scheduler is None:
+                # update model parameters (the phases of the closure are 
+                # timed separately and excluded from the optimizer time)
+                with self.timed('optimizer'):
                     self.optimizer.step(closure=closure)
-                else:
-                    self.scheduler.step(closure())
+                    if isinstance(self.scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+                        self.scheduler.step(self.train_loss.detach())
+                    elif self.scheduler is not None:
+                        self.scheduler.step()
                 
                 # update book keeping for this batch
                 self.train_loss = self.train_loss.cpu().detach().numpy()
@@ -281,6 +360,7 @@ class ModelWrapper():
                 if callbacks is not None:
                     for c in callbacks:
                         if c.on_batch_end:
+                            self.phase = 'on_batch_end'
                             c(self)
                 
             # update book keeping for this epoch
@@ -296,7 +376,7 @@ class ModelWrapper():
                 
                 # optionally save model and optimizer
                 if self.save_best_train:
-                    self.save(self.save_name+'_best_train')
+                    self.save(self.save_name+'_best_train', epoch)
                     
             # print readout
             if verbose == 2:
@@ -320,6 +400,7 @@ class ModelWrapper():
                 
                 self.train = False
                 self.val = True
+                self.start_timer('validation')
                 
                 self.model.eval()
                 y_pred = self.model(x)
@@ -342,6 +423,7 @@ class ModelWrapper():
                     if callbacks is not None:
                         for c in callbacks:
                             if c.on_batch_begin:
+                                self.phase = 'on_batch_begin'
                                 c(self)
                     
                     # stop loop if validation_steps exceeded
@@ -353,7 +435,7 @@ class ModelWrapper():
                     start = idx * val_batch_size
                     stop = (idx+1) * val_batch_size
                     if idx+1 == val_batches_per_epoch:
-                        stop = -1
+                        stop = len(x_val)
                     x_true = x_val[start:stop].data.clone()
                     y_true = y_val[start:stop].data.clone()
                     
@@ -364,14 +446,13 @@ class ModelWrapper():
                     if self.augmentation is not None and include_val_aug:
                         x_true, y_true = self.augmentation(x_true, y_true)
                     
-                    # run the model
-                    y_pred = self.model(x_true)
+                    # run the model and compute loss
+                    y_pred, loss = self.forward_loss(x_true, y_true)
 
                     # save plot
                     if epoch % 1000 == 0:
                         self.plot(x_true, y_true, y_pred, epoch, True)
-                    # compute loss 
-                    self.val_loss += self.loss(y_pred, y_true)
+                    self.val_loss += loss
                     
                     # optionally include regularization in val loss
                     if include_val_reg and self.regularizer is not None:
@@ -388,6 +469,7 @@ class ModelWrapper():
                     if callbacks is not None:
                         for c in callbacks:
                             if c.on_batch_end:
+                                self.phase = 'on_batch_end'
                                 c(self)
                     
                 # update book keeping for this epoch
@@ -404,7 +486,7 @@ class ModelWrapper():
                     
                     # optionally save model and optimizer
                     if self.save_best_val:
-                        self.save(self.save_name+'_best_val')
+                        self.save(self.save_name+'_best_val', epoch)
                     
                     # update early stopper
                     last_improved = epoch
@@ -414,6 +496,8 @@ class ModelWrapper():
                 else:
                     
                     improved = ''
+                
+                self.stop_timer()
             
             # update user
             if verbose == 1:
@@ -461,17 +545,18 @@ class ModelWrapper():
             if callbacks is not None:
                 for c in callbacks:
                     if c.on_epoch_end:
+                        self.phase = 'on_epoch_end'
                         c(self)
                 
         # final print readout for verbose 1
-        if verbose == 1:
+        if verbose == 1 and last_epoch >= initial_epoch:
             
             # times
             elapsed, remaining, ms = TimeRemaining(
-                current_iter=epoch+1,
+                current_iter=last_epoch+1,
                 total_iter=initial_epoch+epochs,
                 start_time=start_time,
-                previous_time=epoch_start_time,
+                previous_time=start_time,
                 ops_per_iter=batch_size)
             
             # prints
@@ -481,20 +566,259 @@ class ModelWrapper():
                 idx = np.argmin(self.train_loss_list)
             else:
                 idx = -1
-            p = '\rEpoch {0}'.format(epoch)
+            p = '\rEpoch {0}'.format(last_epoch)
             p += ' | Train loss = {0:1.4e}'.format(self.train_loss_list[idx])
             if validation_data is not None:
                 p += ' | Val loss = {0:1.4e}'.format(self.val_loss_list[idx])
             p += ' | Elapsed = ' + elapsed + '           '
             sys.stdout.write(p)
             print()
+        
+        # optional second-order refinement
+        if lbfgs_epochs > 0:
+            self.fit_lbfgs(
+                x=x,
+                y=y,
+                epochs=lbfgs_epochs,
+                verbose=verbose,
+                validation_data=validation_data,
+                initial_epoch=last_epoch+1,
+                best_train_loss=best_train_loss,
+                best_val_loss=best_val_loss,
+                include_val_reg=include_val_reg,
+                rel_save_thresh=rel_save_thresh,
+                callbacks=callbacks,
+                **(lbfgs_kwargs if lbfgs_kwargs is not None else {}))
             
         # callback at ending of training
         if callbacks is not None:
             for c in callbacks:
                 if c.on_train_end:
+                    self.phase = 'on_train_end'
                     c(self)
     
+    def fit_lbfgs(self,
+                  x,
+                  y,
+                  epochs=100,
+                  verbose=1,
+                  validation_data=None,
+                  initial_epoch=0,
+                  best_train_loss=None,
+                  best_val_loss=None,
+                  include_val_reg=False,
+                  rel_save_thresh=0.0,
+                  callbacks=None,
+                  lr=1.0,
+                  max_iter=20,
+                  history_size=100,
+                  tolerance_grad=1e-9,
+                  tolerance_change=1e-12):
+        
+        '''
+        Full-batch L-BFGS refinement with strong Wolfe line search, typically 
+        run after first-order training (see fit(lbfgs_epochs=...)). Each epoch
+        is one L-BFGS step of up to max_iter iterations, whose closure 
+        re-evaluates the loss on the full training set. The model is run in 
+        eval mode (no dropout or collocation points), so the objective is 
+        deterministic as the line search requires. Losses are appended to 
+        train_loss_list/val_loss_list and the best models are saved as in fit.
+        Stops early once the loss no longer changes or becomes non-finite.
+        Callbacks get the epoch hooks (e.g. Telemetry, CollocationSampler) but
+        not the batch hooks, as the line search evaluates the closure an 
+        unknown number of times per epoch. fit passes its callbacks and calls
+        on_train_end after the refinement.
+        '''
+        
+        self.lbfgs = torch.optim.LBFGS(
+            self.model.parameters(),
+            lr=lr,
+            max_iter=max_iter,
+            history_size=history_size,
+            tolerance_grad=tolerance_grad,
+            tolerance_change=tolerance_change,
+            line_search_fn='strong_wolfe')
+        best_train_loss = 1e12 if best_train_loss is None else best_train_loss
+        best_val_loss = 1e12 if best_val_loss is None else best_val_loss
+        start_time = time.time()
+        x_true = x.data.clone()
+        y_true = y.data.clone()
+        x_true.requires_grad = True
+        
+        # full-batch loss with optional regularization
+        def objective(x_true, y_true, regularize):
+            y_pred, loss = self.forward_loss(x_true, y_true)
+            if regularize and self.regularizer is not None:
+                loss = loss + self.regularizer(self.model, x_true, y_true, y_pred)
+            return loss
+        
+        # computes loss and gradients, called repeatedly by the line search
+        def closure():
+            self.lbfgs.zero_grad()
+            loss = objective(x_true, y_true, True)
+            with self.timed('backward'):
+                loss.backward()
+            return loss
+        
+        self.model.eval()
+        for epoch in range(initial_epoch, initial_epoch + epochs):
+            
+            epoch_start_time = time.time()
+            self.train = True
+            self.val = False
+            
+            # callback at beginning of epoch
+            if callbacks is not None:
+                for c in callbacks:
+                    if c.on_epoch_begin:
+                        self.phase = 'on_epoch_begin'
+                        c(self)
+            
+            with self.timed('optimizer'):
+                self.lbfgs.step(closure)
+            
+            # loss at the updated parameters
+            train_loss = to_numpy(objective(x_true, y_true, True))
+            previous = self.train_loss_list[-1] if len(self.train_loss_list) > 0 else None
+            self.train_loss_list.append(train_loss)
+            
+            # if train error improved
+            rel_diff = (best_train_loss - train_loss) / best_train_loss
+            if rel_diff > rel_save_thresh:
+                best_train_loss = train_loss
+                if self.save_best_train:
+                    self.save(self.save_name+'_best_train', epoch)
+            
+            # validation step
+            if validation_data is not None:
+                self.train = False
+                self.val = True
+                x_val = validation_data[0].data.clone()
+                x_val.requires_grad = True
+                val_loss = to_numpy(objective(x_val, validation_data[1], include_val_reg))
+                self.val_loss_list.append(val_loss)
+                rel_diff = (best_val_loss - val_loss) / best_val_loss
+                if rel_diff > rel_save_thresh:
+                    best_val_loss = val_loss
+                    if self.save_best_val:
+                        self.save(self.save_name+'_best_val', epoch)
+            
+            # update user
+            if verbose == 1:
+                elapsed, remaining, ms = TimeRemaining(
+                    current_iter=epoch-initial_epoch+1,
+                    total_iter=epochs,
+                    start_time=start_time,
+                    previous_time=epoch_start_time,
+                    ops_per_iter=len(x))
+                p = '\rL-BFGS epoch {0}'.format(epoch)
+                p += ' | Train loss = {0:1.4e}'.format(train_loss)
+                if validation_data is not None:
+                    p += ' | Val loss = {0:1.4e}'.format(val_loss)
+                p += ' | Remaining = ' + remaining + '           '
+                sys.stdout.write(p)
+            
+            # callback at ending of epoch
+            if callbacks is not None:
+                for c in callbacks:
+                    if c.on_epoch_end:
+                        self.phase = 'on_epoch_end'
+                        c(self)
+            
+            # stop once converged or diverged
+            if not np.isfinite(train_loss) or train_loss == previous:
+                break
+        
+        if verbose == 1:
+            print()
+    
+    def start_timer(self, name):
+        
+        '''
+        Starts timing a phase, nested in the phase currently timed (if any).
+        '''
+        
+        self.timers.append([name, time.perf_counter(), 0.0])
+    
+    def stop_timer(self):
+        
+        '''
+        Stops the innermost timer and adds its self time (the wall time minus
+        that of the phases nested in it) to timings[name], so the phases never
+        overlap and add up to at most the epoch time.
+        '''
+        
+        name, start_time, nested = self.timers.pop()
+        elapsed = time.perf_counter() - start_time
+        self.timings[name] += elapsed - nested
+        if len(self.timers) > 0:
+            self.timers[-1][2] += elapsed
+    
+    @contextmanager
+    def timed(self, name):
+        
+        '''
+        Adds the self time of the enclosed block to timings[name], which 
+        callbacks such as Telemetry read and reset every epoch.
+        '''
+        
+        self.start_timer(name)
+        try:
+            yield
+        finally:
+            self.stop_timer()
+    
+    def compile_modules(self, x, y):
+        
+        '''
+        Compiles the submodules named in the model's compile_modules attribute
+        in place (module.compile keeps the parameter names, so checkpoints 
+        are unchanged) and runs one forward and backward pass on the batch 
+        x, y, which triggers compilation. If dynamo or inductor fail, the 
+        submodules are reset to eager mode with a warning, so errors never 
+        switch modes during training. Other errors are raised.
+        '''
+        
+        if not hasattr(torch.nn.Module, 'compile'):
+            warnings.warn('torch.nn.Module.compile is not available, running eagerly.')
+            return
+        names = list(getattr(self.model, 'compile_modules', []))
+        if len(names) == 0:
+            warnings.warn('The model has no compile_modules, running eagerly.')
+            return
+        kwargs = self.use_compile if isinstance(self.use_compile, dict) else {}
+        for name in names:
+            getattr(self.model, name).compile(**kwargs)
+        
+        self.model.train()
+        x_true = x.data.clone()
+        x_true.requires_grad = True
+        try:
+            y_pred, loss = self.forward_loss(x_true, y.data.clone())
+            loss.backward()
+            self.compiled = names
+        except COMPILE_ERRORS as e:
+            warnings.warn(f'Compilation failed, running eagerly: {e}')
+            for name in names:
+                getattr(self.model, name)._compiled_call_impl = None
+        finally:
+            self.optimizer.zero_grad()
+    
+    def forward_loss(self, x, y):
+        
+        '''
+        Runs the model and computes the loss. Validation passes are timed 
+        as val_forward and val_loss.
+        '''
+        
+        prefix = 'validation_' if self.val else ''
+        with self.timed(prefix + 'forward'):
+            y_pred = self.model(x)
+        with self.timed(prefix + 'loss'):
+            loss = self.loss(y_pred, y)
+        
+        return y_pred, loss
+    
     def predict(self, inputs):
         
         '''
@@ -506,22 +830,32 @@ class ModelWrapper():
         
         return self.model(inputs)
     
-    def save(self, save_name):
+    def save(self, save_name, epoch=None):
         
         '''
         Saves model weights and optionally optimizer and/or regularizer weights.
+        With async_save, the weights are snapshotted and written in the 
+        background (epoch tags the kept copies, see AsyncWriter).
         '''
         
         # save model weights
-        torch.save(self.model.state_dict(), save_name+'_model')
+        self.start_timer('checkpoint')
+        states = [(self.model.state_dict(), save_name+'_model')]
         
         # save optimizer weights
         if self.save_opt and self.optimizer is not None:
-            torch.save(self.optimizer.state_dict(), save_name+'_opt')
+            states.append((self.optimizer.state_dict(), save_name+'_opt'))
         
         # save regularizer weights
         if self.save_reg and self.regularizer is not None:
-            torch.save(self.regularizer.state_dict(), save_name+'_reg')
+            states.append((self.regularizer.state_dict(), save_name+'_reg'))
+        
+        for state, file_name in states:
+            if self.writer is not None:
+                self.writer.save(state, file_name, epoch)
+            else:
+                torch.save(state, file_name)
+        self.stop_timer()
     
     def load(self, 
              model_weights, 
@@ -533,6 +867,10 @@ class ModelWrapper():
         Loads model weights and optionally optimizer and/or regularizer weights.
         '''
         
+        # wait for pending checkpoints
+        if self.writer is not None:
+            self.writer.flush()
+        
         # load model weights
         weights = torch.load(model_weights, map_location=device)
         self.model.load_state_dict(weights)
@@ -554,6 +892,10 @@ class ModelWrapper():
         Loads model weights that yielded best training error.
         '''
         
+        # wait for pending checkpoints
+        if self.writer is not None:
+            self.writer.flush()
+        
         # load model weights
         name = self.save_name+'_best_train_model'
         weights = torch.load(name, map_location=device)
@@ -578,6 +920,10 @@ class ModelWrapper():
         Loads model weights that yielded best validation error.
         '''
         
+        # wait for pending checkpoints
+        if self.writer is not None:
+            self.writer.flush()
+        
         # load model weights
         name = self.save_name+'_best_val_model'
         weights = torch.load(name, map_location=device)
@@ -600,21 +946,27 @@ class ModelWrapper():
         t = to_numpy(t)
         y_true = to_numpy(y_true)
         y_pred = to_numpy(y_pred)
+        fig_name = 'epoch_' + str(epoch)
+        fig_name += '_val' if is_val else '_train'
+        fig_name += '.png'
+        fig_name = os.path.join(self.save_folder, fig_name)
+        with self.timed('plot'):
+            if self.writer is not None:
+                self.writer.submit(fig_name, self.write_plot, t, y_true, y_pred, fig_name)
+            else:
+                self.write_plot(t, y_true, y_pred, fig_name)
+
+    def write_plot(self, t, y_true, y_pred, fig_name):
         # col_names = list('STEAYDQRF') if self.model.keep_d else list('STEAYQRF')
         col_names = list(self.str_name)
         n = len(col_names)
-        # plot compartments
-        fig = plt.figure(figsize=(10, 7))
+        # plot compartments (without pyplot, so it can run on the writer thread)
+        fig = Figure(figsize=(10, 7))
         for i in range(1, n + 1):
             ax = fig.add_subplot(int(np.ceil(n / 3)), 3, i)
             ax.plot(t, y_true[:, i - 1], '.k', label=col_names[i - 1] + '_true')
             ax.plot(t, y_pred[:, i - 1], '.r', label=col_names[i - 1] + '_pred')
             ax.legend()
             fig.subplots_adjust(left=0, right=1, bottom=0, top=1)
-            plt.tight_layout(pad=2)
-        fig_name = 'epoch_' + str(epoch)
-        fig_name += '_val' if is_val else '_train'
-        fig_name += '.png'
-        plt.savefig(os.path.join(self.save_folder, fig_name))
-        plt.close(fig)
-
+            fig.tight_layout(pad=2)
+        fig.savefig(fig_name)
@@ -3,7 +3,6 @@ import numpy as np
 from scipy import integrate
 from scipy import sparse
 from scipy import interpolate
-from scipy.stats import beta
 import os
 import scipy.io as sio
 import scipy.optimize
@@ -20,7 +19,7 @@ from matplotlib import cm
 from matplotlib.ticker import LinearLocator, FormatStrFormatter
 from mpl_toolkits.axes_grid1.inset_locator import zoomed_inset_axes
 from mpl_toolkits.axes_grid1.inset_locator import mark_inset
-from sklearn.preprocessing import PolynomialFeatures
+from Modules.Models.PolynomialLayer import polynomial_layer
 
 def chi_func(t, chi_type):
     eff_ub = 0.3
@@ -37,13 +36,13 @@ def chi_func(t, chi_type):
         rad_times = t * np.pi / 40.
         factor = 0.3 * (1 + np.sin(rad_times)) / 2
     elif chi_type == 'piecewise':
-        a, b = 3, 3
+        # Beta(3, 3) pdf scaled to a maximum of one, in closed form
+        bump = lambda x: 16 * x ** 2 * (1 - x) ** 2 if 0 <= x <= 1 else 0.0
         t_max = 159
-        max_val = beta.pdf(0.5, a, b, loc=0, scale=1)
         if t < 80:
-            factor = beta.pdf(t / t_max, a, b, loc=0, scale=1) * eff_ub / max_val
+            factor = bump(t / t_max) * eff_ub
         elif t >= 120:
-            factor = beta.pdf((t - 40) / t_max, a, b, loc=0, scale=1) * eff_ub / max_val
+            factor = bump((t - 40) / t_max) * eff_ub
         else:
             factor = eff_ub
     elif chi_type == 'constant':
@@ -70,7 +69,9 @@ def STEAYDQRF_RHS_dynamic_DRUMS(t,
     
     Args:
         t (array): time vector.
-        y (array): vector of values of STEAYDQRF.
+        y (array): vector of values of STEAYDQRF, or a (9, m) block of m states
+            (e.g. to evaluate the RHS on many states), in which case each learned
+            component is called once on all m states.
         contact_rate (func): the contact rate learned MLP in the BINN model.
         quarantine_test (func): the quarantining rate learned MLP in the BINN model.
         tau_func (func): the quarantine diagnoses rate learned MLP in the BINN model.
@@ -79,7 +80,8 @@ def STEAYDQRF_RHS_dynamic_DRUMS(t,
         chi_type (str): string indicated the type of function chi is.
     
     Returns:
-        (array): numpy array of values of each differential term in the ODE system.
+        (array): numpy array of values of each differential term in the ODE system
+            with the same shape as y.
     '''
 
     population = params['population']
@@ -94,47 +96,42 @@ def STEAYDQRF_RHS_dynamic_DRUMS(t,
     eff_ub = params['eff_ub']
     
     chi = chi_func(t, chi_type)
+
+    # states as columns, so a (9, m) block of states is evaluated at once
+    u = np.asarray(u)
+    vectorized = u.ndim == 2
+    U = u.T if vectorized else u[None, :]
+    m = U.shape[0]
+
     # eta
-    eta_input = u[None, :][:, [0, 3, 4]].reshape(1,-1) if not eta_all_comps else u[None, :].reshape(1,-1)
+    eta_input = U[:, [0, 3, 4]] if not eta_all_comps else U
     if masking:
-        if int(t * t_max) < 183:
-            eta_input = np.append(eta_input, avg_masking[int(t * t_max)]).reshape(1, -1)
-        else:
-            eta_input = np.append(eta_input, avg_masking[-1]).reshape(1, -1)
-    if eta_degree==-1:
-        cr = eta_func(eta_input).reshape(-1)
-    else:
-        poly = PolynomialFeatures(eta_degree)
-        eta_input = poly.fit_transform(eta_input)
-        cr = eta_func(eta_input).reshape(-1)
-    yita = params['yita_lb'] + (params['yita_ub'] - params['yita_lb']) * cr[0]
-    yita = yita if yita.shape == (1,) else np.array([yita])
+        mask = avg_masking[int(t * t_max)] if int(t * t_max) < 183 else avg_masking[-1]
+        eta_input = np.hstack([eta_input, np.full((m, 1), mask)])
+    if eta_degree != -1:
+        eta_input = polynomial_layer(eta_input.shape[1], eta_degree).transform(eta_input)
+    cr = np.reshape(eta_func(eta_input), (m, -1))[:, 0]
+    yita = params['yita_lb'] + (params['yita_ub'] - params['yita_lb']) * cr
     
     # beta
     if not beta_all_comps:
-        beta_input = np.append(u[None, :][:,[0, 3, 4]].sum(axis=1, keepdims=True), chi).reshape(1,-1)
-    else:
-        beta_input = u[None, :].reshape(1, -1)
-    if beta_degree==-1:
-        beta0 = beta_func(beta_input).reshape(-1)
+        beta_input = np.hstack([U[:, [0, 3, 4]].sum(axis=1, keepdims=True), np.full((m, 1), chi)])
     else:
-        poly = PolynomialFeatures(beta_degree)
-        beta_input = poly.fit_transform(beta_input)
-        beta0 = beta_func(beta_input).reshape(-1)
+        beta_input = U
+    if beta_degree != -1:
+        beta_input = polynomial_layer(beta_input.shape[1], beta_degree).transform(beta_input)
+    beta0 = np.reshape(beta_func(beta_input), (m, -1))[:, 0]
     beta = chi * beta0
     
     # tau
-    tau_input = u[None, :][:, [3, 4]].reshape(1,-1) if not tau_all_comps else u[None, :].reshape(1,-1)
-    if tau_degree==-1:
-        tau0 = tau_func(tau_input)
-    else:
-        poly = PolynomialFeatures(tau_degree)
-        tau_input = poly.fit_transform(tau_input)
-        tau0 = tau_func(tau_input)
+    tau_input = U[:, [3, 4]] if not tau_all_comps else U
+    if tau_degree != -1:
+        tau_input = polynomial_layer(tau_input.shape[1], tau_degree).transform(tau_input)
+    tau0 = np.reshape(tau_func(tau_input), (m, -1))[:, 0]
     tau = params['tau_lb'] + (params['tau_ub'] - params['tau_lb']) * tau0
     
     # current compartment values
-    s, tq, e, a, y, d, q, r, f = u[0], u[1], u[2], u[3], u[4], u[5], u[6], u[7], u[8]
+    s, tq, e, a, y, d, q, r, f = U.T
     new_d = mu * y +  tau * q
     # dS
     ds = - yita * s * (a + y) - beta * new_d *  n_contacts * s + alpha * tq
@@ -144,7 +141,6 @@ def STEAYDQRF_RHS_dynamic_DRUMS(t,
 
     # dE
     de = yita * s * (a + y) - gamma * e
-    de = de if de.shape == ds.shape else de.reshape(1, -1)
 
     # dA
     da =  p_asymp * gamma * e - lamda * a - beta * new_d *  n_contacts * a
@@ -160,13 +156,13 @@ def STEAYDQRF_RHS_dynamic_DRUMS(t,
 
     # dR
     dr =  lamda * (a + y + d ) #
-    dr = dr if dr.shape == ds.shape else np.array([dr]).reshape(1, -1)
 
     # dF
     df =  delta * (y + d + q)
-    df = df if df.shape == ds.shape else np.array([df]).reshape(1, -1)
 
-    return np.array([ds, dt, de, da, dy, dd, dq, dr, df])
+    du = np.array([ds, dt, de, da, dy, dd, dq, dr, df])
+
+    return du if vectorized else du[:, 0]
 
 
 def STEAYDQRF_sim(RHS, 
@@ -183,7 +179,9 @@ def STEAYDQRF_sim(RHS,
                   tau_all_comps=False,
                   eta_degree=-1,
                   beta_degree=-1,
-                  tau_degree=-1):
+                  tau_degree=-1,
+                  rtol=1e-6,
+                  atol=1e-12):
     '''
     Simulator for the STEAYDQRF model using numerical integration.
     
@@ -196,21 +194,20 @@ def STEAYDQRF_sim(RHS,
         params (dict):
         chi_type (str): string indicating the type of function chi is.
         regression (bool): boolean indicating if the parameters are NN are linear models.
+        rtol (float): relative tolerance of the integrator.
+        atol (float): absolute tolerance of the integrator.
     
     Returns:
-        y (array): numpy array of values of each term in STEAYDQRF.
+        y (array): numpy array of values of each term in STEAYDQRF, reported at the
+            points of a 1000-point grid nearest to t.
     '''
     # grids for numerical integration
     t_max = np.max(t)
     t_sim = np.linspace(np.min(t), t_max, 1000)
 
-    # indices for integration to write to file for
-    for tp in t:
-        tp_ind = np.abs(tp - t_sim).argmin()
-        if tp == t[0]:
-            t_sim_write_ind = np.array(tp_ind)
-        else:
-            t_sim_write_ind = np.hstack((t_sim_write_ind, tp_ind))
+    # grid points nearest to the output times (the solution is reported there)
+    t_sim_write_ind = np.abs(np.asarray(t)[:, None] - t_sim[None, :]).argmin(axis=1)
+    t_eval = t_sim[t_sim_write_ind[1:]]
 
     # make RHS a function of t,y
     def RHS_tu(t, u):
@@ -235,21 +232,17 @@ def STEAYDQRF_sim(RHS,
 
     u[0,:] = IC
     
-    write_count = 0
-    r = integrate.ode(RHS_tu).set_integrator("dopri5")  # choice of method
-    r.set_initial_value(u[0,:], t[0])  # initial values
-    
-    for i in range(1, t_sim.size):
-
-        # write to y for write indices
-        if np.any(i == t_sim_write_ind):
-            write_count += 1
-            u[write_count, :] = r.integrate(t_sim[i])
-        else:
-            # otherwise just integrate
-            r.integrate(t_sim[i])  # get one more value, add it to the array
-        if not r.successful():
-            print("integration failed")
-            return 1e6 * np.ones(u.shape)
-
-    return u
\ No newline at end of file
+    # Dormand-Prince 5(4) as scipy's ode('dopri5') with its tolerances
+    sol = integrate.solve_ivp(RHS_tu, 
+                              (t[0], t_eval[-1]), 
+                              u[0,:], 
+                              method='RK45', 
+                              t_eval=t_eval, 
+                              rtol=rtol, 
+                              atol=atol)
+    if not sol.success:
+        print("integration failed")
+        return 1e6 * np.ones(u.shape)
+    u[1:, :] = sol.y.T
+
+    return u
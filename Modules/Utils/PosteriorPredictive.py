@@ -0,0 +1,308 @@
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from Modules.Utils.EquationCompiler import simulate
+
+def sample_coefficients(mean, cov, n_samples, scale=1.0, seed=None):
+    '''
+    Draws coefficient vectors from a multivariate normal distribution.
+
+    Args:
+        mean (array): mean coefficient vector with shape (n_coefs,).
+        cov (array): covariance matrix with shape (n_coefs, n_coefs).
+        n_samples (int): number of samples.
+        scale (float): factor applied to the covariance matrix.
+        seed (int): seed of the random generator.
+
+    Returns:
+        samples (array): coefficient samples with shape (n_samples, n_coefs).
+    '''
+    rng = np.random.default_rng(seed)
+    return rng.multivariate_normal(np.asarray(mean), scale * np.asarray(cov), n_samples)
+
+def chunks(n, chunk_size):
+    return [slice(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+
+class PredictiveBands():
+
+    '''
+    Streaming per-day summary of simulated trajectories. Every (day, output)
+    cell keeps a histogram with n_bins bins on [lower, upper] plus an under-
+    and an overflow bin, the running minimum and maximum, and the running sum
+    and sum of squares, so quantile bands, means and standard deviations are
+    available without storing the trajectories. Quantiles are linearly
+    interpolated within bins, i.e. accurate to (upper - lower) / n_bins.
+    Bands computed on separate chunks (e.g. in worker processes) with the same
+    bounds can be merged.
+
+    Args:
+        lower (array): lower bound of the histograms with shape (T, k).
+        upper (array): upper bound of the histograms with shape (T, k).
+        n_bins  (int): number of bins between the bounds.
+    '''
+
+    def __init__(self, lower, upper, n_bins=1000):
+
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.maximum(np.asarray(upper, dtype=float), self.lower + 1e-12)
+        self.n_bins = n_bins
+        self.counts = np.zeros(self.lower.shape + (n_bins + 2,), dtype=np.int64)
+        self.min = np.full(self.lower.shape, np.inf)
+        self.max = np.full(self.lower.shape, -np.inf)
+        self.sum = np.zeros(self.lower.shape)
+        self.sum_sq = np.zeros(self.lower.shape)
+        self.n = 0
+
+    @classmethod
+    def from_pilot(cls, u, n_bins=1000, margin=0.5):
+
+        '''
+        Bands with bounds from a pilot batch u with shape (B, T, k), widened
+        on both sides by margin times the range of the pilot batch.
+        '''
+
+        lo, hi = u.min(axis=0), u.max(axis=0)
+        pad = margin * (hi - lo) + 1e-12
+        return cls(lo - pad, hi + pad, n_bins)
+
+    def empty(self):
+
+        return PredictiveBands(self.lower, self.upper, self.n_bins)
+
+    def update(self, u):
+
+        '''
+        Adds a batch of trajectories with shape (B, T, k).
+        '''
+
+        u = np.asarray(u, dtype=float)
+        if len(u) == 0:
+            return self
+        idx = np.floor((u - self.lower) / (self.upper - self.lower) * self.n_bins)
+        idx = np.clip(idx, -1, self.n_bins).astype(np.int64) + 1
+        cells = np.arange(self.lower.size).reshape(self.lower.shape)
+        flat = (cells * (self.n_bins + 2) + idx).ravel()
+        self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+        self.min = np.minimum(self.min, u.min(axis=0))
+        self.max = np.maximum(self.max, u.max(axis=0))
+        self.sum += u.sum(axis=0)
+        self.sum_sq += (u ** 2).sum(axis=0)
+        self.n += len(u)
+        return self
+
+    def merge(self, other):
+
+        '''
+        Adds the trajectories summarized by other (same bounds and bins).
+        '''
+
+        if not (np.array_equal(self.lower, other.lower) and np.array_equal(self.upper, other.upper)):
+            raise ValueError('cannot merge bands with different bounds')
+        self.counts += other.counts
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.n += other.n
+        return self
+
+    @property
+    def mean(self):
+
+        return self.sum / self.n
+
+    @property
+    def std(self):
+
+        return np.sqrt(np.maximum(self.sum_sq / self.n - self.mean ** 2, 0.0))
+
+    def quantile(self, q):
+
+        '''
+        Per-day quantiles with shape (T, k) for a scalar q, or (len(q), T, k).
+        '''
+
+        q_arr = np.atleast_1d(q)
+        width = (self.upper - self.lower) / self.n_bins
+        cum = np.cumsum(self.counts, axis=-1)
+        out = []
+        for qi in q_arr:
+            target = qi * self.n
+            b = np.argmax(cum >= target, axis=-1)[..., None]
+            before = np.where(b > 0, np.take_along_axis(cum, np.maximum(b - 1, 0), axis=-1), 0)[..., 0]
+            in_bin = np.take_along_axis(self.counts, b, axis=-1)[..., 0]
+            frac = np.clip((target - before) / np.maximum(in_bin, 1), 0.0, 1.0)
+            b = b[..., 0]
+
+            # bin edges, the under- and overflow bins end at the running extremes
+            left = self.lower + (b - 1) * width
+            right = left + width
+            left = np.where(b == 0, self.min, left)
+            right = np.where(b == 0, self.lower, right)
+            left = np.where(b == self.n_bins + 1, self.upper, left)
+            right = np.where(b == self.n_bins + 1, self.max, right)
+            left, right = np.maximum(left, self.min), np.minimum(right, self.max)
+            out.append(left + frac * (right - left))
+
+        out = np.stack(out)
+        return out[0] if np.ndim(q) == 0 else out
+
+def trajectory_distances(u, target, weights=1.0):
+    '''
+    Weighted RMS distance of trajectories with shape (B, T, 9) to a target
+    trajectory with shape (T, 9) (nan is ignored), infinite for failed
+    integrations.
+    '''
+    d = np.sqrt(np.nanmean(((u - target) * weights) ** 2, axis=(1, 2)))
+    d[(u == 1e6).all(axis=(1, 2))] = np.inf
+    return d
+
+def simulate_chunk(equations, IC, t, samples, params, transform, bands, kwargs, target=None, weights=1.0, n_bins=1000):
+    '''
+    Simulates a chunk of coefficient samples and summarizes the successful
+    trajectories in new bands with the bounds of bands (bands from the chunk
+    itself with n_bins bins if bands is None, i.e. for the first chunk).
+    Returns the bands, the number of failed trajectories and the distances
+    of all trajectories to target (None without target).
+    '''
+    u = simulate(equations, IC, t, samples, params, **kwargs)
+    distances = trajectory_distances(u, target, weights) if target is not None else None
+    failed = (u == 1e6).all(axis=(1, 2))
+    u = u[~failed]
+    if bands is None and len(u) == 0:
+        raise RuntimeError('all trajectories of the first chunk failed to integrate')
+    if transform is not None:
+        u = transform(u, samples[~failed])
+    bands = bands.empty() if bands is not None else PredictiveBands.from_pilot(u, n_bins)
+    return bands.update(u), int(failed.sum()), distances
+
+def predictive_bands(equations,
+                     IC,
+                     t,
+                     samples,
+                     params,
+                     transform=None,
+                     accept=None,
+                     target=None,
+                     weights=1.0,
+                     chunk_size=1000,
+                     n_bins=1000,
+                     n_jobs=1,
+                     **kwargs):
+    '''
+    Posterior predictive engine for compiled equations. Integrates all
+    coefficient samples in chunks (each chunk is one batched, numba-parallel
+    EquationCompiler.simulate call) and streams the trajectories into
+    PredictiveBands, so memory does not grow with the number of samples. The
+    histogram bounds come from the first chunk; the remaining chunks can be
+    distributed over n_jobs worker processes (then set parallel=False to
+    avoid oversubscription). With a target, the distances used for rejection
+    sampling (see sample_distances) are computed in the same pass, e.g. to 
+    get the prior bands and the distances of the prior samples at once.
+
+    Args:
+        equations (CompiledEquations): compiled eta, beta and tau terms.
+        IC (array): initial conditions with shape (9,).
+        t (array): output times.
+        samples (array): coefficient samples with shape (n_samples, n_coefs).
+        params (dict): parameters of the Covasim model.
+        transform (func): optional map of (trajectories (B, T, 9), samples
+            (B, n_coefs)) to the (B, T, k) outputs to summarize.
+        accept (array): optional boolean mask of the samples to include.
+        target (array): optional target trajectory with shape (T, 9).
+        weights (array): weights of the compartments in the distances.
+        chunk_size (int): number of samples integrated at once.
+        n_bins (int): number of histogram bins per day and output.
+        n_jobs (int): number of worker processes (joblib).
+        kwargs (dict): passed on to EquationCompiler.simulate.
+
+    Returns:
+        bands (PredictiveBands): streamed summary of the trajectories, with
+            the number of failed integrations in bands.n_failed and, with a
+            target, the distances of the (accepted) samples in 
+            bands.distances.
+    '''
+    samples = np.atleast_2d(np.asarray(samples, dtype=float))
+    if accept is not None:
+        samples = samples[np.asarray(accept, dtype=bool)]
+    slices = chunks(len(samples), chunk_size)
+
+    # the first chunk sets the histogram bounds
+    bands, n_failed, d = simulate_chunk(equations, IC, t, samples[slices[0]], params, transform, None,
+                                        kwargs, target, weights, n_bins)
+    distances = [d]
+
+    if n_jobs == 1:
+        results = (simulate_chunk(equations, IC, t, samples[s], params, transform, bands, kwargs, target, weights)
+                   for s in slices[1:])
+    else:
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(simulate_chunk)(equations, IC, t, samples[s], params, transform, bands, kwargs, target, weights)
+            for s in slices[1:])
+    for chunk_bands, n, d in results:
+        bands.merge(chunk_bands)
+        n_failed += n
+        distances.append(d)
+    bands.n_failed = n_failed
+    bands.distances = np.concatenate(distances) if target is not None else None
+
+    return bands
+
+def sample_distances(equations, IC, t, samples, params, target, weights=1.0, chunk_size=1000, **kwargs):
+    '''
+    Weighted RMS distance of the trajectory of every coefficient sample to a
+    target trajectory (e.g. the mean of the training replicates), computed
+    chunk by chunk for rejection sampling (ABC). Failed integrations get an
+    infinite distance. predictive_bands(target=...) computes the same 
+    distances along with the bands.
+
+    Args:
+        equations (CompiledEquations): compiled eta, beta and tau terms.
+        IC (array): initial conditions with shape (9,).
+        t (array): output times.
+        samples (array): coefficient samples with shape (n_samples, n_coefs).
+        params (dict): parameters of the Covasim model.
+        target (array): target trajectory with shape (T, 9) (nan is ignored).
+        weights (array): weights of the compartments.
+        chunk_size (int): number of samples integrated at once.
+        kwargs (dict): passed on to EquationCompiler.simulate.
+
+    Returns:
+        distances (array): distances with shape (n_samples,).
+    '''
+    samples = np.atleast_2d(np.asarray(samples, dtype=float))
+    distances = np.empty(len(samples))
+    for s in chunks(len(samples), chunk_size):
+        u = simulate(equations, IC, t, samples[s], params, **kwargs)
+        distances[s] = trajectory_distances(u, target, weights)
+    return distances
+
+def coverage(bands, replicates, lower=0.025, upper=0.975, names=list('STEAYDQRF')):
+    '''
+    Fraction of replicate data points (e.g. held-out Covasim runs) inside the
+    [lower, upper] quantile band, per output and overall. Replicates with k
+    outputs are compared with the first k outputs of the bands (e.g. the
+    compartments of bands with R(t) as an extra output).
+
+    Args:
+        bands (PredictiveBands): streamed summary of the trajectories.
+        replicates (array): replicate trajectories with shape (R, T, k), in
+            the units of the bands (nan is ignored).
+        lower (float): quantile of the lower edge of the band.
+        upper (float): quantile of the upper edge of the band.
+        names (list): names of the k outputs.
+
+    Returns:
+        coverage (DataFrame): coverage and mean band width per output.
+    '''
+    replicates = np.asarray(replicates, dtype=float)
+    lb, ub = bands.quantile([lower, upper])[..., :replicates.shape[-1]]
+    valid = np.isfinite(replicates)
+    inside = (replicates >= lb) & (replicates <= ub) & valid
+    names = list(names)[:replicates.shape[-1]]
+    df = pd.DataFrame({
+        'coverage': inside.sum(axis=(0, 1)) / valid.sum(axis=(0, 1)),
+        'band_width': (ub - lb).mean(axis=0)}, index=names)
+    df.loc['all'] = [inside.sum() / valid.sum(), np.nan]
+    return df
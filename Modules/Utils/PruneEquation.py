@@ -1,17 +1,171 @@
 import numpy as np
+import pandas as pd
 from sklearn.linear_model import LinearRegression
-from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import KFold
+from scipy.linalg import qr, solve_triangular
 
-def PruneEquation(theta_old_dict, y, alpha, max_pruning=-1) -> dict:
+def lstsq_cv_error(Z_train, y_train, Z_test, y_test, loo):
+
+    '''
+    CV error of a minimum-norm least squares fit (as LinearRegression), for
+    rank-deficient features. With loo, the PRESS residuals follow from the
+    leverages of the SVD of Z_train.
     '''
+
+    if loo:
+        U, s, _ = np.linalg.svd(Z_train, full_matrices=False)
+        U = U[:, s > max(Z_train.shape) * np.finfo(float).eps * s[0]]
+        h = (U ** 2).sum(axis=1)
+        e = y_train - U @ (U.T @ y_train)
+        return np.mean((e / (1 - h)) ** 2)
+    beta = np.linalg.lstsq(Z_train, y_train, rcond=None)[0]
+    return np.mean((y_test - Z_test @ beta) ** 2)
+
+class DeletionCV():
+    '''
+    Cross-validated least squares (with intercept, as LinearRegression) of a
+    feature matrix under backward elimination. Every fold keeps the inverse
+    Gram matrix and the coefficients of its training split, so the CV errors
+    of all single-feature deletions follow in closed form from the downdate
+    beta_-j = beta - H[:, j] beta_j / H[j, j], and deleting a feature is a
+    rank-one downdate of H instead of a refit. Supports k-fold CV (the folds
+    of cross_val_score(..., cv=k)) and closed-form leave-one-out CV (PRESS).
+    Features are standardized internally, which does not change the fits.
+
+    H is computed from a pivoted QR factorization of the training split
+    (without forming the Gram matrix). If its numerical rank is deficient,
+    i.e. the smallest pivot is below rcond times the largest (near-collinear
+    features, e.g. of degree-3 polynomial libraries), the closed form is
+    unreliable and the fold falls back to minimum-norm least squares refits
+    until enough features are deleted to make it full rank again.
+
+    Args:
+        theta (array): feature matrix with shape (n_samples, n_features)
+            without constant columns.
+        y (array): target values with shape (n_samples,).
+        cv (int): number of folds, or -1 for leave-one-out.
+        columns (list): labels of the features, defaults to their indices.
+        rcond (float): relative pivot threshold of the rank check.
+    '''
+
+    def __init__(self, theta, y, cv=5, columns=None, rcond=1e-7):
+
+        self.loo = cv == -1
+        self.rcond = rcond
+        Z = (theta - theta.mean(axis=0)) / theta.std(axis=0)
+        Z = np.hstack([np.ones((len(Z), 1)), Z])
+        splits = [(np.arange(len(Z)), None)] if self.loo else KFold(cv).split(Z)
+        self.folds = []
+        for train, test in splits:
+            Z_train, y_train = Z[train], y[train]
+            Z_test, y_test = (Z_train, y_train) if self.loo else (Z[test], y[test])
+            self.folds.append(self.factor([None, None, Z_train, y_train, Z_test, y_test]))
+
+        # column 0 is the intercept, column j + 1 is feature j
+        self.columns = list(range(theta.shape[1])) if columns is None else list(columns)
+
+    def factor(self, fold):
+
+        '''
+        Sets the inverse Gram matrix H and the coefficients of a fold from a
+        pivoted QR factorization of its training split, or None for both if
+        the training split is numerically rank-deficient.
+        '''
+
+        Z, y = fold[2], fold[3]
+        Q, R, perm = qr(Z, mode='economic', pivoting=True)
+        pivots = np.abs(np.diag(R))
+        if len(pivots) < Z.shape[1] or pivots[-1] < self.rcond * pivots[0]:
+            fold[0], fold[1] = None, None
+            return fold
+
+        # Z[:, perm] = Q R, so H[perm][:, perm] = R^-1 R^-T
+        R_inv = solve_triangular(R, np.eye(len(R)))
+        H = np.empty_like(R)
+        H[np.ix_(perm, perm)] = R_inv @ R_inv.T
+        beta = np.empty(len(R))
+        beta[perm] = R_inv @ (Q.T @ y)
+        fold[0], fold[1] = H, beta
+        return fold
+
+    def fold_error(self, H, beta, Z_train, y_train, Z, y):
+
+        '''
+        CV error of the current fit and of every single-feature deletion.
+        '''
+
+        # rank-deficient fold, refit every deletion
+        if H is None:
+            keep = np.ones(Z.shape[1], dtype=bool)
+            errors = [lstsq_cv_error(Z_train, y_train, Z, y, self.loo)]
+            for j in range(1, Z.shape[1]):
+                keep[j] = False
+                errors.append(lstsq_cv_error(Z_train[:, keep], y_train, Z[:, keep], y, self.loo))
+                keep[j] = True
+            return np.array(errors)
+
+        # row j holds the coefficients without column j
+        B = beta[None, :] - H * (beta / np.diag(H))[:, None]
+        E = y[:, None] - Z @ np.vstack([beta, B[1:]]).T
+        if self.loo:
+            W = Z @ H
+            h = (W * Z).sum(axis=1)
+            h = np.hstack([h[:, None], h[:, None] - W[:, 1:] ** 2 / np.diag(H)[1:]])
+            E = E / (1 - h)
+        return (E ** 2).mean(axis=0)
+
+    def scores(self):
+
+        '''
+        Returns the CV MSE of the current features and an array with the CV
+        MSE after deleting each of the current features.
+        '''
+
+        errors = np.mean([self.fold_error(*fold) for fold in self.folds], axis=0)
+        return errors[0], errors[1:]
+
+    def delete(self, i):
+
+        '''
+        Deletes the i-th current feature by downdating every fold (or by 
+        refactoring the rank-deficient ones).
+        '''
+
+        j = i + 1
+        keep = np.arange(len(self.columns) + 1) != j
+        for fold in self.folds:
+            H, beta = fold[0], fold[1]
+            fold[2] = fold[2][:, keep]
+            fold[4] = fold[2] if self.loo else fold[4][:, keep]
+            if H is None:
+                self.factor(fold)
+                continue
+            beta = beta - H[:, j] * beta[j] / H[j, j]
+            H = H - np.outer(H[:, j], H[j, :]) / H[j, j]
+            fold[0], fold[1] = H[keep][:, keep], beta[keep]
+        self.columns.pop(i)
+
+def PruneEquation(theta_old_dict, y, alpha, max_pruning=-1, cv=5, full_trace=False) -> dict:
+    '''
+    Backward elimination of the features of a linear model. Each step
+    evaluates the CV MSE of all single-feature deletions at once (see
+    DeletionCV) and deletes the feature whose removal gives the lowest CV
+    MSE, as long as val / val0 < 1 + alpha and at most max_pruning features
+    were deleted. Constant columns (e.g. a bias feature '1') are redundant
+    with the intercept and can always be deleted without changing the fit.
+
     Args:
         theta_old_dict (dict): dictionary containing the feature matrix that we wish to prune.
             'theta' -> feature matrix (np.ndarray)
             'features' -> list of the feature names (default are indices).
         y (np.ndarray): target values.
         alpha (float): threshold value that determines pruning.
+        max_pruning (int): maximal number of features to prune. If -1 then no max.
+        cv (int): number of CV folds (as cross_val_score), or -1 for leave-one-out CV.
+        full_trace (bool): if True, keeps eliminating after the stopping rule down to
+            a single feature, so the trace covers the whole elimination path.
     Returns:
-        theta_new_dict (dict): dictionary with key value pairs 
+        theta_new_dict (dict): dictionary with key value pairs
             'theta' -> pruned feature matrix
             'xi' -> coefficients from linear regression fit on pruned feature matrix and target values y.
             'pruned' -> boolean value indicating if pruning occured.
@@ -19,61 +173,62 @@ def PruneEquation(theta_old_dict, y, alpha, max_pruning=-1) -> dict:
             'old_features' -> list of original feature names.
             'val' -> validation score measured in MSE.
             'val0' -> original validation score measured in MSE.
-            #'change' -> percentage change in validation MSE between old and new. If pruned==False then 0%.
-            'num_pruned' -> number of features pruned. If pruned==False then 0. If -1 then no max.
+            'num_pruned' -> number of features pruned. If pruned==False then 0.
+            'trace' -> DataFrame with one row per elimination step: the removed feature, the
+                number of remaining features, the CV MSE, its ratio to val0, whether the step
+                passed the stopping rule and the CV MSE of every candidate deletion.
     '''
     theta_new_dict = dict()
     theta_new_dict['old_features'] = theta_old_dict['features']
-    old_feature_arr = theta_new_dict['old_features']
-    pruned_features = []
-    
-    theta_0 = theta_old_dict['theta']
-    lm = LinearRegression()
-    lm.fit(theta_0, y)
-    theta_new_dict['xi'] = lm.coef_.T
-    scoring = 'neg_mean_squared_error'
-    cv0 = cross_val_score(lm, theta_0, y, cv=5, scoring=scoring)
-    val0 = cv0.mean()*-1
+    old_feature_arr = list(theta_new_dict['old_features'])
+    theta_0 = np.asarray(theta_old_dict['theta'], dtype=float)
+    y_vec = np.asarray(y, dtype=float).reshape(len(theta_0))
+    if max_pruning == -1:   max_pruning = theta_0.shape[1]
+
+    # constant columns do not enter the least squares problem
+    constant = np.ptp(theta_0, axis=0) == 0
+    engine = DeletionCV(theta_0[:, ~constant], y_vec, cv=cv, columns=np.nonzero(~constant)[0])
+    constant_columns = list(np.nonzero(constant)[0])
+
+    val0, deletions = engine.scores()
     theta_new_dict['val0'] = val0
-    
-    def prune(lm, theta_curr, y, val_0, curr_feature_arr, pruned_features, alpha):
-        '''
-        Single pruning pass
-        '''
-        for i, name in enumerate(curr_feature_arr):
-            theta_i = np.delete(theta_0, i, axis=1)
-            lm.fit(theta_i, y)
-            cv_i = cross_val_score(lm, theta_i, y, cv=5, scoring='neg_mean_squared_error')
-            val_i = cv_i.mean()*-1
-            
-            if val_i / val0 < 1 + alpha:
-                pruned_features.append(name)
-                theta_new_dict['xi'] = lm.coef_.T
-                return True, theta_i, val_i, pruned_features
-            
-            else:
-                return False, theta_curr, val_0, pruned_features
-    
-    theta_curr = theta_0.copy()
-    curr_feature_arr = old_feature_arr.copy()
-    pruned = True
+    curr_features = list(range(theta_0.shape[1]))
+    selected, val_selected = list(curr_features), val0
+    trace = [{'removed': None, 'num_features': len(curr_features), 'val': val0,
+              'ratio': 1.0, 'accepted': True, 'candidates': {}}]
     num_pruned = 0
-    if max_pruning == -1:   max_pruning = theta_0.shape[1]
-    while pruned and num_pruned <= max_pruning:
-        pruned, theta_curr, val_curr, pruned_features = prune(lm, theta_curr, y, val0, curr_feature_arr, pruned_features, alpha)
-        for elem in curr_feature_arr:
-            if elem in pruned_features:
-                curr_feature_arr.remove(elem)
-        if pruned:
+    accepting = True
+
+    while len(curr_features) > 1 and (accepting or full_trace):
+        val_curr, deletions = engine.scores()
+        candidates = dict(zip(engine.columns, deletions))
+        candidates.update({c: val_curr for c in constant_columns})
+        best = min(candidates, key=candidates.get)
+        val_best = candidates[best]
+        accepting = accepting and val_best / val0 < 1 + alpha and num_pruned < max_pruning
+        if not (accepting or full_trace):
+            break
+
+        if best in constant_columns:
+            constant_columns.remove(best)
+        else:
+            engine.delete(engine.columns.index(best))
+        curr_features.remove(best)
+        trace.append({'removed': old_feature_arr[best], 'num_features': len(curr_features),
+                      'val': val_best, 'ratio': val_best / val0, 'accepted': accepting,
+                      'candidates': {old_feature_arr[c]: v for c, v in candidates.items()}})
+        if accepting:
             num_pruned += 1
-            
-    theta_new_dict['theta'] = theta_curr
+            selected, val_selected = list(curr_features), val_best
+
+    lm = LinearRegression()
+    lm.fit(theta_0[:, selected], y)
+    theta_new_dict['xi'] = lm.coef_.T
+    theta_new_dict['theta'] = theta_0[:, selected]
     theta_new_dict['pruned'] = True if num_pruned > 0 else False
-    theta_new_dict['features'] = []
-    for elem in old_feature_arr:
-        if elem not in pruned_features:
-            theta_new_dict['features'].append(elem)
-    theta_new_dict['val'] = val_curr
+    theta_new_dict['features'] = [old_feature_arr[i] for i in selected]
+    theta_new_dict['val'] = val_selected
     theta_new_dict['num_pruned'] = num_pruned
-    
-    return theta_new_dict
\ No newline at end of file
+    theta_new_dict['trace'] = pd.DataFrame(trace)
+
+    return theta_new_dict
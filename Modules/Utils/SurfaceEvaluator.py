@@ -0,0 +1,151 @@
+import os
+import hashlib
+import torch
+import numpy as np
+
+from Modules.Models.BuildEnsemble import StackedModule
+
+def grid_points(axes):
+
+    '''
+    Points of the tensor grid spanned by a list of 1D axes, ordered as
+    np.meshgrid(*axes, indexing='ij'), i.e. the surface of a grid with shape
+    (len(axes[0]), len(axes[1]), ...) is surface.reshape(-1) over the points.
+
+    Args:
+        axes (list): 1D arrays of the coordinates of every input.
+
+    Returns:
+        points (array): grid points with shape (n_points, len(axes)).
+    '''
+
+    mesh = np.meshgrid(*[np.atleast_1d(np.asarray(a, dtype=float)) for a in axes], indexing='ij')
+    return np.stack([m.ravel() for m in mesh], axis=1)
+
+def grid_hash(axes):
+
+    '''
+    Hash of the coordinates of a grid.
+    '''
+
+    h = hashlib.sha1()
+    for a in axes:
+        a = np.ascontiguousarray(np.atleast_1d(np.asarray(a, dtype=np.float64)))
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+def module_hash(module):
+
+    '''
+    Hash of the weights of a module, i.e. of the checkpoint it was loaded from.
+    '''
+
+    h = hashlib.sha1()
+    for name, value in sorted(module.state_dict().items()):
+        value = value.detach().cpu().contiguous()
+        h.update(name.encode())
+        h.update(str(value.dtype).encode())
+        h.update(str(tuple(value.shape)).encode())
+        h.update(value.numpy().tobytes())
+    return h.hexdigest()
+
+class SurfaceEvaluator():
+
+    '''
+    Evaluates the parameter networks (eta_func, beta_func, tau_func) of many
+    trained models, e.g. one BINN per Covasim replicate, on grids. The
+    networks of all models whose surfaces are not cached are stacked into one
+    StackedModule and evaluated in a single vmapped pass per batch under
+    torch.inference_mode. Every surface is cached on disk as
+    <function>_<weights hash>_<grid hash>.npy, so plots and regressions on
+    the same checkpoints and grids share one evaluation, also across runs.
+
+    Args:
+        models (list): trained models with the parameter networks as attributes.
+        cache_dir (str): directory of the surface cache, None disables caching.
+        batch_size (int): number of grid points per member and pass.
+
+    Inputs:
+        name (str): attribute name of the network, e.g. 'eta_func'.
+        grids (list): one grid (a list of 1D axes) for all models, or one grid
+            per model, all with the same shape.
+
+    Returns:
+        surfaces (array): raw network outputs with shape (n_models, *grid shape).
+    '''
+
+    def __init__(self, models, cache_dir=None, batch_size=100000):
+
+        self.models = list(models)
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.hashes = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def weights_hash(self, name, k):
+
+        if (name, k) not in self.hashes:
+            self.hashes[(name, k)] = module_hash(getattr(self.models[k], name))
+        return self.hashes[(name, k)]
+
+    def cache_file(self, name, k, axes):
+
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, '{0}_{1}_{2}.npy'.format(
+            name, self.weights_hash(name, k)[:16], grid_hash(axes)[:16]))
+
+    def evaluate(self, name, members, grids):
+
+        '''
+        Evaluates the network name of the given members on their grids in
+        one stacked pass per batch of grid points.
+        '''
+
+        modules = [getattr(self.models[k], name) for k in members]
+        parameter = next(modules[0].parameters())
+        stacked = StackedModule(modules).to(parameter.device).eval()
+        points = np.stack([grid_points(grids[k]) for k in members])
+        outputs = []
+        with torch.inference_mode():
+            for start in range(0, points.shape[1], self.batch_size):
+                x = torch.as_tensor(points[:, start:start + self.batch_size].reshape(-1, points.shape[-1]),
+                                    dtype=parameter.dtype, device=parameter.device)
+                y = stacked(x)
+                outputs.append(y.reshape(len(members), -1).cpu().numpy())
+        return np.concatenate(outputs, axis=1)
+
+    def __call__(self, name, grids):
+
+        # one grid for all models or one grid per model
+        if np.ndim(grids[0][0]) == 0:
+            grids = [grids] * len(self.models)
+        if len(grids) != len(self.models):
+            raise ValueError('got {0} grids for {1} models'.format(len(grids), len(self.models)))
+        shape = tuple(len(np.atleast_1d(a)) for a in grids[0])
+        if any(tuple(len(np.atleast_1d(a)) for a in g) != shape for g in grids):
+            raise ValueError('all grids must have the same shape')
+
+        surfaces = np.empty((len(self.models), int(np.prod(shape))), dtype=np.float32)
+        missing = []
+        for k in range(len(self.models)):
+            file_name = self.cache_file(name, k, grids[k])
+            if file_name is not None and os.path.exists(file_name):
+                surfaces[k] = np.load(file_name).reshape(-1)
+            else:
+                missing.append(k)
+
+        if missing:
+            surfaces[missing] = self.evaluate(name, missing, grids)
+            for k in missing:
+                file_name = self.cache_file(name, k, grids[k])
+                if file_name is None:
+                    continue
+                # write and rename, so concurrent readers never see partial files
+                tmp_name = file_name[:-4] + '_{0}.tmp.npy'.format(os.getpid())
+                np.save(tmp_name, surfaces[k].reshape(shape))
+                os.replace(tmp_name, file_name)
+
+        return surfaces.reshape((len(self.models),) + shape)
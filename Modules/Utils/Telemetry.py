@@ -0,0 +1,199 @@
+import gc
+import sys
+import json
+import time
+import warnings
+import torch
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+def peak_rss():
+
+    '''
+    Returns the peak resident set size of the process in MB (None if the
+    resource module is not available).
+    '''
+
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+def count_tensors():
+
+    '''
+    Counts the tensors tracked by the garbage collector (slow for large
+    processes, hence optional).
+    '''
+
+    count = 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for obj in gc.get_objects():
+            try:
+                if torch.is_tensor(obj):
+                    count += 1
+            except Exception:
+                pass
+
+    return count
+
+class Telemetry():
+
+    '''
+    ModelWrapper callback that writes per-epoch timing and memory metrics as
+    JSON lines to <save_name>_telemetry.jsonl (or file_name). Timings come
+    from ModelWrapper.timings, which times data slicing and cloning, forward
+    pass, loss, backward pass, optimizer step, validation (with its forward 
+    passes and losses under validation_forward and validation_loss), plotting
+    and checkpointing. If the model has gls_loss/pde_loss methods (e.g. the
+    BINNs) these are timed as well (validation_gls_loss etc. in validation).
+    Every phase is timed exclusively (e.g. optimizer excludes the forward and 
+    backward passes of its closure, loss excludes pde_loss), and the rest of 
+    the epoch is recorded as other, so the phases add up to the epoch time. 
+    Memory metrics are the peak RSS of the process, the CUDA peak memory and
+    CUDA allocation counts (only recorded on CUDA, there is no CPU allocation
+    counter), and optionally the number of live tensors. Use 
+    summarize_telemetry to aggregate a file.
+
+    Args:
+        file_name      (str): Output file, defaults to save_name + '_telemetry.jsonl'.
+        count_tensors (bool): If True, counts live tensors every epoch.
+        sync          (bool): If True, synchronizes CUDA before reading timings.
+
+    Inputs:
+        wrapper (ModelWrapper): Model wrapper being trained.
+    '''
+
+    def __init__(self, file_name=None, count_tensors=False, sync=True):
+
+        self.file_name = file_name
+        self.count_tensors = count_tensors
+        self.sync = sync
+        self.epoch = 0
+        self.file = None
+
+        # callback flags, see ModelWrapper.fit
+        self.on_train_begin = True
+        self.on_epoch_begin = True
+        self.on_batch_begin = False
+        self.on_batch_end = False
+        self.on_epoch_end = True
+        self.on_train_end = True
+
+    def wrap(self, wrapper, name):
+
+        '''
+        Times a model method by shadowing it with an instance attribute.
+        '''
+
+        method = getattr(wrapper.model, name)
+        def timed(*args, **kwargs):
+            with wrapper.timed(('validation_' if wrapper.val else '') + name):
+                return method(*args, **kwargs)
+        setattr(wrapper.model, name, timed)
+        self.wrapped.append(name)
+
+    def train_begin(self, wrapper):
+
+        if self.file_name is None:
+            self.file_name = wrapper.save_name + '_telemetry.jsonl'
+        self.file = open(self.file_name, 'a')
+        self.wrapped = []
+        for name in ['gls_loss', 'pde_loss']:
+            if hasattr(wrapper.model, name):
+                self.wrap(wrapper, name)
+        self.cuda = torch.cuda.is_available()
+        self.pending = False
+
+    def epoch_begin(self, wrapper):
+
+        if self.sync and self.cuda:
+            torch.cuda.synchronize()
+        wrapper.timings.clear()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+            self.cuda_allocs = torch.cuda.memory_stats().get('allocation.all.allocated', 0)
+        self.start_time = time.perf_counter()
+        self.pending = True
+
+    def epoch_end(self, wrapper):
+
+        if self.sync and self.cuda:
+            torch.cuda.synchronize()
+        record = {'epoch': self.epoch,
+                  'time': time.perf_counter() - self.start_time}
+        record.update({k: v for k, v in wrapper.timings.items()})
+        record['other'] = max(record['time'] - sum(wrapper.timings.values()), 0.0)
+        if len(wrapper.train_loss_list) > 0:
+            record['train_loss'] = float(wrapper.train_loss_list[-1])
+        if len(wrapper.val_loss_list) > 0:
+            record['val_loss'] = float(wrapper.val_loss_list[-1])
+        record['peak_rss_mb'] = peak_rss()
+        if self.cuda:
+            stats = torch.cuda.memory_stats()
+            record['cuda_peak_mb'] = torch.cuda.max_memory_allocated() / 1024**2
+            record['cuda_allocations'] = stats.get('allocation.all.allocated', 0) - self.cuda_allocs
+        if self.count_tensors:
+            record['live_tensors'] = count_tensors()
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.epoch += 1
+        self.pending = False
+
+    def train_end(self, wrapper):
+
+        # the last epoch skips on_epoch_end when early stopping breaks the loop
+        if self.pending:
+            self.epoch_end(wrapper)
+        for name in self.wrapped:
+            delattr(wrapper.model, name)
+        self.file.close()
+
+    def __call__(self, wrapper):
+
+        # dispatch on the hook that invoked the callback
+        {'on_train_begin': self.train_begin,
+         'on_epoch_begin': self.epoch_begin,
+         'on_epoch_end': self.epoch_end,
+         'on_train_end': self.train_end}[wrapper.phase](wrapper)
+
+def summarize_telemetry(file_name, skip=1):
+
+    '''
+    Summarizes a telemetry file written by Telemetry: the median time per
+    epoch of every phase, its mean share of the epoch time, and the final memory
+    metrics. The phases are exclusive, so their shares sum to 1 (the time row
+    is the whole epoch). The first skip epochs (warm-up) are excluded.
+
+    Args:
+        file_name (str): Path of the JSON lines file.
+        skip      (int): Number of initial epochs to exclude.
+
+    Returns:
+        summary (DataFrame): Median/mean seconds and share per phase.
+    '''
+
+    df = pd.read_json(file_name, lines=True)
+    df = df.iloc[skip:] if len(df) > skip else df
+    phases = [c for c in df.columns if c not in
+              ['epoch', 'train_loss', 'val_loss', 'peak_rss_mb', 'cuda_peak_mb',
+               'cuda_allocations', 'live_tensors']]
+    # phases that did not run in an epoch (e.g. plotting) took no time
+    times = df[phases].fillna(0.0)
+    summary = pd.DataFrame({
+        'median_s': times.median(),
+        'mean_s': times.mean(),
+        'share': times.mean() / times['time'].mean()})
+    for c in ['peak_rss_mb', 'cuda_peak_mb', 'cuda_allocations', 'live_tensors']:
+        if c in df.columns:
+            summary.loc[c] = [df[c].iloc[-1], np.nan, np.nan]
+
+    return summary
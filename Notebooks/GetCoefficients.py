@@ -4,6 +4,7 @@ import torch
 from Modules.Utils.GetLowestGPU import *
 from utils import get_case_name
 import Modules.Loaders.DataFormatter as DF
+from Modules.Utils.CoefficientStore import CoefficientStore, from_directory, from_table
 import os
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -25,20 +26,22 @@ n_runs = 100
 n_samples = 50
 params = DF.load_covasim_data(path, population, test_prob, trace_prob, case_name + '_' + str(n_runs), plot=False)
 parameter_names = ['eta', 'beta', 'tau']
-dict_parameter = {}
 terms = {'eta': [r'$\beta_0$', 'S', 'S^2', 'A', 'Y'], 'beta': [r'$\beta_0$', 'S + A + Y', r'$\chi$'], 'tau': [r'$\beta_0$', 'A', 'Y']}
-for pn_idx, parameter_name in enumerate(parameter_names):
-    list_parameter = []
-    for i in range(n_samples): # loop through each sample
-        # mydir = '../models/covasim/2023-05-01_01-46-08'  # piecewise
-        # mydir = '../models/covasim/2023-02-06_10-51-59'  # constant
-        mydir = '../models/covasim/2023-05-01_17-03-03'  # sin
-        # mydir = '../models/covasim/2023-05-01_01-21-08'  # constant
-        save_path = os.path.join(mydir, case_name, str(i))
-        list_parameter.append(pd.read_csv(os.path.join(save_path, case_name + '_regression_coef_' + parameter_name + '.csv'), index_col=[0]))
-    df_concat = pd.concat(list_parameter, axis=1)
-    df_concat.index = terms[parameter_name]
-    dict_parameter[parameter_name] = df_concat
+# mydir = '../models/covasim/2023-05-01_01-46-08'  # piecewise
+# mydir = '../models/covasim/2023-02-06_10-51-59'  # constant
+mydir = '../models/covasim/2023-05-01_17-03-03'  # sin
+# mydir = '../models/covasim/2023-05-01_01-21-08'  # constant
+store = CoefficientStore(os.path.join(mydir, 'coefficients.db'))
+if case_name not in store.keys('case_name'):
+    # convert the older layouts, a consolidated CSV table or one CSV per replicate and parameter
+    table_path = os.path.join(mydir, case_name, 'regression_coefs.csv')
+    if os.path.exists(table_path):
+        from_table(store, table_path)
+    else:
+        from_directory(store, mydir, case_name, range(n_samples))
+dict_parameter = store.coefficient_dict(case_name, parameter_names)
+for parameter_name in parameter_names:
+    dict_parameter[parameter_name].index = terms[parameter_name]
 file_name = 'estimated_coefs.joblib'
 joblib.dump(dict_parameter, os.path.join(mydir, case_name, file_name), compress=True)
 # visualization
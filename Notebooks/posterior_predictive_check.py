@@ -1,4 +1,3 @@
-import joblib
 import numpy as np
 import pandas as pd
 import torch
@@ -10,9 +9,10 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.covariance import empirical_covariance
 from scipy.linalg import block_diag
-import Modules.Utils.PDESolver as PDESolver
+from Modules.Utils.EquationCompiler import CompiledEquations
+from Modules.Utils.CoefficientStore import CoefficientStore, from_joblib
+from Modules.Utils.PosteriorPredictive import sample_coefficients, predictive_bands, coverage
 from Modules.Models.BuildBINNs import BINNCovasim
-import scipy
 
 device = torch.device(GetLowestGPU(pick_from=[0,1,2,3]))
 path = '../Data/covasim_data/xin_data/'
@@ -33,8 +33,10 @@ mydir = '../models/covasim/2023-05-01_01-46-08' # piecewise
 # mydir = '../models/covasim/2023-05-01_17-03-03' # sin
 # mydir = '../models/covasim/2023-05-01_01-21-08'  # constant
 
-file_name = 'estimated_coefs.joblib'
-estimated_coefs = joblib.load(os.path.join(mydir, case_name, file_name))
+store = CoefficientStore(os.path.join(mydir, 'coefficients.db'))
+if case_name not in store.keys('case_name'):
+    from_joblib(store, os.path.join(mydir, case_name, 'estimated_coefs.joblib'), case_name)
+estimated_coefs = store.coefficient_dict(case_name, ['eta', 'beta', 'tau'])
 
 # grab initial condition
 data = params['data'][0]
@@ -43,7 +45,6 @@ N = len(data)
 t_max = N - 1
 t = np.arange(N)
 u0 = data[0, :].copy()
-RHS = PDESolver.STEAYDQRF_RHS_dynamic
 binn = BINNCovasim(params, t_max, None, keep_d=keep_d).to(device)
 weights = binn.weights_c.detach().numpy()
 params['yita_lb'] = binn.yita_lb
@@ -53,48 +54,24 @@ params['beta_ub'] = binn.beta_ub
 params['tau_lb'] = binn.tau_lb
 params['tau_ub'] = binn.tau_ub
 
-def get_r0(parameters, **fixed_parameters):
-    eta_coefs = parameters[:5]
-    s, a, y = 1, 0, 0
-    features = [np.ones_like(a), s, s ** 2, a, y]
-    features = np.array(features)
-    eta0 = features @ eta_coefs
+def get_r0(samples, **fixed_parameters):
+    # R0 of a (n_samples, n_coefs) matrix of coefficients, eta at s, a, y = 1, 0, 0
+    eta0 = samples[:, :5] @ np.array([1, 1, 1, 0, 0])
     eta0 = fixed_parameters['yita_lb'] + (fixed_parameters['yita_ub'] - fixed_parameters['yita_lb']) * eta0
     r0 = fixed_parameters['p_asymp'] * eta0 / fixed_parameters['lamda']  + (1-fixed_parameters['p_asymp']) * eta0 / (fixed_parameters['lamda'] + fixed_parameters['mu'] + fixed_parameters['delta'])
     return r0
 
-def get_rt(r0, s):
-    return r0 * s.reshape(-1,1)
+def rt_transform(u, samples):
+    # compartments and R(t) = R0 S(t) as a 10th output of every trajectory
+    rt = get_r0(samples, **params)[:, None, None] * u[:, :, :1]
+    return np.concatenate([u, rt], axis=2)
 
-def competition_model(parameters, **fixed_parameters):
-    """Return the simulated trajectories."""
-    eta, beta, tau = parameters[:5], parameters[5:-3], parameters[-3:]
-
-    def contact_rate_regression(u):
-        s, a, y = u[:, 0][:, None], u[:, 1][:, None], u[:, 2][:, None]
-        features = [np.ones_like(a), s, s ** 2, a, y]  #
-        features = np.concatenate(features, axis=1)
-        res = features @ eta
-        return res
-
-    def beta_regression(u):
-        a, b = u[:, 0][:, None], u[:, 1][:, None]
-        features = [np.ones_like(a), a, b]  #
-        features = np.concatenate(features, axis=1)
-        res = features @ beta
-        return res
-
-    def tau_regression(u):
-        a, b = u[:, 0][:, None], u[:, 1][:, None]
-        features = [np.ones_like(a), a, b]  #
-        features = np.concatenate(features, axis=1)
-        res = features @ tau
-        return res
-    u_sim_regression = PDESolver.STEAYDQRF_sim(RHS, u0, t, contact_rate_regression, beta_regression, tau_regression,
-                                               fixed_parameters, chi_type)
-    u_sim_regression *= population
-
-    return u_sim_regression
+# eta, beta and tau regression models compiled into one jitted RHS,
+# coefficients are [eta (5), beta (3), tau (3)] as in the coefficient store
+equations = CompiledEquations(eta_terms=['1', 'S', 'S^2', 'A', 'Y'],
+                              beta_terms=['1', 's', 'x'],
+                              tau_terms=['1', 'A', 'Y'],
+                              chi_type=chi_type)
 
 
 # # sample mean as the mean
@@ -113,62 +90,40 @@ cov_matrix = empirical_covariance(concat_coefs.T)
 # concatenate first
 # mean_vec = np.concatenate([eta_mean, beta_mean, tau_mean])
 # cov_matrix = block_diag(*[eta_cov_matrix, beta_cov_matrix, tau_cov_matrix])
-cov_matrix *= 64
 
+n_prior_samples = 20000
+data_simulated = equations.simulate(u0, t, mean_vec, params) * population
+samples_X = sample_coefficients(mean_vec, cov_matrix, n_prior_samples, scale=64)
 
-data_simulated = competition_model(parameters = mean_vec, **params)
-samples_X = np.random.multivariate_normal(mean_vec, cov_matrix, 500)
-samples_Y = [competition_model(parameters= vec, **params) for vec in samples_X]
-samples_r0 = [get_r0(parameters=vec, **params) for vec in samples_X]
-samples_S_comp = [tmp[:, 0] / population for tmp in samples_Y]
-samples_rt = [get_rt(r0_val, S_comp_val) for r0_val, S_comp_val in zip(samples_r0, samples_S_comp)]
-
-
-def distance(simulated, obs):
-    return np.sqrt(np.nanmean(((simulated - obs)/population * weights) ** 2))
+# streamed 95% quantile bands of the prior predictive, the distances of the
+# prior samples to the training mean are computed in the same pass
 train_data = params['data'][:n_samples]
 train_data_mean = sum(train_data) / len(train_data)
-train_data_mean = train_data_mean.to_numpy()
-samples_dis = [distance(sample, train_data_mean) for sample in samples_Y]
+train_data_mean = train_data_mean.to_numpy() / population
+prior_bands = predictive_bands(equations, u0, t, samples_X, params, target=train_data_mean, weights=weights)
+print('failed integrations: {0}'.format(prior_bands.n_failed))
+
+# rejection step (ABC): keep the 10% of samples closest to the training mean
+samples_dis = prior_bands.distances
 threshold = np.quantile(samples_dis, 0.1)
-valid = np.array(samples_dis) < threshold
+valid = samples_dis < threshold
 posterior_samples_X = samples_X[valid]
-posterior_samples_Y = []
-posterior_samples_rt = []
-for idx, tmp in enumerate(samples_Y):
-    if valid[idx]:
-        posterior_samples_Y.append(tmp)
-        posterior_samples_rt.append(samples_rt[idx])
-posterior_samples_Y_mean = sum(posterior_samples_Y) / len(posterior_samples_Y)
-prior_samples_Y_mean = sum(samples_Y) / len(samples_Y)
-
-posterior_samples_rt_mean = sum(posterior_samples_rt) / len(posterior_samples_rt)
 
-def confidence_interval(data, confidence=0.95):
-    a = 1.0 * np.array(data)
-    n = a.shape[1]
-    m, se = np.mean(a, axis=1), np.std(a, axis=1)
-    h = se * scipy.stats.t.ppf((1 + confidence) / 2., n-1)
-    print(max(se))
-    return m, m-h, m+h
+# posterior predictive bands of the compartments and R(t) in one pass
+posterior_bands = predictive_bands(equations, u0, t, samples_X, params, transform=rt_transform, accept=valid)
 
-n_compartments = posterior_samples_Y_mean.shape[1]
-def get_CI(list_arrays, n_compartments):
-    list_lb, list_ub = [], []
-    for i in range(n_compartments):
-        cur_data = [tmp[:, i] for tmp in list_arrays]
-        cur_data = np.stack(cur_data, axis=1)
-        _, cur_lb, cur_ub = confidence_interval(cur_data)
-        list_lb.append(cur_lb)
-        list_ub.append(cur_ub)
-    lb_array = np.stack(list_lb, axis=1)
-    ub_array = np.stack(list_ub, axis=1)
-    return lb_array, ub_array
+posterior_samples_Y_mean = posterior_bands.mean[:, :9] * population
+prior_samples_Y_mean = prior_bands.mean * population
+posterior_samples_Y_lb, posterior_samples_Y_ub = posterior_bands.quantile([0.025, 0.975])[:, :, :9] * population
+prior_samples_Y_lb, prior_samples_Y_ub = prior_bands.quantile([0.025, 0.975]) * population
 
-posterior_samples_Y_lb, posterior_samples_Y_ub = get_CI(posterior_samples_Y, n_compartments)
-prior_samples_Y_lb, prior_samples_Y_ub = get_CI(samples_Y, n_compartments)
+posterior_samples_rt_mean = posterior_bands.mean[:, 9:]
+posterior_samples_rt_lb, posterior_samples_rt_ub = posterior_bands.quantile([0.025, 0.975])[:, :, 9:]
 
-posterior_samples_rt_lb, posterior_samples_rt_ub = get_CI(posterior_samples_rt, 1)
+# coverage of the held-out Covasim replicates
+test_data = np.stack([params['data'][idx].to_numpy() for idx in range(n_samples, n_runs)])
+print('posterior 95% band coverage of the test replicates:')
+print(coverage(posterior_bands, test_data / population))
 
 
 # fig = plt.figure(figsize=(15, 15))
@@ -4,19 +4,15 @@ import numpy as np
 from Modules.Utils.Imports import *
 from Modules.Models.BuildBINNs import BINNCovasim
 from Modules.Utils.ModelWrapper import ModelWrapper
+from Modules.Utils.CoefficientStore import CoefficientStore
+from Modules.Utils.SurfaceEvaluator import SurfaceEvaluator, grid_points
 
 import Modules.Utils.PDESolver as PDESolver
 import Modules.Loaders.DataFormatter as DF
-from utils import get_case_name, lasso_parameter_fitting
+from utils import get_case_name, fit_replicates, plot_lasso_fit
 import seaborn as sns
 # sns.set(font_scale=1.2, style='white')
 from sklearn import linear_model
-# helper functions
-def to_torch(x):
-    return torch.from_numpy(x).float().to(device)
-def to_numpy(x):
-    return x.detach().cpu().numpy()
-
 
 device = torch.device(GetLowestGPU(pick_from=[0,1,2,3]))
 # instantiate BINN
@@ -33,6 +29,14 @@ case_name = get_case_name(population, test_prob, trace_prob, keep_d, dynamic=dyn
 n_runs = 100
 n_samples = 50
 params = DF.load_covasim_data(path, population, test_prob, trace_prob, case_name + '_' + str(n_runs), plot=False)
+# mydir = '../models/covasim/2023-05-01_01-46-08' # piecewise
+# mydir = '../models/covasim/2023-02-06_23-32-15' # sin
+# mydir = '../models/covasim/2023-02-08_15-12-05'  # sin
+mydir = '../models/covasim/2023-05-01_17-03-03'  # sin
+# mydir = '../models/covasim/2023-05-01_01-21-08'  # constant
+
+# load the trained model of every sample and the value ranges of its data
+binns, save_paths, ranges = [], [], []
 for i in range(n_samples): # loop through each sample
     data = params['data'][i]
     data = (data / params['population']).to_numpy()
@@ -41,83 +45,89 @@ for i in range(n_samples): # loop through each sample
     t = np.arange(N)
     # params.pop('data')
     tracing_array = params['tracing_array']
-    # mydir = '../models/covasim/2023-05-01_01-46-08' # piecewise
-    # mydir = '../models/covasim/2023-02-06_23-32-15' # sin
-    # mydir = '../models/covasim/2023-02-08_15-12-05'  # sin
-    mydir = '../models/covasim/2023-05-01_17-03-03'  # sin
-    # mydir = '../models/covasim/2023-05-01_01-21-08'  # constant
     binn = BINNCovasim(params, t_max, tracing_array, keep_d=keep_d).to(device)
-    parameters = binn.parameters()
     model = ModelWrapper(binn, None, None, save_name=os.path.join(mydir, case_name, str(i)))
 
     # load model weights
-
     model.save_name += '_best_val'
     model.load(model.save_name + '_model', device=device)
-    save_path = model.save_folder
-    # grab initial condition
-    u0 = data[0, :].copy()
+    binns.append(binn)
+    save_paths.append(model.save_folder)
 
     # grab value ranges
-    yita_lb, yita_ub = model.model.yita_lb, model.model.yita_ub
-    beta_lb, beta_ub = model.model.beta_lb, model.model.beta_ub
-    tau_lb, tau_ub = model.model.tau_lb, model.model.tau_ub
-
-    # learned contact_rate function
-    def contact_rate(u):
-        res = binn.eta_func(to_torch(u)) # [:,[0,3,4]]
-        return to_numpy(res)
-
-    def beta(u):
-        res = binn.beta_func(to_torch(u))
-        return to_numpy(res)
-
-    def tau(u):
-        res = binn.tau_func(to_torch(u))
-        return to_numpy(res)
-
-    #%% visualization for eta
-    s_min, s_max = data[:,0].min(), data[:,0].max()
+    ranges.append({'s': (data[:,0].min(), data[:,0].max()),
+                   'a': (data[:,3].min(), data[:,3].max()),
+                   'y': (data[:,4].min(), data[:,4].max())})
     # a_min, a_max = 0.0, 0.015 # data[:,3].min(), data[:,3].max()
     # y_min, y_max = 0.0, 0.015 # data[:,4].min(), data[:,4].max()
-    a_min, a_max = data[:,3].min(), data[:,3].max()
-    y_min, y_max = data[:,4].min(), data[:,4].max()
-    # chi_min, chi_max = 0.0, params['eff_ub']
 
-    a_grid = np.linspace(s_min, s_max, 10)
-    b_grid = np.linspace(a_min, a_max, 10)
-    c_grid = np.linspace(y_min, y_max, 10)
+# value ranges
+yita_lb, yita_ub = binns[0].yita_lb, binns[0].yita_ub
+beta_lb, beta_ub = binns[0].beta_lb, binns[0].beta_ub
+tau_lb, tau_ub = binns[0].tau_lb, binns[0].tau_ub
+chi_min, chi_max = 0.05, params['eff_ub']
+
+# grids of every sample, each surface is evaluated for all samples in one stacked no-grad pass
+# and cached on disk, plots and regression inputs read the same surfaces
+def eta_axes(r):
+    return [np.linspace(*r['s'], 10), np.linspace(*r['a'], 10), np.linspace(*r['y'], 10)]
+
+def eta_slice_axes(r, j):
+    # fixes input j at the mean of its grid
+    axes = eta_axes(r)
+    axes[j] = np.array([axes[j].mean()])
+    return axes
+
+def tau_axes(r):
+    return [np.linspace(*r['a'], 10), np.linspace(*r['y'], 10)]
+
+beta_axes = [np.linspace(0.5, 1.0, 10), np.linspace(chi_min, chi_max, 10)] # D + R + F, chi
+evaluator = SurfaceEvaluator(binns, cache_dir=os.path.join(mydir, case_name, 'surfaces'))
+eta_slices = {j: evaluator('eta_func', [eta_slice_axes(r, j) for r in ranges]) for j in range(3)}
+eta_surfaces = evaluator('eta_func', [eta_axes(r) for r in ranges])
+beta_surfaces = evaluator('beta_func', beta_axes)
+tau_surfaces = evaluator('tau_func', [tau_axes(r) for r in ranges])
+
+def get_samples_ct(u):
+    s, a, y =  u[:, 0][:, None], u[:, 1][:, None], u[:, 2][:, None]
+    candidates = [s, s**2, a, y] # s related terms
+    # candidates += [a]
+    # candidates += [y]
+    # candidates += [chi]
+    candidates = np.concatenate(candidates, axis=1)
+    return candidates
+
+def get_samples_beta(u):
+    drf, chi = u[:, 0][:, None], u[:, 1][:, None]
+    candidates = [drf, chi] # , chi**2
+    candidates = np.concatenate(candidates, axis=1)
+    return candidates
+
+def get_samples_tau(u):
+    a, y = u[:, 0][:, None], u[:, 1][:, None]
+    candidates = [a, y]
+    candidates = np.concatenate(candidates, axis=1)
+    return candidates
+
+lasso_tasks = []
+for i in range(n_samples): # loop through each sample
+    save_path = save_paths[i]
+
+    #%% visualization for eta
     labels = ['S', 'A', 'Y']
-    # for 3 inputs
+    # for 3 inputs, (plotted inputs, fixed input) of each slice
     fig = plt.figure(figsize=(10,7))
-    for i in range(3):
-        if i == 0:
-            X, Y = np.meshgrid(a_grid, b_grid)
-            Z = np.ones_like(X) * c_grid.mean()
-            x_label, y_label = labels[0], labels[1]
-        elif i == 1:
-            X, Z = np.meshgrid(a_grid, c_grid)
-            Y = np.ones_like(X) * b_grid.mean()
-            x_label, y_label = labels[0], labels[2]
-        else:
-            Y, Z = np.meshgrid(b_grid, c_grid)
-            X = np.ones_like(Y) * a_grid.mean()
-            x_label, y_label = labels[1], labels[2]
-        u_grid = np.stack([np.ravel(X), np.ravel(Y), np.ravel(Z)], axis=1)
-        res = contact_rate(u_grid)
+    for j, (free, fixed) in enumerate([((0, 1), 2), ((0, 2), 1), ((1, 2), 0)]):
+        axes = eta_slice_axes(ranges[i], fixed)
+        X, Y = np.meshgrid(axes[free[0]], axes[free[1]], indexing='ij')
+        x_label, y_label = labels[free[0]], labels[free[1]]
+        res = eta_slices[fixed][i].reshape(X.shape)
         res = yita_lb + (yita_ub - yita_lb) * res  # scaling
-        res = res[:,0].reshape(X.shape)
         res = np.round(res, decimals=6)
-        ax = fig.add_subplot(1, 3, i + 1, projection='3d')
-        if i == 0:
-            ax.plot_surface(X, Y, res, cmap=cm.coolwarm, alpha=1)
-            ax.scatter(X.reshape(-1), Y.reshape(-1), res.reshape(-1), s=5, c='k')
-        elif i == 1:
-            ax.plot_surface(X, Z, res, cmap=cm.coolwarm, alpha=1)
-            ax.scatter(X.reshape(-1), Z.reshape(-1), res.reshape(-1), s=5, c='k')
-        else:
-            ax.plot_surface(Y, Z, res, cmap=cm.coolwarm, alpha=1)
-            ax.scatter(Y.reshape(-1), Z.reshape(-1), res.reshape(-1), s=5, c='k')
+        ax = fig.add_subplot(1, 3, j + 1, projection='3d')
+        ax.plot_surface(X, Y, res, cmap=cm.coolwarm, alpha=1)
+        ax.scatter(X.reshape(-1), Y.reshape(-1), res.reshape(-1), s=5, c='k')
+        if j == 2:
             plt.setp(ax.get_xticklabels(), rotation=15) # , ha="right", rotation_mode="anchor"
         ax.set_xlabel(x_label)
         ax.set_ylabel(y_label)
@@ -128,17 +138,11 @@ for i in range(n_samples): # loop through each sample
     plt.close()
 
     #%% visualization for beta
-    chi_min, chi_max = 0.05, params['eff_ub']
-
-    a_grid = np.linspace(0.5, 1.0, 10) # D + R + F
-    b_grid = np.linspace(chi_min, chi_max, 10)
     labels = ['S + A + Y', r'$h(t)$']
 
-    X, Y = np.meshgrid(a_grid, b_grid)
+    X, Y = np.meshgrid(*beta_axes, indexing='ij')
     x_label, y_label = labels[0], labels[1]
-    u_grid = np.stack([np.ravel(X), np.ravel(Y)], axis=1)
-    res = beta(u_grid) * params['n_contacts'] # * u_grid[:, [1]] *
-    res = res[:,0].reshape(X.shape)
+    res = beta_surfaces[i] * params['n_contacts'] # * u_grid[:, [1]] *
     res = np.round(res, decimals=6)
     # res = beta_lb + (beta_ub - beta_lb) * res
 
@@ -155,16 +159,11 @@ for i in range(n_samples): # loop through each sample
     plt.close()
 
     #%% visualization for tau
-
-    a_grid = np.linspace(a_min, a_max, 10)
-    b_grid = np.linspace(y_min, y_max, 10)
     labels = ['A', 'Y']
 
-    X, Y = np.meshgrid(a_grid, b_grid)
+    X, Y = np.meshgrid(*tau_axes(ranges[i]), indexing='ij')
     x_label, y_label = labels[0], labels[1]
-    u_grid = np.stack([np.ravel(X), np.ravel(Y)], axis=1)
-    res = tau(u_grid)
-    res = res[:,0].reshape(X.shape)
+    res = tau_surfaces[i]
     res = tau_lb + (tau_ub - tau_lb) * res # scaling
     res = np.round(res, decimals=4)
 
@@ -178,60 +177,35 @@ for i in range(n_samples): # loop through each sample
     plt.savefig(os.path.join(save_path, case_name + '_parameter_NN_tau' + '.png'), dpi=300, bbox_inches='tight') #
     plt.close()
 
-    def get_samples_ct(u):
-        s, a, y =  u[:, 0][:, None], u[:, 1][:, None], u[:, 2][:, None]
-        candidates = [s, s**2, a, y] # s related terms
-        # candidates += [a]
-        # candidates += [y]
-        # candidates += [chi]
-        candidates = np.concatenate(candidates, axis=1)
-        return candidates
-
-    def get_samples_beta(u):
-        drf, chi = u[:, 0][:, None], u[:, 1][:, None]
-        candidates = [drf, chi] # , chi**2
-        candidates = np.concatenate(candidates, axis=1)
-        return candidates
-
-    def get_samples_tau(u):
-        a, y = u[:, 0][:, None], u[:, 1][:, None]
-        candidates = [a, y]
-        candidates = np.concatenate(candidates, axis=1)
-        return candidates
-
-    s_grid = np.linspace(s_min, s_max, 10)
-    a_grid = np.linspace(a_min, a_max, 10)
-    y_grid = np.linspace(y_min, y_max, 10)
-    train_x = np.array(np.meshgrid(s_grid, a_grid, y_grid)).T.reshape(-1,3)
+    #%% regression inputs from the same surfaces
+    train_x = grid_points(eta_axes(ranges[i]))
     data_x = get_samples_ct(train_x)
-    data_y = contact_rate(train_x)
-    data_y = data_y[:,0][:, None]
+    data_y = eta_surfaces[i].reshape(-1, 1)
     # data_y = yita_lb + (yita_ub - yita_lb) * data_y
 
     term_names = ['S', 'S^2', 'A', 'Y'] #
-    lasso_parameter_fitting(data_x, data_y, 'eta', save_path, case_name, True, term_names)
-
+    lasso_tasks.append({'replicate': i, 'data_x': data_x, 'data_y': data_y, 'parameter_name': 'eta',
+                        'save_path': save_path, 'fit_intercept': True, 'term_names': term_names})
 
-    a_grid = np.linspace(0.5, 1.0, 10) # D + R + F
-    b_grid = np.linspace(chi_min, chi_max, 10)
     term_names = ['S + A + Y', r'$\chi$']
-    # c_grid = np.ones_like(a_grid) * chi_max
-    train_x = np.array(np.meshgrid(a_grid, b_grid)).T.reshape(-1,2)
+    train_x = grid_points(beta_axes)
     data_x = get_samples_beta(train_x)
-    data_y = beta(train_x)
-    data_y = data_y[:,0][:, None]
-    lasso_parameter_fitting(data_x[:, :], data_y, 'beta', save_path, case_name, True, term_names)
+    data_y = beta_surfaces[i].reshape(-1, 1)
+    lasso_tasks.append({'replicate': i, 'data_x': data_x[:, :], 'data_y': data_y, 'parameter_name': 'beta',
+                        'save_path': save_path, 'fit_intercept': True, 'term_names': term_names})
 
-    a_grid = np.linspace(a_min, a_max, 10)
-    b_grid = np.linspace(y_min, y_max, 10)
     term_names = ['A', 'Y']
-    # c_grid = np.ones_like(a_grid) * chi_max
-    train_x = np.array(np.meshgrid(a_grid, b_grid)).T.reshape(-1,2)
+    train_x = grid_points(tau_axes(ranges[i]))
     data_x = get_samples_tau(train_x)
-    data_y = tau(train_x)
-    data_y = data_y[:,0][:, None]
+    data_y = tau_surfaces[i].reshape(-1, 1)
     # data_y = tau_lb + (tau_ub - tau_lb) * data_y
-    lasso_parameter_fitting(data_x[:, :], data_y, 'tau', save_path, case_name, True, term_names)
-
+    lasso_tasks.append({'replicate': i, 'data_x': data_x[:, :], 'data_y': data_y, 'parameter_name': 'tau',
+                        'save_path': save_path, 'fit_intercept': True, 'term_names': term_names})
 
+# fit all replicates in a process pool, the workers append to one coefficient store
+store = CoefficientStore(os.path.join(mydir, 'coefficients.db'))
+table, results = fit_replicates(lasso_tasks, case_name, store=store)
 
+# the CV error and coefficient path figures are drawn here, once the pool has finished
+for task, result in zip(lasso_tasks, results):
+    plot_lasso_fit(result, task['save_path'], case_name, task['term_names'])
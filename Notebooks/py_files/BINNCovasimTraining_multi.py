@@ -6,8 +6,9 @@ import joblib
 sys.path.append('../')
 
 from Modules.Utils.Imports import *
-from Modules.Utils.ModelWrapper import ModelWrapper
-from Modules.Models.BuildBINNs import BINNCovasim
+from Modules.Utils.EnsembleWrapper import EnsembleWrapper, MemberReduceLROnPlateau
+from Modules.Models.BuildBINNs import AdaMaskBINNCovasim
+from Modules.Models.BuildEnsemble import BuildEnsemble
 
 import Modules.Loaders.DataFormatter as DF
 import datetime
@@ -53,7 +54,8 @@ epochs =  250 # int(10e4)
 batch_size = 128
 rel_save_thresh = 0.05
 
-# split into train/val and convert to torch
+# split each replicate into train/val and initialize one model per replicate
+x_train, y_train, x_val, y_val, binns, save_names = [], [], [], [], [], []
 for i in range(len(params['data'])): # loop through each sample
     data = params['data'][i]
     data = (data / params['population']).to_numpy()
@@ -61,57 +63,54 @@ for i in range(len(params['data'])): # loop through each sample
     N = len(data) # number of days
     split = int(0.8*N)
     p = np.random.permutation(N)
-    x_train = to_torch(p[:split][:, None]/(N-1))
-    y_train = to_torch(data[p[:split]])
-    x_val = to_torch(p[split:][:, None]/(N-1))
-    y_val = to_torch(data[p[split:]])
+    x_train.append(p[:split][:, None]/(N-1))
+    y_train.append(data[p[:split]])
+    x_val.append(p[split:][:, None]/(N-1))
+    y_val.append(data[p[split:]])
 
     # initialize model
-    binn = BINNCovasim(params, N - 1, tracing_array, keep_d=keep_d, chi_type=chi_type)
-    binn.to(device)
-
-    # compile
-    parameters = binn.parameters()
-    opt = torch.optim.Adam(parameters, lr=1e-3)
-    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(opt, patience=5e3)
+    binns.append(AdaMaskBINNCovasim(params, N - 1, tracing_array, chi_type=chi_type))
     os.makedirs(os.path.join(mydir, case_name, str(i)))
-    model = ModelWrapper(
-        model=binn,
-        optimizer=opt,
-        loss=binn.loss,
-        augmentation=None,
-        scheduler= scheduler,
-        save_name=os.path.join(mydir, case_name, str(i)) )
-    model.str_name = 'STEAYDQRF'
+    save_names.append(os.path.join(mydir, case_name, str(i)))
 
     # save the range information before training
+    binn = binns[-1]
     ranges = [binn.yita_lb, binn.yita_ub, binn.beta_lb, binn.beta_ub, binn.tau_lb, binn.tau_ub]
     file_name = '_'.join([str(m) for m in ranges])
-    joblib.dump(None, os.path.join(model.save_folder, file_name))
-    # load initial model after training on the first sample
-    if i != 0:
-        model_path = os.path.join(mydir, case_name, str(0))
-        model.load(model_path + '_best_val_model', device=device)
-        model.model.train()
-        # model.save_name += '_' + str(i)
-
-    # train jointly
-    model.fit(
-        x=x_train,
-        y=y_train,
-        batch_size=batch_size,
-        epochs=epochs,
-        callbacks=None,
-        verbose=1,
-        validation_data=[x_val, y_val],
-        early_stopping=40000,
-        rel_save_thresh=rel_save_thresh)
-
-# # fitting performance on training data
-# y_train_pred = to_numpy(model.predict(x_train))
-
-    # load training errors
-    total_train_losses = model.train_loss_list
-    total_val_losses = model.val_loss_list
-
-    plot_loss_convergence(total_train_losses, total_val_losses, rel_save_thresh, model.save_name)
+    joblib.dump(None, os.path.join(save_names[-1], file_name))
+
+# stack replicates along a leading member dimension
+x_train, y_train = to_torch(np.stack(x_train)), to_torch(np.stack(y_train))
+x_val, y_val = to_torch(np.stack(x_val)), to_torch(np.stack(y_val))
+
+# stack all replicate models into one ensemble, trained in lockstep
+ensemble = BuildEnsemble(binns)
+ensemble.to(device)
+
+# compile
+parameters = ensemble.parameters()
+opt = torch.optim.Adam(parameters, lr=1e-3)
+# per-member plateau schedule, as ReduceLROnPlateau for a single replicate
+scheduler = MemberReduceLROnPlateau(opt, len(binns), patience=5e3)
+model = EnsembleWrapper(
+    model=ensemble,
+    optimizer=opt,
+    loss=ensemble.loss,
+    scheduler=scheduler,
+    save_names=save_names)
+
+# train jointly
+model.fit(
+    x=x_train,
+    y=y_train,
+    batch_size=batch_size,
+    epochs=epochs,
+    verbose=1,
+    validation_data=[x_val, y_val],
+    early_stopping=40000,
+    rel_save_thresh=rel_save_thresh)
+
+# load training errors per replicate
+for i in range(len(save_names)):
+    total_train_losses, total_val_losses = model.member_losses(i)
+    plot_loss_convergence(total_train_losses, total_val_losses, rel_save_thresh, save_names[i])
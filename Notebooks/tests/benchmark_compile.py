@@ -0,0 +1,54 @@
+'''
+Benchmark of ModelWrapper training in eager mode vs. compiled mode
+(ModelWrapper(use_compile=...)), reported in epochs per second. Uses
+synthetic STEAYDQRF data so it runs without the Covasim data sets. Run from
+Notebooks/. Only the networks free of double backward (compile_modules, i.e.
+beta_func) are compiled, the rest of the BINN runs eagerly in both modes.
+'''
+
+import sys
+import time
+sys.path.append('../')
+
+import numpy as np
+import torch
+
+from Modules.Utils.ModelWrapper import ModelWrapper
+from Modules.Models.BuildBINNs import AdaMaskBINNCovasim
+
+torch.manual_seed(0)
+np.random.seed(0)
+device = torch.device('cpu')
+
+n_days = 183
+epochs = 50
+warmup = 5
+batch_size = 128
+
+# synthetic parameters and data (only the shapes matter for timing)
+params = {'population': 200000, 'alpha': 0.1, 'beta': 0.1, 'gamma': 0.2, 'mu': 0.1,
+          'lamda': 0.1, 'p_asymp': 0.3, 'n_contacts': 10, 'delta': 0.01,
+          'eff_ub': 0.3, 'avg_masking': None}
+tracing_array = np.linspace(0.0, 0.3, n_days)
+x = torch.arange(n_days, dtype=torch.float)[:, None] / (n_days - 1)
+y = torch.softmax(torch.randn(n_days, 9), dim=1)
+
+def epochs_per_second(use_compile):
+    binn = AdaMaskBINNCovasim(params, n_days - 1, tracing_array, chi_type='piecewise').to(device)
+    opt = torch.optim.Adam(binn.parameters(), lr=1e-3)
+    model = ModelWrapper(model=binn, optimizer=opt, loss=binn.loss, use_compile=use_compile)
+
+    # warm up (includes compilation)
+    model.fit(x=x, y=y, batch_size=batch_size, epochs=warmup, verbose=0)
+
+    start = time.time()
+    model.fit(x=x, y=y, batch_size=batch_size, epochs=epochs, verbose=0)
+    return epochs / (time.time() - start)
+
+if __name__ == '__main__':
+    modes = {'eager': False,
+             'compiled': True,
+             'captured': {'backend': 'eager'}}
+    rates = {name: epochs_per_second(use_compile) for name, use_compile in modes.items()}
+    for name, rate in rates.items():
+        print('{0:<9} {1:.2f} epochs/s ({2:.2f}x)'.format(name + ':', rate, rate / rates['eager']))
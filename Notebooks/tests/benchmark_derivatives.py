@@ -0,0 +1,60 @@
+'''
+Benchmark of DerivativeEstimator.estimate_derivatives against the ad-hoc
+preprocessing of the denoised notebooks (replicate mean, then savgol_filter
+or central differences, days 1 to T - 2), on synthetic noisy replicates of
+STEAYDQRF-like curves. Run from Notebooks/.
+'''
+
+import sys
+import time
+import tempfile
+sys.path.append('../')
+
+import numpy as np
+from scipy.signal import savgol_filter
+
+from Modules.Loaders.DerivativeEstimator import estimate_derivatives
+
+n_replicates = 2048
+T = 183
+rng = np.random.default_rng(0)
+t = np.arange(T, dtype=float)
+curves = np.stack([np.exp(-t / (60 + 10 * c)) + 0.1 * np.sin(t / (20 + c)) for c in range(9)], axis=1)
+replicates = curves[None] * (1 + 0.05 * rng.standard_normal((n_replicates, T, 9)))
+
+def legacy(data, dmethod):
+    # as in ParameterNNTraining_denoised.ipynb
+    data_smooth = np.mean(data, axis=0)
+    N = len(data_smooth) - 2
+    u = data_smooth[1:N+1, :]
+    if dmethod == 'cfd':
+        ut = (data_smooth[2:, :] - data_smooth[:N, :]) / 2.
+    else:
+        ut = savgol_filter(data_smooth, 15, 3, deriv=1, axis=0)[1:N+1, :]
+    return np.stack([u, ut], axis=2)
+
+if __name__ == '__main__':
+    for dmethod, method in [('cfd', 'fd'), ('savgol', 'savgol')]:
+        start = time.time()
+        old = legacy(replicates, dmethod)
+        t_old = time.time() - start
+        start = time.time()
+        new = estimate_derivatives(replicates, method)['u_tensor'].double().numpy()
+        t_new = time.time() - start
+        print('{0:7s} legacy {1:.3f} s, new {2:.3f} s, max abs. difference {3:.2e}'.format(
+            method, t_old, t_new, np.abs(new - old).max()))
+
+    cache_dir = tempfile.mkdtemp()
+    for method in ['fd', 'savgol', 'spline']:
+        start = time.time()
+        result = estimate_derivatives(replicates, method, n_bootstrap=200, seed=0,
+                                      cache_dir=cache_dir, dataset='synthetic')
+        t_first = time.time() - start
+        start = time.time()
+        estimate_derivatives(replicates, method, n_bootstrap=200, seed=0,
+                             cache_dir=cache_dir, dataset='synthetic')
+        t_cached = time.time() - start
+        print('{0:7s} {1:.3f} s with 200 bootstrap resamples, {2:.4f} s cached, '
+              'mean bootstrap std. of ut {3:.2e}, u_tensor {4}'.format(
+                  method, t_first, t_cached, np.sqrt(result['ut_var']).mean(),
+                  tuple(result['u_tensor'].shape)))
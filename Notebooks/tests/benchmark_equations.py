@@ -0,0 +1,76 @@
+'''
+Benchmark of compiled sparse equations (EquationCompiler) against
+PDESolver.STEAYDQRF_sim with the regression closures of
+BINNCovasimEvaluation_dynamic, for a single trajectory and a batch of
+perturbed coefficient vectors. The compiled solution is evaluated at the
+same nearest-grid times as STEAYDQRF_sim. Run from Notebooks/.
+'''
+
+import sys
+import time
+sys.path.append('../')
+
+import numpy as np
+
+import Modules.Utils.PDESolver as PDESolver
+from Modules.Utils.EquationCompiler import CompiledEquations
+
+params = {'population': 200000, 'alpha': 0.1, 'gamma': 0.2, 'mu': 0.1, 'lamda': 0.1,
+          'p_asymp': 0.3, 'n_contacts': 10, 'delta': 0.01, 'eff_ub': 0.3,
+          'avg_masking': None, 'yita_lb': 0.0, 'yita_ub': 1.0, 'tau_lb': 0.0,
+          'tau_ub': 0.5}
+chi_type = 'piecewise'
+t = np.arange(183.0)
+u0 = np.array([0.99, 0.0, 0.005, 0.003, 0.002, 0.0, 0.0, 0.0, 0.0])
+regression_coefs_cr = np.array([0.1, 0.2, 0.1, 0.5, 0.3])
+regression_coefs_qt = np.array([0.2, 0.1, 0.3])
+regression_coefs_tau = np.array([0.1, 0.2, 0.2])
+n_batch = 1000
+
+def contact_rate_regression(u):
+    s, a, y = u[:, 0][:, None], u[:, 1][:, None], u[:, 2][:, None]
+    features = np.concatenate([np.ones_like(a), s, s**2, a, y], axis=1)
+    return features @ regression_coefs_cr
+
+def beta_regression(u):
+    a, b = u[:, 0][:, None], u[:, 1][:, None]
+    features = np.concatenate([np.ones_like(a), a, b], axis=1)
+    return features @ regression_coefs_qt
+
+def tau_regression(u):
+    a, b = u[:, 0][:, None], u[:, 1][:, None]
+    features = np.concatenate([np.ones_like(a), a, b], axis=1)
+    return features @ regression_coefs_tau
+
+if __name__ == '__main__':
+    equations = CompiledEquations(eta_terms=['1', 'S', 'S^2', 'A', 'Y'],
+                                  beta_terms=['1', 's', 'x'],
+                                  tau_terms=['1', 'A', 'Y'],
+                                  chi_type=chi_type)
+    coefs = np.concatenate([regression_coefs_cr, regression_coefs_qt, regression_coefs_tau])
+
+    # output times of STEAYDQRF_sim (nearest points of a 1000 point grid)
+    t_sim = np.linspace(t.min(), t.max(), 1000)
+    t_out = t_sim[np.abs(t[:, None] - t_sim[None, :]).argmin(axis=1)]
+
+    start = time.time()
+    u_ref = PDESolver.STEAYDQRF_sim(PDESolver.STEAYDQRF_RHS_dynamic_DRUMS, u0, t,
+                                    contact_rate_regression, beta_regression,
+                                    tau_regression, params, chi_type)
+    t_ref = time.time() - start
+
+    equations.simulate(u0, t_out, coefs, params) # jit compilation
+    start = time.time()
+    u_new = equations.simulate(u0, t_out, coefs, params)
+    t_new = time.time() - start
+
+    samples = coefs + 0.01 * np.random.default_rng(0).standard_normal((n_batch, len(coefs)))
+    equations.simulate(u0, t_out, samples[:2], params)
+    start = time.time()
+    equations.simulate(u0, t_out, samples, params)
+    t_batch = (time.time() - start) / n_batch
+
+    print('STEAYDQRF_sim:       {0:.2e} s/trajectory'.format(t_ref))
+    print('compiled:            {0:.2e} s/trajectory ({1:.0f}x)'.format(t_new, t_ref / t_new))
+    print('compiled, batch {0}: {1:.2e} s/trajectory ({2:.0f}x)'.format(n_batch, t_batch, t_ref / t_batch))
+    print('max abs. difference: {0:.2e}'.format(np.abs(u_new - u_ref).max()))
@@ -0,0 +1,60 @@
+'''
+Check and benchmark of PruneEquation.DeletionCV against brute-force
+cross_val_score(LinearRegression()) refits along the backward elimination
+path, for a well-conditioned library, a degree-3 polynomial library and a
+rank-deficient library (duplicated and linearly dependent features), with
+k-fold and leave-one-out CV. Run from Notebooks/.
+'''
+
+import sys
+import time
+sys.path.append('../')
+
+import numpy as np
+from sklearn.linear_model import LinearRegression
+from sklearn.model_selection import cross_val_score, LeaveOneOut
+from sklearn.preprocessing import PolynomialFeatures
+
+from Modules.Utils.PruneEquation import DeletionCV, PruneEquation
+
+rng = np.random.default_rng(0)
+
+def brute_force(theta, y, cv):
+    cv = LeaveOneOut() if cv == -1 else cv
+    return -cross_val_score(LinearRegression(), theta, y, cv=cv, scoring='neg_mean_squared_error').mean()
+
+def max_rel_error(theta, y, cv, steps=4):
+    # compares the CV MSE of the current features and of every deletion
+    engine = DeletionCV(theta, y, cv=cv)
+    error = 0.0
+    for _ in range(steps):
+        val, deletions = engine.scores()
+        cols = list(engine.columns)
+        ref = [brute_force(theta[:, cols], y, cv)]
+        ref += [brute_force(theta[:, [c for c in cols if c != d]], y, cv) for d in cols]
+        error = max(error, np.max(np.abs(np.hstack([val, deletions]) - ref) / np.abs(ref)))
+        engine.delete(int(np.argmin(deletions)))
+    return error
+
+def libraries(n=200):
+    x = rng.uniform(0, 1, (n, 3))
+    y = 1 + 2 * x[:, 0] - x[:, 1] * x[:, 2] + 0.01 * rng.standard_normal(n)
+    random = rng.standard_normal((n, 6))
+    poly = PolynomialFeatures(3, include_bias=False).fit_transform(x)
+    deficient = np.hstack([x, x[:, :1], x[:, :1] + 2 * x[:, 1:2], x ** 2])
+    return {'random': (random, random @ rng.standard_normal(6) + rng.standard_normal(n)),
+            'degree 3': (poly, y),
+            'rank-deficient': (deficient, y)}
+
+if __name__ == '__main__':
+    for name, (theta, y) in libraries().items():
+        for cv in [5, -1]:
+            print('{0:<15} cv={1:<3} max rel. error {2:.1e}'.format(name, cv, max_rel_error(theta, y, cv)))
+
+    # timing of a full elimination on a large degree-3 library
+    x = rng.uniform(0, 1, (2000, 6))
+    theta = PolynomialFeatures(3, include_bias=False).fit_transform(x)
+    y = 1 + x[:, 0] - 2 * x[:, 1] * x[:, 2] + 0.01 * rng.standard_normal(len(x))
+    start = time.time()
+    result = PruneEquation({'theta': theta, 'features': list(range(theta.shape[1]))}, y, alpha=0.1)
+    print('pruned {0} of {1} features in {2:.1f} s'.format(result['num_pruned'], theta.shape[1], time.time() - start))
@@ -0,0 +1,83 @@
+'''
+Benchmark of PDESolver.STEAYDQRF_sim (a single solve_ivp call with t_eval)
+against the previous step-by-step scipy ode('dopri5') loop, using linear
+regression models for eta, beta and tau as in BINNCovasimEvaluation_dynamic.
+Run from Notebooks/.
+'''
+
+import sys
+import time
+sys.path.append('../')
+
+import numpy as np
+from scipy import integrate
+
+import Modules.Utils.PDESolver as PDESolver
+
+params = {'population': 200000, 'alpha': 0.1, 'gamma': 0.2, 'mu': 0.1, 'lamda': 0.1,
+          'p_asymp': 0.3, 'n_contacts': 10, 'delta': 0.01, 'eff_ub': 0.3,
+          'avg_masking': None, 'yita_lb': 0.0, 'yita_ub': 1.0, 'tau_lb': 0.0,
+          'tau_ub': 0.5}
+chi_type = 'piecewise'
+t = np.arange(183.0)
+u0 = np.array([0.99, 0.0, 0.005, 0.003, 0.002, 0.0, 0.0, 0.0, 0.0])
+regression_coefs_cr = np.array([0.1, 0.2, 0.1, 0.5, 0.3])
+regression_coefs_qt = np.array([0.2, 0.1, 0.3])
+regression_coefs_tau = np.array([0.1, 0.2, 0.2])
+repeats = 5
+
+def contact_rate_regression(u):
+    s, a, y = u[:, 0][:, None], u[:, 1][:, None], u[:, 2][:, None]
+    features = np.concatenate([np.ones_like(a), s, s**2, a, y], axis=1)
+    return features @ regression_coefs_cr
+
+def beta_regression(u):
+    a, b = u[:, 0][:, None], u[:, 1][:, None]
+    features = np.concatenate([np.ones_like(a), a, b], axis=1)
+    return features @ regression_coefs_qt
+
+def tau_regression(u):
+    a, b = u[:, 0][:, None], u[:, 1][:, None]
+    features = np.concatenate([np.ones_like(a), a, b], axis=1)
+    return features @ regression_coefs_tau
+
+def legacy_sim(RHS, IC, t, eta_func, beta_func, tau_func, params, chi_type):
+    # previous implementation: dopri5 stepped through 1000 grid points
+    t_max = np.max(t)
+    t_sim = np.linspace(np.min(t), t_max, 1000)
+    for tp in t:
+        tp_ind = np.abs(tp - t_sim).argmin()
+        if tp == t[0]:
+            t_sim_write_ind = np.array(tp_ind)
+        else:
+            t_sim_write_ind = np.hstack((t_sim_write_ind, tp_ind))
+    def RHS_tu(t, u):
+        return RHS(t, u, eta_func, beta_func, tau_func, params, t_max, chi_type)
+    u = np.zeros((len(t), len(IC)))
+    u[0,:] = IC
+    write_count = 0
+    r = integrate.ode(RHS_tu).set_integrator("dopri5")
+    r.set_initial_value(u[0,:], t[0])
+    for i in range(1, t_sim.size):
+        if np.any(i == t_sim_write_ind):
+            write_count += 1
+            u[write_count, :] = r.integrate(t_sim[i])
+        else:
+            r.integrate(t_sim[i])
+    return u
+
+def timed(sim):
+    start = time.time()
+    for _ in range(repeats):
+        u = sim(PDESolver.STEAYDQRF_RHS_dynamic_DRUMS, u0, t, contact_rate_regression,
+                beta_regression, tau_regression, params, chi_type)
+    return u, (time.time() - start) / repeats
+
+if __name__ == '__main__':
+    u_legacy, t_legacy = timed(legacy_sim)
+    u_new, t_new = timed(PDESolver.STEAYDQRF_sim)
+    print('legacy ode loop:   {0:.3f} s/trajectory'.format(t_legacy))
+    print('solve_ivp t_eval:  {0:.3f} s/trajectory ({1:.1f}x)'.format(t_new, t_legacy / t_new))
+    print('max abs. difference: {0:.2e}'.format(np.abs(u_new - u_legacy).max()))
+    print('max rel. difference: {0:.2e}'.format(
+        (np.abs(u_new - u_legacy) / np.maximum(np.abs(u_legacy), 1e-8)).max()))
@@ -4,8 +4,7 @@ import pandas as pd
 import time
 import os
 
-from sklearn.linear_model import LassoCV, Lasso
-from sklearn.pipeline import make_pipeline
+from sklearn.linear_model import Lasso
 from sklearn.linear_model import lasso_path
 from itertools import cycle
 import covasim as cv
@@ -82,58 +81,88 @@ def plot_loss_convergence(total_train_losses, total_val_losses, rel_save_thresh,
     plt.savefig(os.path.join(file_path, 'train_loss.png'))
     # plt.show()
 
-def lasso_parameter_fitting(data_x, data_y, parameter_name, save_path, case_name, fit_intercept, term_names):
+def lasso_fold_path(x_train, y_train, alphas, fit_intercept):
+    # lasso path of a split, centered as in Lasso(fit_intercept=True), and the intercepts along it
+    x_offset = x_train.mean(axis=0) if fit_intercept else np.zeros(x_train.shape[1])
+    y_offset = y_train.mean() if fit_intercept else 0.0
+    alphas, coefs, _ = lasso_path(x_train - x_offset, y_train - y_offset, alphas=alphas, max_iter=10000)
+    return alphas, coefs, y_offset - x_offset @ coefs
+
+def lasso_parameter_fitting(data_x, data_y, parameter_name, save_path, case_name, fit_intercept, term_names,
+                            plot=True, save_csv=True, alphas=np.logspace(-6, -2), seed=None):
     print('We\'re in Lasso Parameter Fitting')
     
     N = len(data_x)
     split = int(0.8 * N)
-    p = np.random.permutation(N)
-    x_train = data_x[p[:split]]
-    y_train = data_y[p[:split]]
-    x_val = data_x[p[split:]]
-    y_val = data_y[p[split:]]
+    p = np.random.permutation(N) if seed is None else np.random.default_rng(seed).permutation(N)
+    data_y = data_y.reshape(-1)
 
-    # lasso CV
+    # lasso CV on 5 folds of the permutation, the last fold is the held out 20%, so the path of
+    # its training split is the coefficient path figure and gives the final model at the CV
+    # estimate of alpha (one path per fold, no refits)
     start_time = time.time()
-    model = make_pipeline(LassoCV(alphas=np.logspace(-6, -2), cv=5, max_iter=10000, fit_intercept=fit_intercept)).fit(
-        data_x, data_y)
+    folds = np.array_split(p[:split], 4) + [p[split:]]
+    mse_path = []
+    for k, test in enumerate(folds):
+        train = np.concatenate(folds[:k] + folds[k + 1:])
+        alphas_lasso, coefs_lasso, intercepts = lasso_fold_path(data_x[train], data_y[train], alphas, fit_intercept)
+        residuals = data_y[test][:, None] - data_x[test] @ coefs_lasso - intercepts
+        mse_path.append((residuals ** 2).mean(axis=0))
+    mse_path = np.stack(mse_path, axis=1)
+    best = np.argmin(mse_path.mean(axis=1))
     fit_time = time.time() - start_time
-    ymin, ymax = 2300, 3800
-    lasso = model[-1]
+
+    coef = coefs_lasso[:, best]
+    if fit_intercept:
+        coefs = np.concatenate(([intercepts[best]], coef))
+    else:
+        coefs = coef
+
+    result = {'parameter_name': parameter_name,
+              'alphas': alphas_lasso,
+              'mse_path': mse_path,
+              'alpha': alphas_lasso[best],
+              'fit_time': fit_time,
+              'alphas_lasso': alphas_lasso,
+              'coefs_lasso': coefs_lasso,
+              'coefs': coefs,
+              'terms': (['intercept'] if fit_intercept else []) + list(term_names)}
+
+    if plot:
+        plot_lasso_fit(result, save_path, case_name, term_names)
+    if save_csv:
+        pd.DataFrame(coefs).to_csv(os.path.join(save_path, case_name + '_regression_coef_' + parameter_name + '.csv'))
+
+    return result
+
+def plot_lasso_fit(result, save_path, case_name, term_names):
+    # CV error and coefficient path figures of a lasso_parameter_fitting result
+    parameter_name = result['parameter_name']
     plt.figure()
-    plt.semilogx(lasso.alphas_, lasso.mse_path_, linestyle=":")
+    plt.semilogx(result['alphas'], result['mse_path'], linestyle=":")
     plt.plot(
-        lasso.alphas_,
-        lasso.mse_path_.mean(axis=-1),
+        result['alphas'],
+        result['mse_path'].mean(axis=-1),
         color="black",
         label="Average across the folds",
         linewidth=2,
     )
-    plt.axvline(lasso.alpha_, linestyle="--", color="black", label="alpha: CV estimate")
+    plt.axvline(result['alpha'], linestyle="--", color="black", label="alpha: CV estimate")
 
-    # plt.ylim(ymin, ymax)
     plt.xlabel(r"$\alpha$")
     plt.ylabel("Mean square error")
     plt.legend()
     _ = plt.title(
-        f"Mean square error on each fold: coordinate descent (train time: {fit_time:.2f}s)"
+        f"Mean square error on each fold: coordinate descent (train time: {result['fit_time']:.2f}s)"
     )
     plt.savefig(os.path.join(save_path, case_name + '_lassoCV_' + parameter_name + '.png'))
     plt.close()
 
-    eps = 5e-3  # the smaller it is the longer is the path
-
-    # lasso path
-    print("Computing regularization path using the lasso...")
-    alphas_lasso, coefs_lasso, _ = lasso_path(x_train, y_train.reshape(-1), alphas=np.logspace(-6, -2),
-                                              max_iter=10000, eps=eps)
     plt.figure()
     colors = cycle(["b", "r", "g", "c"])
-    # names = ['S', r'$S^2$', 'A', 'Y']
-    neg_log_alphas_lasso = alphas_lasso  # -np.log10(alphas_lasso)
-    for coef_l, c, name in zip(coefs_lasso, colors, term_names):
-        l1 = plt.semilogx(neg_log_alphas_lasso, coef_l, c=c, label=name)
-    plt.axvline(lasso.alpha_, linestyle="--", color="black", label="alpha: CV estimate")
+    for coef_l, c, name in zip(result['coefs_lasso'], colors, term_names):
+        l1 = plt.semilogx(result['alphas_lasso'], coef_l, c=c, label=name)
+    plt.axvline(result['alpha'], linestyle="--", color="black", label="alpha: CV estimate")
     plt.xlabel(r"$\alpha$")
     plt.ylabel("coefficients")
     plt.title("Lasso Paths")
@@ -142,16 +171,42 @@ def lasso_parameter_fitting(data_x, data_y, parameter_name, save_path, case_name
     plt.savefig(os.path.join(save_path, case_name + '_lassoPath_' + parameter_name + '.png'))
     plt.close()
 
-    final_lasso = Lasso(alpha=lasso.alpha_, max_iter=10000, fit_intercept=fit_intercept)
-    final_lasso.fit(x_train, y_train)
-    # final_lasso.coef_
-    if fit_intercept:
-        coefs = np.concatenate((final_lasso.intercept_, final_lasso.coef_))
-    else:
-        coefs = final_lasso.coef_
-
-
-    pd.DataFrame(coefs).to_csv(os.path.join(save_path, case_name + '_regression_coef_' + parameter_name + '.csv'))
+def fit_task(task, case_name, plot, store):
+    # one replicate and parameter, appended to the coefficient store by the worker itself
+    result = lasso_parameter_fitting(task['data_x'], task['data_y'], task['parameter_name'],
+                                     task['save_path'], case_name, task['fit_intercept'],
+                                     task['term_names'], plot=plot, save_csv=False,
+                                     seed=task.get('seed', task['replicate']))
+    if store is not None:
+        store.append(case_name, task['replicate'], result['parameter_name'], result['terms'], result['coefs'])
+    return result
+
+def fit_replicates(tasks, case_name, table_path=None, n_jobs=-1, plot=False, store=None):
+    """
+    Runs lasso_parameter_fitting for many (replicate, parameter) tasks in a process pool and
+    collects all coefficients in one long table with columns case_name, replicate, parameter,
+    term and coef instead of one CSV per replicate and parameter. Each task is a dict with the
+    keys replicate, data_x, data_y, parameter_name, save_path, fit_intercept and term_names, and
+    optionally seed (the seed of the train/validation split, defaults to the replicate index so
+    the fits are reproducible).
+    Figures are skipped unless plot=True; they can also be rendered later from the returned
+    results with plot_lasso_fit. If a CoefficientStore is given, every worker appends its
+    coefficients to it as soon as its fit is done.
+    """
+    from joblib import Parallel, delayed
+
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(fit_task)(task, case_name, plot, store) for task in tasks)
+
+    rows = []
+    for task, result in zip(tasks, results):
+        for term, coef in zip(result['terms'], result['coefs']):
+            rows.append((case_name, task['replicate'], result['parameter_name'], term, coef))
+    table = pd.DataFrame(rows, columns=['case_name', 'replicate', 'parameter', 'term', 'coef'])
+    if table_path is not None:
+        table.to_csv(table_path, index=False)
+
+    return table, results
 
 
 # def DRUMS_lasso(
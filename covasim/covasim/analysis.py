@@ -9,6 +9,7 @@ import pylab as pl
 import pandas as pd
 import sciris as sc
 from . import utils as cvu
+from . import defaults as cvd
 from . import misc as cvm
 from . import interventions as cvi
 from . import plotting as cvpl
@@ -152,10 +153,18 @@ class snapshot(Analyzer):
     in time, and saves them to itself. To retrieve them, you can either access
     the dictionary directly, or use the get() method.
 
+    By default, each snapshot is a full copy of the People object. With ``delta=True``,
+    only the first snapshot is copied in full; each later snapshot only stores the
+    array entries that changed since the previous one (as sparse indices and values),
+    the contact layers that were regenerated or modified, and the new infections.
+    The full People object is then reconstructed when it is requested via get(), so
+    memory use scales with the number of changes rather than the population size.
+
     Args:
         days   (list): list of ints/strings/date objects, the days on which to take the snapshot
         args   (list): additional day(s)
         die    (bool): whether or not to raise an exception if a date is not found (default true)
+        delta  (bool): whether to store only the changes between snapshots rather than full copies (default false)
         kwargs (dict): passed to Analyzer()
 
 
@@ -169,17 +178,28 @@ class snapshot(Analyzer):
         people = snapshot.get('2020-04-14')       # Option 3
         people = snapshot.get(34)                 # Option 4
         people = snapshot.get()                   # Option 5
+
+        # Store changes only; snapshots must then be retrieved with get()
+        sim = cv.Sim(analyzers=cv.snapshot(days=range(0, 60, 7), delta=True))
+        sim.run()
+        people = sim.get_analyzer().get(28)
     '''
 
-    def __init__(self, days, *args, die=True, **kwargs):
+    def __init__(self, days, *args, die=True, delta=False, **kwargs):
         super().__init__(**kwargs) # Initialize the Analyzer object
         days = sc.promotetolist(days) # Combine multiple days
         days.extend(args) # Include additional arguments, if present
         self.days      = days # Converted to integer representations
         self.die       = die  # Whether or not to raise an exception
+        self.delta     = delta # Whether to store changes rather than full copies
         self.dates     = None # String representations
         self.start_day = None # Store the start date of the simulation
         self.snapshots = sc.odict() # Store the actual snapshots
+        self.deltas    = sc.odict() # Store the changes between snapshots, if delta=True
+        self.base      = None # The first snapshot, which the deltas are applied to
+        self._prev     = None # Copies of the people arrays as of the previous snapshot
+        self._layers   = None # References to the contact layers as of the previous snapshot
+        self._n_log    = 0    # Length of the infection log as of the previous snapshot
         return
 
 
@@ -198,15 +218,123 @@ class snapshot(Analyzer):
     def apply(self, sim):
         for ind in cvi.find_day(self.days, sim.t):
             date = self.dates[ind]
-            self.snapshots[date] = sc.dcp(sim.people) # Take snapshot!
+            if self.delta:
+                self.deltas[date] = self.make_delta(sim.people) # Take snapshot of the changes only
+            else:
+                self.snapshots[date] = sc.dcp(sim.people) # Take snapshot!
 
 
     def finalize(self, sim):
         super().finalize()
-        validate_recorded_dates(sim, requested_dates=self.dates, recorded_dates=self.snapshots.keys(), die=self.die)
+        recorded = self.deltas if self.delta else self.snapshots
+        validate_recorded_dates(sim, requested_dates=self.dates, recorded_dates=recorded.keys(), die=self.die)
+        self._prev = None # These are only needed while the sim is running
+        self._layers = None
         return
 
 
+    @staticmethod
+    def _layer_refs(layer):
+        ''' References (not copies) to a layer and its arrays, used to check whether it has been modified '''
+        return (layer, [layer[k] for k in layer.keys()])
+
+
+    def make_delta(self, people):
+        '''
+        Record the changes in the people object since the previous snapshot. The
+        first call stores a full copy of the people, which later deltas are applied to.
+
+        Array changes are stored as flat indices and new values; layers listed in
+        ``dynam_layer`` are always stored, while other layers are only stored if
+        they have been replaced or resized (e.g. by ``cv.clip_edges()``).
+
+        Args:
+            people (People): the people object to record
+
+        Returns:
+            delta (objdict): the changes since the previous snapshot
+        '''
+        delta = sc.objdict(t=people.t, arrays={}, contacts={}, infections=None)
+        delta.attrs = sc.dcp(dict(flows=people.flows, flows_variant=people.flows_variant, _pending_quarantine=people._pending_quarantine))
+
+        # On the first snapshot, take a full copy
+        if self.base is None:
+            self.base    = sc.dcp(people)
+            self._prev   = {key:people[key].copy() for key in people.keys()}
+            self._layers = {lkey:self._layer_refs(layer) for lkey,layer in people.contacts.items()}
+            self._n_log  = len(people.infection_log)
+            return delta
+
+        # Store the array entries that have changed
+        for key in people.keys():
+            curr = people[key]
+            prev = self._prev[key]
+            if curr.shape != prev.shape: # The array has been resized, so store it in full
+                delta.arrays[key] = (None, curr.copy())
+                self._prev[key] = curr.copy()
+            else:
+                changed = curr != prev
+                if curr.dtype.kind == 'f':
+                    changed &= ~(np.isnan(curr) & np.isnan(prev)) # NaN != NaN, but these are unchanged
+                inds = np.flatnonzero(changed)
+                if len(inds):
+                    vals = curr.ravel()[inds]
+                    delta.arrays[key] = (inds.astype(cvd.default_int), vals)
+                    np.put(prev, inds, vals)
+
+        # Store contact layers that are dynamic or have been modified
+        dynam_layer = people.pars.get('dynam_layer', {})
+        for lkey,layer in people.contacts.items():
+            refs = self._layers.get(lkey)
+            modified = refs is None or refs[0] is not layer or any(a is not b for a,b in zip(refs[1], self._layer_refs(layer)[1]))
+            if dynam_layer.get(lkey) or modified:
+                delta.contacts[lkey] = sc.dcp(layer)
+            self._layers[lkey] = self._layer_refs(layer)
+        removed = set(self._layers.keys()) - set(people.contacts.keys())
+        for lkey in removed:
+            delta.contacts[lkey] = None
+            self._layers.pop(lkey)
+
+        # Store new infections
+        delta.infections = people.infection_log.subset(self._n_log)
+        self._n_log = len(people.infection_log)
+
+        return delta
+
+
+    def reconstruct(self, date):
+        '''
+        Rebuild the full people object for a date recorded with ``delta=True``, by
+        applying each delta in turn to a copy of the first snapshot.
+
+        Args:
+            date (str): the date of the snapshot to reconstruct
+
+        Returns:
+            people (People): the reconstructed people object
+        '''
+        people = sc.dcp(self.base)
+        for d,delta in self.deltas.items():
+            for key,(inds,vals) in delta.arrays.items():
+                if inds is None:
+                    people[key] = vals.copy()
+                else:
+                    np.put(people[key], inds, vals)
+            for lkey,layer in delta.contacts.items():
+                if layer is None:
+                    people.contacts.pop(lkey)
+                else:
+                    people.contacts[lkey] = sc.dcp(layer)
+            if delta.infections is not None:
+                people.infection_log.extend(delta.infections)
+            people.t = delta.t
+            for attr,val in delta.attrs.items():
+                setattr(people, attr, sc.dcp(val))
+            if d == date:
+                break
+        return people
+
+
     def get(self, key=None):
         ''' Retrieve a snapshot from the given key (int, str, or date) '''
         if key is None:
@@ -215,8 +343,11 @@ class snapshot(Analyzer):
         date = sc.date(day, start_date=self.start_day, as_date=False)
         if date in self.snapshots:
             snapshot = self.snapshots[date]
+        elif date in self.deltas:
+            snapshot = self.reconstruct(date)
         else: # pragma: no cover
-            dates = ', '.join(list(self.snapshots.keys()))
+            recorded = self.deltas if self.delta else self.snapshots
+            dates = ', '.join(list(recorded.keys()))
             errormsg = f'Could not find snapshot date {date} (day {day}): choices are {dates}'
             raise sc.KeyNotFoundError(errormsg)
         return snapshot
@@ -681,8 +812,8 @@ class daily_stats(Analyzer):
 
             # Source stats
             inflog = sim.people.infection_log
-            infloginds = [i for i,e in enumerate(inflog) if (e['date']==sim.t and e['source'] is not None)] # Person was infected today and was not a seed infection
-            sourceinds = list(set([inflog[i]['source'] for i in infloginds]))
+            today = (inflog['date'] == sim.t) & (inflog['source'] >= 0) # Person was infected today and was not a seed infection
+            sourceinds = np.unique(inflog['source'][today])
             stats.source.new_sources = len(sourceinds)
             for key in self.keys:
                 stats.source[key] = len(self.intersect(sourceinds, key))
@@ -1101,6 +1232,7 @@ class Fit(Analyzer):
             if self.die: raise sc.KeyNotFoundError(errormsg)
             else:        cvm.warn(errormsg)
 
+        sim_date_inds = {d:i for i,d in enumerate(self.sim_dates)} # Look up dates by hash rather than by searching the list
         for key in self.keys: # For keys present in both the results and in the data
             self.inds.sim[key]  = []
             self.inds.data[key] = []
@@ -1109,26 +1241,20 @@ class Fit(Analyzer):
             for d, datum in self.data[key].iteritems():
                 count += 1
                 if np.isfinite(datum):
-                    if d in self.sim_dates:
+                    if d in sim_date_inds:
                         self.date_matches[key].append(d)
-                        self.inds.sim[key].append(self.sim_dates.index(d))
+                        self.inds.sim[key].append(sim_date_inds[d])
                         self.inds.data[key].append(count)
-            self.inds.sim[key]  = np.array(self.inds.sim[key])
-            self.inds.data[key] = np.array(self.inds.data[key])
+            self.inds.sim[key]  = np.array(self.inds.sim[key], dtype=int)
+            self.inds.data[key] = np.array(self.inds.data[key], dtype=int)
 
         # Convert into paired points
         matches = 0 # Count how many data points match
         for key in self.keys:
             self.pair[key] = sc.objdict()
-            sim_inds = self.inds.sim[key]
-            data_inds = self.inds.data[key]
-            n_inds = len(sim_inds)
-            self.pair[key].sim  = np.zeros(n_inds)
-            self.pair[key].data = np.zeros(n_inds)
-            for i in range(n_inds):
-                matches += 1
-                self.pair[key].sim[i]  = self.sim_results[key].values[sim_inds[i]]
-                self.pair[key].data[i] = self.data[key].values[data_inds[i]]
+            matches += len(self.inds.sim[key])
+            self.pair[key].sim  = np.array(self.sim_results[key].values[self.inds.sim[key]], dtype=float)
+            self.pair[key].data = np.array(self.data[key].values[self.inds.data[key]], dtype=float)
 
         # Process custom inputs
         self.custom_keys = list(self.custom.keys())
@@ -1197,7 +1323,7 @@ class Fit(Analyzer):
                 if sc.isiterable(weight): # It's an array
                     len_wt = len(weight)
                     len_sim = self.sim_npts
-                    len_match = len(self.gofs[key])
+                    len_match = np.shape(self.gofs[key])[-1] # Along the last axis, in case the fit is batched over sims
                     if len_wt == len_match: # If the weight already is the right length, do nothing
                         pass
                     elif len_wt == len_sim: # Most typical case: it's the length of the simulation, must trim
@@ -1213,12 +1339,13 @@ class Fit(Analyzer):
 
     def compute_mismatch(self, use_median=False):
         ''' Compute the final mismatch '''
-        for key in self.losses.keys():
+        for key,losses in self.losses.items():
+            axis = -1 if np.ndim(losses) else None # Reduce over time, in case the fit is batched over sims
             if use_median:
-                self.mismatches[key] = np.median(self.losses[key])
+                self.mismatches[key] = np.median(losses, axis=axis)
             else:
-                self.mismatches[key] = np.sum(self.losses[key])
-        self.mismatch = self.mismatches[:].sum()
+                self.mismatches[key] = np.sum(losses, axis=axis)
+        self.mismatch = np.sum(list(self.mismatches.values()), axis=0)
         return self.mismatch
 
 
@@ -1361,6 +1488,9 @@ class Calibration(Analyzer):
         n_trials     (int)  : the number of trials per worker
         n_workers    (int)  : the number of parallel workers (default: maximum
         total_trials (int)  : if n_trials is not supplied, calculate by dividing this number by n_workers)
+        n_reps       (int)  : the number of replicates (with consecutive random seeds) to run for each trial; the trial mismatch is their mean (default: 1)
+        checkpoints  (int/list): if supplied, the days (or dates) at which to report the mismatch so far (of the first replicate) to Optuna, so that poor trials can be pruned early; if an integer, use this many evenly spaced days
+        pruner       (Pruner): the Optuna pruner to use with checkpoints (default: median pruner)
         name         (str)  : the name of the database (default: 'covasim_calibration')
         db_name      (str)  : the name of the database file (default: 'covasim_calibration.db')
         keep_db      (bool) : whether to keep the database after calibration (default: false)
@@ -1381,12 +1511,15 @@ class Calibration(Analyzer):
         calib.calibrate()
         calib.plot()
 
+        # Average over 3 seeds per trial, and prune poor trials at 4 checkpoints
+        calib = cv.Calibration(sim, calib_pars, total_trials=100, n_reps=3, checkpoints=4)
+
     New in version 3.0.3.
     '''
 
     def __init__(self, sim, calib_pars=None, fit_args=None, custom_fn=None, par_samplers=None,
-                 n_trials=None, n_workers=None, total_trials=None, name=None, db_name=None,
-                 keep_db=None, storage=None, label=None, die=False, verbose=True):
+                 n_trials=None, n_workers=None, total_trials=None, n_reps=None, checkpoints=None, pruner=None,
+                 name=None, db_name=None, keep_db=None, storage=None, label=None, die=False, verbose=True):
         super().__init__(label=label) # Initialize the Analyzer object
 
         import multiprocessing as mp # Import here since it's also slow
@@ -1394,12 +1527,13 @@ class Calibration(Analyzer):
         # Handle run arguments
         if n_trials  is None: n_trials  = 20
         if n_workers is None: n_workers = mp.cpu_count()
+        if n_reps    is None: n_reps    = 1
         if name      is None: name      = 'covasim_calibration'
         if db_name   is None: db_name   = f'{name}.db'
         if keep_db   is None: keep_db   = False
         if storage   is None: storage   = f'sqlite:///{db_name}'
         if total_trials is not None: n_trials = total_trials/n_workers
-        self.run_args   = sc.objdict(n_trials=int(n_trials), n_workers=int(n_workers), name=name, db_name=db_name, keep_db=keep_db, storage=storage)
+        self.run_args   = sc.objdict(n_trials=int(n_trials), n_workers=int(n_workers), n_reps=int(n_reps), name=name, db_name=db_name, keep_db=keep_db, storage=storage)
 
         # Handle other inputs
         self.sim          = sim
@@ -1407,6 +1541,8 @@ class Calibration(Analyzer):
         self.fit_args     = sc.mergedicts(fit_args)
         self.par_samplers = sc.mergedicts(par_samplers)
         self.custom_fn    = custom_fn
+        self.checkpoints  = checkpoints
+        self.pruner       = pruner
         self.die          = die
         self.verbose      = verbose
         self.calibrated   = False
@@ -1421,12 +1557,13 @@ class Calibration(Analyzer):
         return
 
 
-    def run_sim(self, calib_pars, label=None, return_sim=False):
-        ''' Create and run a simulation '''
+    def make_sim(self, calib_pars, label=None, rep=0):
+        ''' Create a simulation with the calibration parameters, using the random seed for this replicate '''
         sim = self.sim.copy()
         if label: sim.label = label
         valid_pars = {k:v for k,v in calib_pars.items() if k in sim.pars}
         sim.update_pars(valid_pars)
+        sim['rand_seed'] = self.sim['rand_seed'] + rep
         if self.custom_fn:
             sim = self.custom_fn(sim, calib_pars)
         else:
@@ -1434,18 +1571,118 @@ class Calibration(Analyzer):
                 extra = set(calib_pars.keys()) - set(valid_pars.keys())
                 errormsg = f'The following parameters are not part of the sim, nor is a custom function specified to use them: {sc.strjoin(extra)}'
                 raise ValueError(errormsg)
+        return sim
+
+
+    def get_checkpoints(self):
+        ''' Convert the checkpoints to a sorted array of days strictly within the sim '''
+        npts = self.sim.npts
+        if self.checkpoints is None:
+            days = []
+        elif sc.isnumber(self.checkpoints):
+            days = np.linspace(0, npts, int(self.checkpoints)+2)[1:-1] # Evenly spaced, excluding the start and end
+        else:
+            days = [self.sim.day(day) for day in sc.tolist(self.checkpoints)]
+        days = np.unique(np.round(days).astype(int))
+        return days[(days > 0) & (days < npts)]
+
+
+    @staticmethod
+    def partial_sim(sim, keys=None):
+        '''
+        Return a lightweight copy of a partially run sim, truncated to the days run
+        so far, with its results scaled, accumulated, and computed as in sim.finalize().
+        This allows the fit to be computed at a checkpoint without copying the people.
+
+        Args:
+            sim (Sim): the partially run sim
+            keys (list): the keys to be fit; r_eff is only computed if it is one of them
+        '''
+        t = sim.t # The number of days that have been run
+        psim = object.__new__(sim.__class__)
+        psim.__dict__ = sim.__dict__.copy()
+        psim.pars = sc.mergedicts(sim.pars, {'n_days':t-1})
+        results = {}
+        for key in sim.result_keys():
+            res = sc.cp(sim.results[key])
+            res.values = sim.results[key].values[:t].copy()
+            if res.scale:
+                res.values *= sim.rescale_vec[:t]
+            results[key] = res
+        results['variant'] = {}
+        for key in sim.result_keys('variant'):
+            res = sc.cp(sim.results['variant'][key])
+            res.values = sim.results['variant'][key].values[:, :t].copy()
+            if res.scale:
+                res.values = np.einsum('ij,j->ij', res.values, sim.rescale_vec[:t])
+            results['variant'][key] = res
+        for key in cvd.result_flows.keys():
+            results[f'cum_{key}'].values[:] = np.cumsum(results[f'new_{key}'].values)
+        for key in cvd.result_flows_by_variant.keys():
+            results['variant'][f'cum_{key}'].values[:] = np.cumsum(results['variant'][f'new_{key}'].values, axis=1)
+        for res in [results['cum_infections'], results['variant']['cum_infections_by_variant']]: # Include initially infected people
+            res.values += sim['pop_infected']*sim.rescale_vec[0]
+        results['t'] = sim.results['t'][:t]
+        results['date'] = sim.results['date'][:t]
+        psim.results = results
+        psim.results_ready = True
+
+        # Recalculate the derived results, as in sim.compute_results()
+        psim.compute_states()
+        psim.compute_yield()
+        psim.compute_doubling()
+        if keys is not None and 'r_eff' in sc.tolist(keys): # This needs the people, so skip it unless it is being fit
+            psim.compute_r_eff()
+        return psim
+
+
+    @staticmethod
+    def has_data(sim):
+        ''' Check whether any of the data fall on the days the sim has run so far '''
+        if sim.data is None:
+            return True # Let the fit raise the error
+        dates = set(sim.datevec[:sim.t].tolist())
+        return any(date in dates for date in sim.data.index)
+
+
+    def run_sim(self, calib_pars, label=None, return_sim=False, trial=None):
+        '''
+        Create and run a simulation (or n_reps replicates, one after another). If an
+        Optuna trial is supplied and there are checkpoints, report the mismatch of the
+        first replicate so far at each checkpoint, and stop early if the trial should
+        be pruned.
+        '''
+        n_reps = 1 if return_sim else self.run_args.n_reps
+        checkpoints = self.get_checkpoints() if trial is not None else []
+        op = import_optuna() if len(checkpoints) else None
         try:
-            sim.run()
-            sim.compute_fit(**self.fit_args)
-            if return_sim:
-                return sim
-            else:
-                return sim.fit.mismatch
+            mismatches = []
+            for rep in range(n_reps):
+                # The random number generators are global, so each replicate is run to the end before the next one starts, so the results match a single run
+                sim = self.make_sim(calib_pars, label=label, rep=rep)
+                rep_checkpoints = checkpoints if rep == 0 else []
+                for c,checkpoint in enumerate(rep_checkpoints):
+                    sim.run(until=checkpoint, reset_seed=(c == 0)) # Only reset the seed at the start
+                    if not self.has_data(sim): # No data yet, so nothing to report
+                        continue
+                    psim = self.partial_sim(sim, keys=self.fit_args.get('keys'))
+                    mismatch = psim.compute_fit(**self.fit_args).mismatch
+                    trial.report(mismatch, step=int(checkpoint))
+                    if trial.should_prune():
+                        raise op.TrialPruned(f'Pruned at day {checkpoint} with mismatch {mismatch:n}')
+                sim.run(reset_seed=not len(rep_checkpoints))
+                sim.compute_fit(**self.fit_args)
+                if return_sim:
+                    return sim
+                mismatches.append(sim.fit.mismatch)
+            return np.mean(mismatches)
         except Exception as E:
-            if self.die:
+            if op is not None and isinstance(E, op.TrialPruned): # Let Optuna handle this
+                raise E
+            elif self.die:
                 raise E
             else:
-                warnmsg = f'Encountered error running sim!\nParameters:\n{valid_pars}\nTraceback:\n{sc.traceback()}'
+                warnmsg = f'Encountered error running sim!\nParameters:\n{calib_pars}\nTraceback:\n{sc.traceback()}'
                 cvm.warn(warnmsg)
                 output = None if return_sim else np.inf
                 return output
@@ -1464,7 +1701,7 @@ class Calibration(Analyzer):
             else:
                 sampler_fn = trial.suggest_uniform
             pars[key] = sampler_fn(key, low, high) # Sample from values within this range
-        mismatch = self.run_sim(pars)
+        mismatch = self.run_sim(pars, trial=trial)
         return mismatch
 
 
@@ -1475,11 +1712,31 @@ class Calibration(Analyzer):
             op.logging.set_verbosity(op.logging.DEBUG)
         else:
             op.logging.set_verbosity(op.logging.ERROR)
-        study = op.load_study(storage=self.run_args.storage, study_name=self.run_args.name)
+        study = op.load_study(storage=self.get_storage(), study_name=self.run_args.name, pruner=self.get_pruner())
         output = study.optimize(self.run_trial, n_trials=self.run_args.n_trials)
         return output
 
 
+    def get_storage(self):
+        ''' Get the storage; for SQLite, wait rather than fail if other workers have the database locked '''
+        op = import_optuna()
+        storage = self.run_args.storage
+        if isinstance(storage, str) and storage.startswith('sqlite'):
+            storage = op.storages.RDBStorage(url=storage, engine_kwargs={'connect_args':{'timeout':60}})
+        return storage
+
+
+    def get_pruner(self):
+        ''' Get the pruner: by default, the median pruner if there are checkpoints, else no pruning '''
+        op = import_optuna()
+        if self.pruner is not None:
+            return self.pruner
+        elif self.checkpoints is not None:
+            return op.pruners.MedianPruner()
+        else:
+            return op.pruners.NopPruner()
+
+
     def run_workers(self):
         ''' Run multiple workers in parallel '''
         if self.run_args.n_workers > 1: # Normal use case: run in parallel
@@ -1508,7 +1765,7 @@ class Calibration(Analyzer):
         op = import_optuna()
         if not self.run_args.keep_db:
             self.remove_db()
-        output = op.create_study(storage=self.run_args.storage, study_name=self.run_args.name)
+        output = op.create_study(storage=self.get_storage(), study_name=self.run_args.name, pruner=self.get_pruner())
         return output
 
 
@@ -1535,7 +1792,7 @@ class Calibration(Analyzer):
         t0 = sc.tic()
         self.make_study()
         self.run_workers()
-        self.study = op.load_study(storage=self.run_args.storage, study_name=self.run_args.name)
+        self.study = op.load_study(storage=self.get_storage(), study_name=self.run_args.name)
         self.best_pars = sc.objdict(self.study.best_params)
         self.elapsed = sc.toc(t0, output=True)
 
@@ -1583,15 +1840,18 @@ class Calibration(Analyzer):
         results = []
         n_trials = len(self.study.trials)
         failed_trials = []
+        pruned_trials = []
         for trial in self.study.trials:
             data = {'index':trial.number, 'mismatch': trial.value}
             for key,val in trial.params.items():
                 data[key] = val
-            if data['mismatch'] is None:
+            if trial.state.name == 'PRUNED':
+                pruned_trials.append(data['index'])
+            elif data['mismatch'] is None:
                 failed_trials.append(data['index'])
             else:
                 results.append(data)
-        print(f'Processed {n_trials} trials; {len(failed_trials)} failed')
+        print(f'Processed {n_trials} trials; {len(pruned_trials)} pruned, {len(failed_trials)} failed')
 
         keys = ['index', 'mismatch'] + list(best.keys())
         data = sc.objdict().make(keys=keys, vals=[])
@@ -1750,8 +2010,8 @@ def pairplotpars(data, inds=None, color_column=None, bounds=None, cmap='parula',
 class TransTree(Analyzer):
     '''
     A class for holding a transmission tree. There are several different representations
-    of the transmission tree: "infection_log" is copied from the people object and is the
-    simplest representation. "detailed h" includes additional attributes about the source
+    of the transmission tree: "infection_log" is taken from the people object and is the
+    simplest representation; "source_inds" and "target_inds" are arrays of each transmission. "detailed h" includes additional attributes about the source
     and target. If NetworkX is installed (required for most methods), "graph" includes an
     NX representation of the transmission tree.
 
@@ -1796,21 +2056,18 @@ class TransTree(Analyzer):
         # Include the basic line list -- copying directly is slow, so we'll make a copy later
         self.infection_log = people.infection_log
 
-        # Parse into sources and targets
-        self.sources = [None for i in range(self.pop_size)]
-        self.targets = [[]   for i in range(self.pop_size)]
-        self.source_dates = [None for i in range(self.pop_size)]
-        self.target_dates = [[]   for i in range(self.pop_size)]
-
-        for entry in self.infection_log:
-            source = entry['source']
-            target = entry['target']
-            date   = entry['date']
-            if source:
-                self.sources[target] = source # Each target has at most one source
-                self.targets[source].append(target) # Each source can have multiple targets
-                self.source_dates[target] = date # Each target has at most one source
-                self.target_dates[source].append(date) # Each source can have multiple targets
+        # Parse into sources and targets, skipping seed infections
+        log = self.infection_log
+        valid = log['source'] >= 0
+        self.source_inds = log['source'][valid]
+        self.target_inds = log['target'][valid]
+        self.transmission_dates = log['date'][valid]
+        self.source_arr = np.full(self.pop_size, -1, dtype=cvd.default_int) # Each target has at most one source
+        self.source_arr[self.target_inds] = self.source_inds
+        self.source_date_arr = np.full(self.pop_size, -1, dtype=cvd.default_int)
+        self.source_date_arr[self.target_inds] = self.transmission_dates
+        self.date_exposed = people.date_exposed.copy() # Used for r0
+        self.date_recovered = people.date_recovered.copy()
 
         # Count the number of targets each person has, and the list of transmissions
         self.count_targets()
@@ -1833,10 +2090,10 @@ class TransTree(Analyzer):
                     d[attr] = people[attr][i]
                 self.graph.add_node(i, **d)
 
-            # Next, add edges from linelist
-            for edge in people.infection_log:
-                if edge['source'] is not None: # Skip seed infections
-                    self.graph.add_edge(edge['source'],edge['target'],date=edge['date'],layer=edge['layer'])
+            # Next, add edges from linelist, skipping seed infections
+            layers = log.get('layer')[valid]
+            edges = zip(self.source_inds.tolist(), self.target_inds.tolist(), self.transmission_dates.tolist(), layers)
+            self.graph.add_edges_from((src, trg, dict(date=date, layer=layer)) for src,trg,date,layer in edges)
 
         return
 
@@ -1852,6 +2109,36 @@ class TransTree(Analyzer):
             return 0
 
 
+    @property
+    def sources(self):
+        ''' The source of each person, or None if they were not infected by someone '''
+        return [int(src) if src >= 0 else None for src in self.source_arr]
+
+
+    @property
+    def source_dates(self):
+        ''' The date each person was infected by their source, or None '''
+        return [int(date) if src >= 0 else None for src,date in zip(self.source_arr, self.source_date_arr)]
+
+
+    @property
+    def targets(self):
+        ''' The list of people each person infected '''
+        targets = [[] for i in range(self.pop_size)]
+        for src,trg in zip(self.source_inds.tolist(), self.target_inds.tolist()):
+            targets[src].append(trg)
+        return targets
+
+
+    @property
+    def target_dates(self):
+        ''' The dates on which each person infected their targets '''
+        target_dates = [[] for i in range(self.pop_size)]
+        for src,date in zip(self.source_inds.tolist(), self.transmission_dates.tolist()):
+            target_dates[src].append(date)
+        return target_dates
+
+
     def day(self, day=None, which=None):
         ''' Convenience function for converting an input to an integer day '''
         if day is not None:
@@ -1879,51 +2166,30 @@ class TransTree(Analyzer):
         start_day = self.day(start_day, which='start')
         end_day   = self.day(end_day,   which='end')
 
-        n_targets = np.nan+np.zeros(self.pop_size)
-        for i in range(self.pop_size):
-            if self.sources[i] is not None:
-                if self.source_dates[i] >= start_day and self.source_dates[i] <= end_day:
-                    n_targets[i] = len(self.targets[i])
-        n_target_inds = sc.findinds(np.isfinite(n_targets))
-        n_targets = n_targets[n_target_inds]
+        dates = self.source_date_arr
+        inds = (self.source_arr >= 0) & (dates >= start_day) & (dates <= end_day)
+        n_targets = np.bincount(self.source_inds, minlength=self.pop_size)[inds].astype(cvd.default_float)
         self.n_targets = n_targets
         return n_targets
 
 
     def count_transmissions(self):
         """
-        Iterable over edges corresponding to transmission events
+        Iterable over edges corresponding to transmission events, as an array
+        with one row of [source, target] per transmission
 
         This excludes edges corresponding to seeded infections without a source
         """
-        source_inds = []
-        target_inds = []
-        transmissions = []
-        for d in self.infection_log:
-            if d['source'] is not None:
-                src = d['source']
-                trg = d['target']
-                source_inds.append(src)
-                target_inds.append(trg)
-                transmissions.append([src, trg])
+        transmissions = np.column_stack([self.source_inds, self.target_inds])
         self.transmissions = transmissions
-        self.source_inds = source_inds
-        self.target_inds = target_inds
         return transmissions
 
 
     def make_detailed(self, people, reset=False):
         ''' Construct a detailed transmission tree, with additional information for each person '''
 
-        def df_to_arrdict(df):
-            ''' Convert a dataframe to a dictionary of arrays '''
-            arrdict = {}
-            for col in df.columns:
-                arrdict[col] = df[col].values
-            return arrdict
-
-        # Convert infection log to a dataframe and from there to a dict of arrays
-        inflog = df_to_arrdict(sc.dcp(pd.DataFrame(self.infection_log)))
+        # Convert infection log to a dict of arrays (a copy, with NaN for missing sources)
+        inflog = self.infection_log.to_dict()
 
         # Initialization
         n_people = len(people)
@@ -2022,16 +2288,12 @@ class TransTree(Analyzer):
         before the end of the simulation, thus ensuring they all had the same amount of
         time to transmit.
         """
-        n_infected = []
-        try:
-            for i, node in self.graph.nodes.items():
-                if i is None or np.isnan(node['date_exposed']) or (recovered_only and node['date_recovered']>self.n_days):
-                    continue
-                n_infected.append(self.graph.out_degree(i))
-        except Exception as E: # pragma: no cover
-            errormsg = f'Unable to compute r0 ({str(E)}): you may need to reinitialize the transmission tree with to_networkx=True'
-            raise RuntimeError(errormsg)
-        return np.mean(n_infected)
+        pairs = np.unique(self.transmissions, axis=0) # Count each source-target pair once, as for a graph
+        out_degree = np.bincount(pairs[:,0], minlength=self.pop_size)
+        inds = ~np.isnan(self.date_exposed)
+        if recovered_only:
+            inds &= ~(self.date_recovered > self.n_days)
+        return np.mean(out_degree[inds])
 
 
     def plot(self, fig_args=None, plot_args=None, do_show=None, fig=None):
@@ -15,7 +15,7 @@ from . import defaults as cvd
 from . import parameters as cvpar
 
 # Specify all externally visible classes this file defines
-__all__ = ['ParsObj', 'Result', 'BaseSim', 'BasePeople', 'Person', 'FlexDict', 'Contacts', 'Layer']
+__all__ = ['ParsObj', 'Result', 'BaseSim', 'BasePeople', 'Person', 'FlexDict', 'Contacts', 'Layer', 'InfectionLog']
 
 
 #%% Define simulation classes
@@ -630,6 +630,27 @@ class BaseSim(ParsObj):
         return output
 
 
+    def to_parquet(self, filename, **kwargs):
+        '''
+        Export results in long format (one row per result and day) as a Parquet
+        file; see ``cv.to_parquet()`` for details. Requires PyArrow.
+
+        Args:
+            filename (str): the file to write to
+            kwargs (dict): passed to ``cv.to_parquet()``
+
+        Returns:
+            filename (str): the path of the written file
+
+        **Example**::
+
+            sim = cv.Sim().run()
+            sim.to_parquet('results.parquet')
+            df = cv.read_parquet('results.parquet', keys='cum_deaths')
+        '''
+        return cvm.to_parquet(self, filename, **kwargs)
+
+
     def shrink(self, skip_attrs=None, in_place=True):
         '''
         "Shrinks" the simulation by removing the people and other memory-intensive
@@ -1869,3 +1890,195 @@ class Layer(FlexDict):
         self['beta'][inds] = np.ones(n_new, dtype=cvd.default_float)
         return
 
+
+
+
+class InfectionLog(FlexPretty):
+    '''
+    A columnar record of who infected whom. Each infection is a row in a set of
+    preallocated typed arrays, which grow as needed, rather than a dictionary:
+    this keeps memory use low and lets the transmission tree be computed directly
+    with array operations.
+
+    The columns are "source" (-1 for seed infections and importations), "target",
+    "date", "layer", and "variant". The last two are stored as integer codes into
+    ``log.labels['layer']`` and ``log.labels['variant']``. For backwards compatibility,
+    iterating over the log or indexing it with an integer returns dictionaries with
+    keys source (None if no source), target, date, layer, and variant.
+
+    Args:
+        size (int): the number of rows to preallocate
+
+    **Examples**::
+
+        sim = cv.Sim().run()
+        log = sim.people.infection_log
+        log['target']         # Array of everyone who was infected
+        log.get('layer')      # Array of the layer names of each infection
+        log[0]                # The first infection as a dictionary
+        df = log.to_df()      # Convert to a dataframe
+    '''
+
+    def __init__(self, size=1000):
+        self.meta = {
+            'source':  cvd.default_int, # Person who transmitted the infection, -1 if none
+            'target':  cvd.default_int, # Person who was infected
+            'date':    cvd.default_int, # Timestep of infection
+            'layer':   cvd.default_int, # Code of the layer the infection was transmitted on
+            'variant': cvd.default_int, # Code of the variant
+        }
+        self.labels = {'layer':[], 'variant':[]} # Mapping from codes to labels
+        self.n = 0 # Number of infections recorded
+        self.arrs = {key:np.empty(size, dtype=dtype) for key,dtype in self.meta.items()}
+        return
+
+
+    def __len__(self):
+        return self.n
+
+
+    def _brief(self):
+        ''' Return a one-line description of the infection log '''
+        n_seed = np.count_nonzero(self['source'] < 0)
+        return f'InfectionLog({self.n} infections, {self.n-n_seed} transmissions; layers: {sc.strjoin(self.labels["layer"])})'
+
+
+    def __getitem__(self, key):
+        ''' Return a column (str), an infection as a dictionary (int), or a subset of the log (slice) '''
+        if isinstance(key, str):
+            if key not in self.arrs: # pragma: no cover
+                errormsg = f'Key "{key}" is not a column of the infection log; choices are {sc.strjoin(self.keys())}'
+                raise sc.KeyNotFoundError(errormsg)
+            return self.arrs[key][:self.n]
+        elif isinstance(key, slice):
+            return self.subset(*key.indices(self.n)[:2])
+        else:
+            if key < 0:
+                key += self.n
+            if not (0 <= key < self.n): # pragma: no cover
+                raise IndexError(f'Infection {key} is out of range for an infection log of length {self.n}')
+            source = self.arrs['source'][key]
+            return dict(source  = int(source) if source >= 0 else None,
+                        target  = int(self.arrs['target'][key]),
+                        date    = int(self.arrs['date'][key]),
+                        layer   = self.labels['layer'][self.arrs['layer'][key]],
+                        variant = self.labels['variant'][self.arrs['variant'][key]])
+
+
+    def __iter__(self):
+        ''' Iterate over infections as dictionaries '''
+        for i in range(self.n):
+            yield self[i]
+
+
+    def keys(self):
+        ''' The names of the columns '''
+        return list(self.meta.keys())
+
+
+    def code(self, key, label):
+        ''' Return the integer code for a layer or variant label, adding it if needed '''
+        labels = self.labels[key]
+        if label not in labels:
+            labels.append(label)
+        return labels.index(label)
+
+
+    def _grow(self, n_new):
+        ''' Make sure there is room for n_new more rows, doubling the size as needed '''
+        n_total = self.n + n_new
+        size = len(self.arrs['target'])
+        if n_total > size:
+            size = max(n_total, 2*size)
+            for key in self.keys():
+                self.arrs[key] = np.resize(self.arrs[key], size) # Preserves dtype
+        return
+
+
+    def add(self, target, source=None, date=0, layer=None, variant=None):
+        '''
+        Record one or more infections.
+
+        Args:
+            target  (array): the people who were infected
+            source  (array): the people who infected them (None if seed infections or importations)
+            date    (int):   the timestep of the infections
+            layer   (str):   the layer the infections were transmitted on
+            variant (str):   the label of the variant
+        '''
+        target = sc.promotetoarray(target)
+        n_new = len(target)
+        if n_new == 0:
+            return
+        self._grow(n_new)
+        new = slice(self.n, self.n+n_new)
+        self.arrs['target'][new]  = target
+        self.arrs['source'][new]  = -1 if source is None else sc.promotetoarray(source)
+        self.arrs['date'][new]    = date
+        self.arrs['layer'][new]   = self.code('layer', layer)
+        self.arrs['variant'][new] = self.code('variant', variant)
+        self.n += n_new
+        return
+
+
+    def append(self, entry):
+        ''' Record a single infection from a dictionary, as in previous versions '''
+        source = entry.get('source')
+        self.add(target=entry['target'], source=None if source is None else [source], date=entry['date'],
+                 layer=entry.get('layer'), variant=entry.get('variant'))
+        return
+
+
+    def extend(self, log):
+        ''' Append all the infections in another infection log '''
+        n_new = len(log)
+        if n_new == 0:
+            return
+        self._grow(n_new)
+        new = slice(self.n, self.n+n_new)
+        for key in ['source', 'target', 'date']:
+            self.arrs[key][new] = log[key]
+        for key in self.labels.keys(): # Recode the labels, since the codes may differ between logs
+            mapping = np.array([self.code(key, label) for label in log.labels[key]], dtype=self.meta[key])
+            self.arrs[key][new] = mapping[log[key]] if len(mapping) else log[key]
+        self.n += n_new
+        return
+
+
+    def subset(self, start=0, stop=None):
+        ''' Return a new infection log containing the rows from start to stop '''
+        stop = self.n if stop is None else min(stop, self.n)
+        start = min(start, stop)
+        log = InfectionLog(size=max(stop-start, 1))
+        for key in self.keys():
+            log.arrs[key][:stop-start] = self.arrs[key][start:stop]
+        log.labels = sc.dcp(self.labels)
+        log.n = stop - start
+        return log
+
+
+    def get(self, key):
+        ''' Return a column, with layers and variants converted from codes to labels '''
+        arr = self[key]
+        if key in self.labels:
+            arr = np.array(self.labels[key]+[None], dtype=object)[arr] # The extra entry is never indexed, but forces a 1D object array
+        return arr
+
+
+    def to_dict(self):
+        ''' Convert to a dictionary of arrays, with NaN for missing sources and labels for layers and variants '''
+        source = self['source'].astype(cvd.default_float)
+        source[source < 0] = np.nan
+        output = {key:self.get(key) for key in self.keys()}
+        output['source'] = source
+        return output
+
+
+    def to_df(self):
+        ''' Convert to a dataframe '''
+        return pd.DataFrame(self.to_dict())
+
+
+    def to_list(self):
+        ''' Convert to a list of dictionaries, as in previous versions '''
+        return list(self)
@@ -3,6 +3,7 @@ Miscellaneous functions that do not belong anywhere else
 '''
 
 import re
+import hashlib
 import inspect
 import warnings
 import numpy as np
@@ -212,6 +213,192 @@ def savefig(filename=None, comments=None, fig=None, **kwargs):
     return filename
 
 
+#%% Columnar export functions
+
+__all__ += ['to_parquet', 'read_parquet']
+
+
+def import_pyarrow():
+    ''' A helper function to import PyArrow, which is an optional dependency '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ModuleNotFoundError as E: # pragma: no cover
+        errormsg = f'PyArrow import failed ({str(E)}), please install first (pip install pyarrow)'
+        raise ModuleNotFoundError(errormsg)
+    return pa, pq
+
+
+def pars_hash(sim, skip=None):
+    '''
+    Compute a short hash of the parameters of a sim, so that runs of the same
+    scenario (by default, differing only in their random seed) can be grouped.
+
+    Args:
+        sim (Sim): the sim to hash the parameters of
+        skip (list): parameters to exclude from the hash (default: rand_seed, verbose, and analyzers)
+
+    Returns:
+        A 16-character hexadecimal string
+    '''
+    if skip is None:
+        skip = ['rand_seed', 'verbose', 'analyzers']
+    pars = {k:v for k,v in sim.export_pars().items() if k not in skip}
+    string = sc.jsonify(pars, tostring=True)
+    return hashlib.sha1(string.encode()).hexdigest()[:16]
+
+
+def _parquet_schema(pa):
+    ''' The schema of the long-format results table: one row per sim, result, and day '''
+    labels = pa.dictionary(pa.int32(), pa.string()) # Repeated strings are stored once per row group
+    schema = pa.schema([
+        ('sim',       pa.int32()),
+        ('label',     labels),
+        ('pars_hash', labels),
+        ('t',         pa.int32()),
+        ('date',      pa.date32()),
+        ('key',       labels),
+        ('variant',   labels),
+        ('value',     pa.float64()),
+        ('low',       pa.float64()),
+        ('high',      pa.float64()),
+    ])
+    return schema
+
+
+def _sim_to_table(sim, index, pa, schema, variants=True, hash_skip=None):
+    ''' Convert the results of a single sim to a long-format PyArrow table '''
+    from . import base as cvb # To avoid circular imports
+
+    if not sim.results_ready: # pragma: no cover
+        errormsg = 'Please run the sim before exporting the results'
+        raise RuntimeError(errormsg)
+
+    # Collect each row of results as (key, variant, values, low, high)
+    rows = []
+    for key,res in sim.results.items():
+        if isinstance(res, cvb.Result):
+            rows.append((key, None, res.values, res.low, res.high))
+    if variants:
+        variant_labels = [sim['variant_map'][v] for v in range(sim['n_variants'])]
+        for key,res in sim.results['variant'].items():
+            for v,variant in enumerate(variant_labels):
+                low  = res.low[v]  if res.low  is not None else None
+                high = res.high[v] if res.high is not None else None
+                rows.append((key, variant, res.values[v], low, high))
+
+    # Flatten into columns without building a dataframe
+    npts   = len(sim.results['t'])
+    n_rows = len(rows)*npts
+    empty  = np.full(npts, np.nan)
+
+    def dict_col(labels):
+        ''' Dictionary-encode a label per result, with None as a null '''
+        uniques = list(dict.fromkeys(l for l in labels if l is not None))
+        codes = np.array([uniques.index(l) if l is not None else 0 for l in labels], dtype=np.int32)
+        mask = np.array([l is None for l in labels], dtype=bool)
+        indices = pa.array(np.repeat(codes, npts), mask=np.repeat(mask, npts))
+        return pa.DictionaryArray.from_arrays(indices, pa.array(uniques, type=pa.string()))
+
+    def float_col(i):
+        ''' Concatenate a values/low/high column, with nulls where a result has no such values '''
+        vals = np.concatenate([row[i] if row[i] is not None else empty for row in rows]) if rows else np.zeros(0)
+        mask = np.repeat([row[i] is None for row in rows], npts)
+        return pa.array(np.asarray(vals, dtype=np.float64), mask=mask if mask.any() else None)
+
+    dates = np.array(sim.datevec, dtype='datetime64[D]')
+    arrays = [
+        pa.array(np.full(n_rows, index, dtype=np.int32)),
+        dict_col([str(sim.label) if sim.label is not None else None]*len(rows)),
+        dict_col([pars_hash(sim, skip=hash_skip)]*len(rows)),
+        pa.array(np.tile(np.arange(npts, dtype=np.int32), len(rows))),
+        pa.array(np.tile(dates, len(rows))),
+        dict_col([row[0] for row in rows]),
+        dict_col([row[1] for row in rows]),
+        float_col(2),
+        float_col(3),
+        float_col(4),
+    ]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def to_parquet(sims, filename, variants=True, row_group_size=None, compression='snappy', hash_skip=None, **kwargs):
+    '''
+    Write the results of one or more sims to a single long-format Parquet file,
+    with one row per sim, result, and day. Sims are written one at a time as
+    separate row groups, so the full table is never held in memory; this means
+    ``sims`` can also be a generator that e.g. loads each sim from disk in turn.
+
+    The columns are: "sim" (the index of the sim), "label", "pars_hash" (see
+    ``cv.misc.pars_hash()``), "t", "date", "key" (the result key, e.g. "new_infections"),
+    "variant" (the variant label for variant results, otherwise null), and "value",
+    "low", and "high" (null if the result has no bounds). See also ``cv.read_parquet()``.
+
+    Args:
+        sims (Sim/list): the sim or sims to export; each must have been run
+        filename (str): the file to write to
+        variants (bool): whether to include results by variant
+        row_group_size (int): the maximum number of rows per row group (default: one row group per sim)
+        compression (str): the compression to use (passed to ``pq.ParquetWriter()``)
+        hash_skip (list): parameters to exclude from the parameters hash
+        kwargs (dict): passed to ``sc.makefilepath()``
+
+    Returns:
+        filename (str): the path of the written file
+
+    **Example**::
+
+        msim = cv.MultiSim(cv.Sim(), n_runs=100).run()
+        cv.to_parquet(msim.sims, 'runs.parquet')
+        df = cv.read_parquet('runs.parquet', keys='new_infections')
+    '''
+    pa, pq = import_pyarrow()
+    schema = _parquet_schema(pa)
+    filename = sc.makefilepath(filename=filename, **kwargs)
+    if hasattr(sims, 'results'): # It's a single sim
+        sims = [sims]
+    with pq.ParquetWriter(filename, schema, compression=compression) as writer:
+        for i,sim in enumerate(sims):
+            table = _sim_to_table(sim, index=i, pa=pa, schema=schema, variants=variants, hash_skip=hash_skip)
+            writer.write_table(table, row_group_size=row_group_size)
+    return filename
+
+
+def read_parquet(filename, keys=None, sims=None, hashes=None, variants=None, columns=None, to_df=True):
+    '''
+    Read results written by ``cv.to_parquet()``. Filters are pushed down to the
+    Parquet reader, so row groups that do not match are never loaded.
+
+    Args:
+        filename (str): the file (or directory of files) to read
+        keys (str/list): if supplied, only read these result keys
+        sims (int/list): if supplied, only read these sim indices
+        hashes (str/list): if supplied, only read sims with these parameter hashes
+        variants (str/list): if supplied, only read results for these variants
+        columns (list): if supplied, only read these columns
+        to_df (bool): whether to convert to a dataframe (else, return a PyArrow table)
+
+    Returns:
+        A dataframe (or PyArrow table) of results in long format
+
+    **Example**::
+
+        df = cv.read_parquet('runs.parquet', keys=['new_infections', 'new_deaths'], sims=range(10))
+        df.pivot_table(index='t', columns='key', values='value', aggfunc='mean')
+    '''
+    pa, pq = import_pyarrow()
+    filters = []
+    for col,vals in [['key', keys], ['sim', sims], ['pars_hash', hashes], ['variant', variants]]:
+        if vals is not None:
+            vals = [int(v) for v in sc.tolist(vals)] if col == 'sim' else sc.tolist(vals)
+            filters.append((col, 'in', vals))
+    table = pq.read_table(filename, columns=columns, filters=filters if filters else None)
+    if to_df:
+        return table.to_pandas()
+    else:
+        return table
+
+
 #%% Migration functions
 
 __all__ += ['migrate']
@@ -267,6 +454,23 @@ def migrate_variants(pars, verbose=True):
     return
 
 
+def migrate_infection_log(people, verbose=True):
+    '''
+    Small helper function to convert an infection log stored as a list of dictionaries
+    (as in previous versions) to an InfectionLog, with -1 for missing sources and
+    codes for the layer and variant labels.
+    '''
+    from . import base as cvb # To avoid circular imports
+    old_log = people.infection_log
+    log = cvb.InfectionLog(size=max(len(old_log), 1))
+    for entry in old_log:
+        log.append(entry) # Handles missing sources and converts labels to codes
+    people.infection_log = log
+    if verbose > 1:
+        print(f'  Converted {len(log)} infections to an InfectionLog')
+    return
+
+
 def migrate(obj, update=True, verbose=True, die=False):
     '''
     Define migrations allowing compatibility between different versions of saved
@@ -355,6 +559,13 @@ def migrate(obj, update=True, verbose=True, die=False):
             if not hasattr(ppl, 'infected_initialized'):
                 ppl.infected_initialized = True
 
+        # Migration from a list of dictionaries to a columnar infection log
+        if isinstance(getattr(ppl, 'infection_log', None), list):
+            if verbose:
+                print(f'Migrating people from version {ppl.version} to version {cvv.__version__}')
+                print('Converting the infection log to an InfectionLog')
+            migrate_infection_log(ppl, verbose=verbose)
+
     # Migrations for MultiSims -- use recursion
     elif isinstance(obj, cvr.MultiSim):
         msim = obj
@@ -710,9 +921,13 @@ def compute_gof(actual, predicted, normalize=True, use_frac=False, use_squared=F
     highly customizable. For example, mean squared error is equivalent to
     setting normalize=False, use_squared=True, as_scalar='mean'.
 
+    The default calculation is vectorized over any leading dimensions, so e.g.
+    predictions from many sims can be scored at once with a predicted array of
+    shape (n_sims, n_points); normalization and as_scalar apply along the last axis.
+
     Args:
         actual      (arr):   array of actual (data) points
-        predicted   (arr):   corresponding array of predicted (model) points
+        predicted   (arr):   corresponding array of predicted (model) points (or a stack of them)
         normalize   (bool):  whether to divide the values by the largest value in either series
         use_frac    (bool):  convert to fractional mismatches rather than absolute
         use_squared (bool):  square the mismatches
@@ -735,6 +950,7 @@ def compute_gof(actual, predicted, normalize=True, use_frac=False, use_squared=F
         e3 = compute_gof(x1, x2, normalize=False, use_squared=True, as_scalar='mean') # Mean squared error
         e4 = compute_gof(x1, x2, skestimator='mean_squared_error') # Scikit-learn's MSE method
         e5 = compute_gof(x1, x2, as_scalar='median') # Normalized median absolute error -- highly robust
+        e6 = compute_gof(x1, np.vstack([x1, x2]), as_scalar='sum') # One value per row
     '''
 
     # Handle inputs
@@ -768,9 +984,8 @@ def compute_gof(actual, predicted, normalize=True, use_frac=False, use_squared=F
         gofs = abs(np.array(actual) - np.array(predicted))
 
         if normalize and not use_frac:
-            actual_max = abs(actual).max()
-            if actual_max>0:
-                gofs /= actual_max
+            actual_max = abs(actual).max(axis=-1, keepdims=True)
+            gofs = np.divide(gofs, actual_max, out=gofs, where=actual_max>0)
 
         if use_frac:
             if (actual<0).any() or (predicted<0).any():
@@ -783,11 +998,11 @@ def compute_gof(actual, predicted, normalize=True, use_frac=False, use_squared=F
             gofs = gofs**2
 
         if as_scalar == 'sum':
-            gofs = np.sum(gofs)
+            gofs = np.sum(gofs, axis=-1)
         elif as_scalar == 'mean':
-            gofs = np.mean(gofs)
+            gofs = np.mean(gofs, axis=-1)
         elif as_scalar == 'median':
-            gofs = np.median(gofs)
+            gofs = np.median(gofs, axis=-1)
 
         return gofs
 
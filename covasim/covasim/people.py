@@ -56,7 +56,7 @@ class People(cvb.BasePeople):
         self.meta = cvd.PeopleMeta() # Store list of keys and dtypes
         self.contacts = None
         self.init_contacts() # Initialize the contacts
-        self.infection_log = [] # Record of infections - keys for ['source','target','date','layer']
+        self.infection_log = cvb.InfectionLog() # Record of infections - columns for ['source','target','date','layer','variant']
 
         # Set person properties -- all floats except for UID
         for key in self.meta.person:
@@ -423,7 +423,7 @@ class People(cvb.BasePeople):
             * If the simulation is being run with waning, this method also sets/updates agents' neutralizing antibody levels
 
         Method also deduplicates input arrays in case one agent is infected many times
-        and stores who infected whom in infection_log list.
+        and stores who infected whom in the infection log.
 
         Args:
             inds     (array): array of people to infect
@@ -486,9 +486,7 @@ class People(cvb.BasePeople):
         self.flows_variant['new_infections_by_variant'][variant] += n_infections
 
         # Record transmissions
-        for i, target in enumerate(inds):
-            entry = dict(source=source[i] if source is not None else None, target=target, date=self.t, layer=layer, variant=variant_label)
-            self.infection_log.append(entry)
+        self.infection_log.add(target=inds, source=source, date=self.t, layer=layer, variant=variant_label)
 
         # Calculate how long before this person can infect other people
         self.dur_exp2inf[inds] = cvu.sample(**durpars['exp2inf'], size=n_infections)
@@ -731,7 +729,10 @@ class People(cvb.BasePeople):
                 if not np.isnan(date):
                     events.append((date, message))
 
-            for infection in self.infection_log:
+            log = self.infection_log
+            sources = log['source']
+            for i in np.flatnonzero((log['target'] == uid) | (sources == uid)):
+                infection = log[i]
                 lkey = infection['layer']
                 llabel = label_lkey(lkey)
                 if infection['target'] == uid:
@@ -741,7 +742,7 @@ class People(cvb.BasePeople):
                         events.append((infection['date'], 'was infected with COVID as a seed infection'))
 
                 if infection['source'] == uid:
-                    x = len([a for a in self.infection_log if a['source'] == infection['target']])
+                    x = np.count_nonzero(sources == infection['target'])
                     events.append((infection['date'],f'gave COVID to {infection["target"]} via the {llabel} layer ({x} secondary infections)'))
 
             if len(events):
@@ -374,6 +374,70 @@ class MultiSim(cvb.FlexPretty):
             return
 
 
+    def compute_fit(self, keys=None, weights=None, use_median=False, return_losses=False, die=True, **kwargs):
+        '''
+        Compute the fit of every sim to the data at once. The data dates are matched
+        against the sim dates only once, the matched results of all sims are stacked
+        into an array of shape (n_sims, n_keys, n_days), and the goodness-of-fit is
+        then computed for all sims together. Gives the same mismatches as calling
+        sim.compute_fit() on each sim, but much faster for large ensembles. See
+        cv.Fit() for more information.
+
+        Args:
+            keys          (list): the result keys to compare to the data (default: all cumulative keys in the data)
+            weights       (dict): the weight of each key
+            use_median    (bool): whether to take the median rather than the sum of the losses over time
+            return_losses (bool): whether to also return the losses of each key, each of shape (n_sims, n_matches)
+            die           (bool): whether to raise an exception if no data or matches are found
+            kwargs        (dict): passed to cv.compute_gof()
+
+        Returns:
+            mismatches (array): the mismatch of each sim; if return_losses, a tuple of the mismatches and the losses
+
+        **Example**::
+
+            msim = cv.MultiSim(cv.Sim(datafile='data.csv'), n_runs=100)
+            msim.run()
+            mismatches = msim.compute_fit()
+            best = msim.sims[mismatches.argmin()]
+        '''
+        from . import analysis as cva # To avoid circular imports
+
+        if not self.sims: # pragma: no cover
+            errormsg = 'Cannot compute fit since there are no sims -- did you run the multisim?'
+            raise RuntimeError(errormsg)
+        if kwargs.get('as_scalar', 'none') != 'none':
+            errormsg = 'The as_scalar option cannot be used with a batched fit; use use_median instead'
+            raise ValueError(errormsg)
+        npts = self.sims[0].npts
+        for sim in self.sims:
+            if not sim.results_ready: # pragma: no cover
+                errormsg = 'Cannot compute fit since results are not ready yet -- did you run the multisim?'
+                raise RuntimeError(errormsg)
+            if sim.npts != npts:
+                errormsg = f'Cannot compute a batched fit for sims with inconsistent numbers of days: {npts} vs. {sim.npts}'
+                raise ValueError(errormsg)
+
+        # Match the data to the first sim, then replace its results with those of every sim
+        fit = cva.Fit(self.sims[0], keys=keys, weights=weights, compute=False, die=die, **kwargs)
+        fit.reconcile_inputs()
+        stacked = np.array([[sim.results[key].values for key in fit.keys] for sim in self.sims], dtype=float)
+        for k,key in enumerate(fit.keys):
+            fit.pair[key].sim = stacked[:, k, fit.inds.sim[key]]
+
+        # Compute the fit for all sims together
+        fit.compute_diffs()
+        fit.compute_gofs()
+        fit.compute_losses()
+        mismatches = fit.compute_mismatch(use_median=use_median)
+        mismatches = np.broadcast_to(mismatches, (len(self.sims),)).copy() # In case there are no keys
+
+        if return_losses:
+            return mismatches, fit.losses
+        else:
+            return mismatches
+
+
     def compare(self, t=None, sim_inds=None, output=False, do_plot=False, **kwargs):
         '''
         Create a dataframe compare sims at a single point in time.
@@ -858,6 +922,31 @@ class MultiSim(cvb.FlexPretty):
         return self.base_sim.to_excel(*args, **kwargs)
 
 
+    def to_parquet(self, filename, **kwargs):
+        '''
+        Export the results of every sim to a single long-format Parquet file, written
+        one sim at a time; see ``cv.to_parquet()`` for details. The "sim" column is
+        the index of the sim in ``msim.sims``. Requires PyArrow.
+
+        Args:
+            filename (str): the file to write to
+            kwargs (dict): passed to ``cv.to_parquet()``
+
+        Returns:
+            filename (str): the path of the written file
+
+        **Example**::
+
+            msim = cv.MultiSim(cv.Sim(), n_runs=20).run()
+            msim.to_parquet('runs.parquet')
+            df = cv.read_parquet('runs.parquet', keys='new_infections', sims=range(5))
+        '''
+        if not self.sims: # pragma: no cover
+            errormsg = 'Parquet export requires the individual sims; please run the multisim first'
+            raise RuntimeError(errormsg)
+        return cvm.to_parquet(self.sims, filename, **kwargs)
+
+
 class Scenarios(cvb.ParsObj):
     '''
     Class for running multiple sets of multiple simulations -- e.g., scenarios.
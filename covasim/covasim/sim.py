@@ -951,8 +951,8 @@ class Sim(cvb.BaseSim):
         # Alternate (traditional) method -- count from the date of infection or outcome
         elif method in ['infectious', 'outcome']:
 
-            # Store a mapping from each source to their date
-            source_dates = {}
+            # Store a mapping from each source to their date, -1 if not a source during the sim
+            source_dates = np.full(len(self.people), -1, dtype=cvd.default_int)
 
             for t in self.tvec:
 
@@ -966,18 +966,14 @@ class Sim(cvb.BaseSim):
                 sources[t] = len(inds)
 
                 # Create the mapping from sources to dates
-                for ind in inds:
-                    source_dates[ind] = t
+                source_dates[inds] = t
 
-            # Targets are hard -- loop over the transmission tree
-            for transdict in self.people.infection_log:
-                source = transdict['source']
-                if source is not None and source in source_dates: # Skip seed infections and people with e.g. recovery after the end of the sim
-                    source_date = source_dates[source]
-                    targets[source_date] += 1
-
-                # for ind in inds:
-                #     targets[t] += len(self.people.transtree.targets[ind])
+            # Targets are hard -- count the transmissions from each source on the date they became a source
+            log = self.people.infection_log
+            log_sources = log['source']
+            dates = source_dates[log_sources[log_sources >= 0]] # Skip seed infections
+            dates = dates[dates >= 0] # Skip people with e.g. recovery after the end of the sim
+            targets += np.bincount(dates, minlength=self.npts)[:self.npts]
 
             # Populate the array -- to avoid divide-by-zero, skip indices that are 0
             r_eff = np.divide(targets, sources, out=np.full(self.npts, np.nan), where=sources > 0)
@@ -1010,28 +1006,24 @@ class Sim(cvb.BaseSim):
             gen_time (dict): the generation time results
         '''
 
-        intervals1 = np.zeros(len(self.people))
-        intervals2 = np.zeros(len(self.people))
-        pos1 = 0
-        pos2 = 0
+        log = self.people.infection_log
+        has_source = log['source'] >= 0 # Skip seed infections
+        source_inds = log['source'][has_source]
+        target_inds = log['target'][has_source]
         date_exposed = self.people.date_exposed
         date_symptomatic = self.people.date_symptomatic
 
-        for infection in self.people.infection_log:
-            if infection['source'] is not None:
-                source_ind = infection['source']
-                target_ind = infection['target']
-                intervals1[pos1] = date_exposed[target_ind] - date_exposed[source_ind]
-                pos1 += 1
-                if np.isfinite(date_symptomatic[source_ind]) and np.isfinite(date_symptomatic[target_ind]):
-                    intervals2[pos2] = date_symptomatic[target_ind] - date_symptomatic[source_ind]
-                    pos2 += 1
+        intervals1 = date_exposed[target_inds] - date_exposed[source_inds]
+        symp_source = date_symptomatic[source_inds]
+        symp_target = date_symptomatic[target_inds]
+        both_symp = np.isfinite(symp_source) & np.isfinite(symp_target)
+        intervals2 = symp_target[both_symp] - symp_source[both_symp]
 
         self.results['gen_time'] = {
-                'true':         np.mean(intervals1[:pos1]),
-                'true_std':     np.std(intervals1[:pos1]),
-                'clinical':     np.mean(intervals2[:pos2]),
-                'clinical_std': np.std(intervals2[:pos2])}
+                'true':         np.mean(intervals1),
+                'true_std':     np.std(intervals1),
+                'clinical':     np.mean(intervals2),
+                'clinical_std': np.std(intervals2)}
         return self.results['gen_time']
 
 
@@ -55,6 +55,7 @@ setup(
             'plotly',
             'fire',
             'optuna',
+            'pyarrow',
             'synthpops',
             'parestlib',
         ],